@@ -8,6 +8,8 @@ import optparse
 import itertools
 import copy
 import traceback
+import warnings
+import collections
 
 import statsmodels as sm
 import scipy.stats as spstats
@@ -18,6 +20,7 @@ import seaborn as sns
 import cPickle as pkl
 
 from pipeline.python.classifications import experiment_classes as util
+from pipeline.python.classifications import test_responsivity as resp
 from pipeline.python.utils import label_figure, natural_keys, reformat_morph_values, add_meta_to_df, isnumber, split_datakey, split_datakey_str
 
 # ===============================================================
@@ -2947,15 +2950,62 @@ def load_corrected_dff_traces(animalid, session, fov, experiment='blobs', tracei
             return dff
     else:
         labels = pd.DataFrame(data=dset['labels_data'],columns=dset['labels_columns'])
-        dfmat = traces_to_trials(dff, labels, epoch=epoch, metric=metric)
+        datakey = '%s_%s_fov%i' % (session, animalid, int(fov.split('_')[0][3:]))
+        dfmat = traces_to_trials(dff, labels, epoch=epoch, metric=metric, 
+                                 datakey='%s_%s_dff0' % (datakey, experiment))
         return dfmat 
 
 
 
-def traces_to_trials(traces, labels, epoch='stimulus', metric='mean', n_on=None):
+# Trial tensors by datakey, most recently used last. An entry is reused only for the same traces and 
+# labels objects (identity, not content), so traces/labels must not be modified in place between calls.
+trial_tensors = collections.OrderedDict()
+max_trial_tensors = 2
+
+def get_trial_tensor(traces, labels, datakey=None):
+    '''
+    test_responsivity.build_trial_tensor(traces, labels), cached per datakey (see trial_tensors).
+    '''
+    if datakey is None:
+        return resp.build_trial_tensor(traces, labels)
+    entry = trial_tensors.pop(datakey, None)
+    if entry is None or entry['traces'] is not traces or entry['labels'] is not labels:
+        entry = {'traces': traces, 'labels': labels, 'tensor': resp.build_trial_tensor(traces, labels)}
+    trial_tensors[datakey] = entry
+    while len(trial_tensors) > max_trial_tensors:
+        trial_tensors.popitem(last=False)
+
+    return entry['tensor']
+
+def clear_trial_tensors():
+    trial_tensors.clear()
+
+def trial_epoch_metric(tensor, s_on, n_on=None, epoch='stimulus', metric='mean'):
+    '''
+    Per-trial metric (ntrials x nrois) from trial tensor (ntrials x nframes x nrois).
+    epoch:  'baseline' (frames 0:s_on) or 'stimulus'/'firsthalf'/'plushalf' (frames s_on:s_on+n_on)
+    metric: 'mean', 'zscore' (epoch mean / std of baseline), or 'std' (std of epoch)
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        curr_frames = tensor[:, 0:s_on, :] if epoch=='baseline' else tensor[:, s_on:s_on+n_on, :]
+        if metric=='std':
+            return np.nanstd(curr_frames, axis=1)
+        responses = np.nanmean(curr_frames, axis=1)
+        if metric=='zscore':
+            responses = responses / np.nanstd(tensor[:, 0:s_on, :], axis=1)
+
+    return responses
+
+def traces_to_trials(traces, labels, epoch='stimulus', metric='mean', n_on=None, trial_tensor=None, datakey=None):
     '''
     Returns dataframe w/ columns = roi ids, rows = mean response to stim ON per trial
     Last column is config on given trial.
+
+    trial_tensor: output of test_responsivity.build_trial_tensor(traces, labels), to reuse 
+    one tensor across calls (different epochs/metrics) on the same traces and labels.
+    datakey: if given (and no trial_tensor), the tensor is cached for repeated calls with the 
+    same traces and labels objects (see get_trial_tensor()).
     '''
     s_on = int(labels['stim_on_frame'].mean())
     if epoch=='stimulus':
@@ -2967,29 +3017,12 @@ def traces_to_trials(traces, labels, epoch='stimulus', metric='mean', n_on=None)
         n_on = int(labels['nframes_on'].mean() + half_dur) 
 
     roi_list = traces.columns.tolist()
-    trial_list = np.array([int(trial[5:]) for trial, g in labels.groupby(['trial'])])
-    if epoch in ['stimulus', 'firsthalf', 'plushalf']:
-        mean_responses = pd.DataFrame(np.vstack([np.nanmean(traces.iloc[g.index[s_on:s_on+n_on]], axis=0)\
-                                            for trial, g in labels.groupby(['trial'])]),
-                                             columns=roi_list, index=trial_list)
-        if metric=='zscore':
-            std_responses = pd.DataFrame(np.vstack([np.nanstd(traces.iloc[g.index[0:s_on]], axis=0)\
-                                            for trial, g in labels.groupby(['trial'])]),
-                                             columns=roi_list, index=trial_list)
-            tmp = mean_responses.divide(std_baseline)
-            mean_responses = tmp.copy()
-    elif epoch == 'baseline':
-        mean_responses = pd.DataFrame(np.vstack([np.nanmean(traces.iloc[g.index[0:s_on]], axis=0)\
-                                            for trial, g in labels.groupby(['trial'])]),
-                                             columns=roi_list, index=trial_list)
-        if metric=='zscore':
-            std_baseline = pd.DataFrame(np.vstack([np.nanstd(traces.iloc[g.index[0:s_on]], axis=0)\
-                                            for trial, g in labels.groupby(['trial'])]),
-                                             columns=roi_list, index=trial_list)
-            tmp = mean_responses.divide(std_baseline)
-            mean_responses = tmp.copy()
- 
-    condition_on_trial = np.array([g['config'].unique()[0] for trial, g in labels.groupby(['trial'])])
+    if trial_tensor is None:
+        trial_tensor = get_trial_tensor(traces, labels, datakey=datakey)
+    tensor, trial_list, condition_on_trial = trial_tensor
+    mean_responses = pd.DataFrame(trial_epoch_metric(tensor, s_on, n_on=n_on, epoch=epoch, 
+                                                     metric='zscore' if metric=='zscore' else 'mean'),
+                                  columns=roi_list, index=trial_list)
     mean_responses['config'] = condition_on_trial
 
     return mean_responses
@@ -3234,7 +3267,9 @@ def get_neuraldf(animalid, session, fovnum, experiment, traceid='traces001',
                 return None
             # Calculate mean trial metric
             metric = 'zscore' if response_type=='zscore' else 'mean'
-            mean_responses = traces_to_trials(traces, labels, epoch=epoch, metric=response_type)
+            datakey = '%s_%s_fov%i' % (session, animalid, fovnum)
+            mean_responses = traces_to_trials(traces, labels, epoch=epoch, metric=response_type,
+                                              datakey='%s_%s_%s' % (datakey, experiment, trace_type))
 
         # save
         with open(ndf_fpath, 'wb') as f:
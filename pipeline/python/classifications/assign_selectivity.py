@@ -39,7 +39,7 @@ from pipeline.python.paradigm import tifs_to_data_arrays as fmt
 from pipeline.python.classifications import utils as util
 from pipeline.python.utils import uint16_to_RGB
 
-from pipeline.python.utils import natural_keys, replace_root, print_elapsed_time
+from pipeline.python.utils import natural_keys, replace_root, print_elapsed_time, load_maskarray
 import pipeline.python.traces.combine_runs as cb
 import pipeline.python.paradigm.align_acquisition_events as acq
 import pipeline.python.visualization.plot_psths_from_dataframe as vis
@@ -2022,7 +2022,7 @@ def load_masks_and_img(options, INFO):
         img_src = replace_root(img_src, rootdir, animalid, session)
     
     img = tf.imread(img_src)
-    maskarray = masks[ref_file]['Slice01']['maskarray']
+    maskarray = load_maskarray(masks[ref_file]['Slice01'], 'maskarray')
     
     return maskarray, img
 
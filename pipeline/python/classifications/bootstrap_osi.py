@@ -301,8 +301,10 @@ def angdir180(x):
 
 def double_gaussian( x, c1, c2, mu, sigma, C ):
     #(c1, c2, mu, sigma) = params
-    x1vals = np.array([angdir180(xi - mu) for xi in x])
-    x2vals = np.array([angdir180(xi - mu - 180 ) for xi in x])
+    # angdir180() of all x at once
+    x = np.asarray(x, dtype=float)
+    x1vals = np.abs([x - mu, x - mu - 360, x - mu + 360]).min(axis=0)
+    x2vals = np.abs([x - mu - 180, x - mu - 180 - 360, x - mu - 180 + 360]).min(axis=0)
     res =   C + c1 * np.exp( -(x1vals**2.0) / (2.0 * sigma**2.0) )             + c2 * np.exp( -(x2vals**2.0) / (2.0 * sigma**2.0) )
 
 #    res =   C + c1 * np.exp( - ((x - mu) % 360.)**2.0 / (2.0 * sigma**2.0) ) \
@@ -479,7 +481,91 @@ def get_r2(fitr, y):
     
     return r2
 
+def get_interp_weights(n_values, n_intervals=3):
+    '''
+    Linear interpolation weights, W (n_interp x n_values), such that W.dot(response_vector) is
+    interp_values(response_vector, n_intervals=n_intervals) wrapped to the first value.
+    Lets all bootstrap iterations (columns) be interpolated in one product.
+    '''
+    n_interp = n_values*n_intervals + 1
+    W = np.zeros((n_interp, n_values))
+    for vi in range(n_values):
+        last = vi == n_values-1
+        npts = n_intervals+1 if last else n_intervals
+        t = np.linspace(0, 1, num=npts, endpoint=last)
+        rows = np.arange(vi*n_intervals, vi*n_intervals + npts)
+        W[rows, vi] += 1 - t
+        W[rows, (vi+1) % n_values] += t
+    return W
+
+def fit_ori_tuning_batch(bootdf, n_intervals_interp=3, warm_start=False):
+    '''
+    Same as fit_ori_tuning() applied to each column of bootdf, but with interpolation, init params
+    and ASI/DSI calculated for all bootstrap iterations at once.
 
+    bootdf = DataFrame
+        index : tested_oris
+        columns : bootstrap iterations
+    warm_start (bool) : start each fit from the previous iteration's fit params (clipped to current bounds),
+                        instead of the init params from get_init_params().
+    Returns
+        fitp : DataFrame, fit params (rows, as fit_ori_tuning()) x iterations
+        fitv : DataFrame, fit curve (interp oris) x iterations
+        yvs  : DataFrame, interpolated responses (interp oris) x iterations
+    '''
+    tested_oris = np.array(bootdf.index.tolist(), dtype=float)
+    R = bootdf.values.astype(float)
+    n_oris, n_iters = R.shape
+    iter_ixs = np.arange(0, n_iters)
+
+    oris_interp = interp_values(tested_oris.tolist(), n_intervals=n_intervals_interp, wrap_value=360)
+    resps_interp = get_interp_weights(n_oris, n_intervals=n_intervals_interp).dot(R)
+
+    # initial params (as get_init_params())
+    ori_ixs = dict((ori, oi) for oi, ori in enumerate(tested_oris))
+    pref_ixs = R.argmax(axis=0)
+    null_ixs = np.array([ori_ixs[(theta_pref + 180) % 360.] for theta_pref in tested_oris[pref_ixs]], dtype=int)
+    r_prefs = R[pref_ixs, iter_ixs]
+    r_nulls = R[null_ixs, iter_ixs]
+    theta_prefs = tested_oris[pref_ixs]
+    sigma = np.mean(np.diff(tested_oris))
+    non_prefs = np.ones(R.shape, dtype=bool)
+    non_prefs[pref_ixs, iter_ixs] = False
+    non_prefs[null_ixs, iter_ixs] = False
+    r_offsets = (R * non_prefs).sum(axis=0) / non_prefs.sum(axis=0)
+
+    popts = np.full((n_iters, 5), np.nan)
+    fitv = np.full((len(oris_interp), n_iters), np.nan)
+    prev_popt = None
+    for ni in range(n_iters):
+        init_params = (r_prefs[ni], r_nulls[ni], theta_prefs[ni], sigma, r_offsets[ni])
+        init_bounds = ([0, 0, -np.inf, sigma/2., -r_prefs[ni]], [3*r_prefs[ni], 3*r_prefs[ni], np.inf, np.inf, r_prefs[ni]])
+        if warm_start and prev_popt is not None:
+            init_params = tuple(np.clip(prev_popt, init_bounds[0], init_bounds[1]))
+        rfit, fitr = fit_osi_params(oris_interp, resps_interp[:, ni], init_params, bounds=init_bounds)
+        if rfit['success']:
+            popts[ni, :] = rfit['popt']
+            fitv[:, ni] = fitr
+            prev_popt = rfit['popt']
+
+    # Normalize range, 0 to 1, and get ASI/DSI (as get_ASI(), get_DSI())
+    thetas = np.deg2rad(oris_interp)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        response_vectors = (fitv - fitv.min(axis=0)) / (fitv.max(axis=0) - fitv.min(axis=0))
+        asi = np.abs(np.exp(2j*thetas).dot(response_vectors)) / np.abs(response_vectors).sum(axis=0)
+        dsi = np.abs(np.exp(1j*thetas).dot(response_vectors)) / np.abs(response_vectors).sum(axis=0)
+
+    fitp = pd.DataFrame({'response_pref': popts[:, 0],
+                         'response_null': popts[:, 1],
+                         'theta_pref': popts[:, 2],
+                         'sigma': popts[:, 3],
+                         'response_offset': popts[:, 4],
+                         'asi': asi,
+                         'dsi': dsi}, index=bootdf.columns).T
+    fitv = pd.DataFrame(fitv, columns=bootdf.columns)
+    yvs = pd.DataFrame(resps_interp, columns=bootdf.columns)
+
+    return fitp, fitv, yvs
 
 
 #%%
@@ -519,7 +605,8 @@ def initializer(terminating_):
 
 def bootstrap_roi_responses_by_config(roi_df, sdf=None, statdf=None, response_type='dff',
                             n_bootstrap_iters=1000, n_resamples=20, 
-                            n_intervals_interp=3, min_cfgs_above=2, min_nframes_above=10):
+                            n_intervals_interp=3, min_cfgs_above=2, min_nframes_above=10,
+                            boot_arrays=True, warm_start=False):
     '''
     Inputs
         roi_df (pd.DataFrame) 
@@ -534,6 +621,11 @@ def bootstrap_roi_responses_by_config(roi_df, sdf=None, statdf=None, response_ty
             Number of stimulus configs that should pass the "responsive" threshold for cell to count as responsive
         min_nframes_above (int)
             Min num frames (from statdf) that counts as a cell to be reposnsive for a given stimulus config
+        boot_arrays (bool)
+            Draw all resamples as one index array and fit all iterations with fit_ori_tuning_batch() (default).
+            Set False to resample/fit with pandas, per iteration.
+        warm_start (bool)
+            If boot_arrays, start each iteration's fit from the previous iteration's fit params.
             
     Returns
         List of dicts from mp for each roi's results
@@ -581,22 +673,32 @@ def bootstrap_roi_responses_by_config(roi_df, sdf=None, statdf=None, response_ty
         datadict = {'responses': responses_df, 'tested_values': tested_oris}
         
         # Bootstrap distN of responses (rand w replacement):
-        bootdf_tmp = pd.concat([responses_df.sample(n_resamples, replace=True).mean(axis=0) \
-                                for ni in range(n_bootstrap_iters)], axis=1)
+        if boot_arrays:
+            # All resampled trial indices at once (n_bootstrap_iters x n_resamples), gather + mean:
+            response_arr = responses_df.values
+            boot_ixs = np.random.randint(0, response_arr.shape[0], size=(n_bootstrap_iters, n_resamples))
+            bootdf_tmp = pd.DataFrame(np.nanmean(response_arr[boot_ixs], axis=1).T, index=responses_df.columns)
+        else:
+            bootdf_tmp = pd.concat([responses_df.sample(n_resamples, replace=True).mean(axis=0) \
+                                    for ni in range(n_bootstrap_iters)], axis=1)
         bootdf_tmp.index = [sdf['ori'][c] for c in bootdf_tmp.index]
         #bootdf = np.abs((bootdf_tmp - bootdf_tmp.mean())) 
         bootdf = (bootdf_tmp-bootdf_tmp.min()) #- (bootdf_tmp-bootdf_tmp.mean()).min()
 
         # Find init params for tuning fits and set fit constraints:
-        fitp = bootdf.apply(fit_ori_tuning, args=[n_intervals_interp], axis=0) # Get fit params
+        if boot_arrays:
+            fitp, fitv, yvs = fit_ori_tuning_batch(bootdf, n_intervals_interp=n_intervals_interp, warm_start=warm_start)
+        else:
+            fitp = bootdf.apply(fit_ori_tuning, args=[n_intervals_interp], axis=0) # Get fit params
         if fitp.dropna().shape[0] == 0:
             fitdict = None
             fitp = None
         else:
-            # Get fits
-            fitv = fitp.apply(fit_from_params, args=[tested_oris], axis=0)
-            # Interpolate boot responses 
-            yvs = bootdf.apply(interp_values, args=[n_intervals_interp, True], axis=0, reduce=True)
+            if not boot_arrays:
+                # Get fits
+                fitv = fitp.apply(fit_from_params, args=[tested_oris], axis=0)
+                # Interpolate boot responses 
+                yvs = bootdf.apply(interp_values, args=[n_intervals_interp, True], axis=0, reduce=True)
             xvs = interp_values(tested_oris, n_intervals=n_intervals_interp, wrap_value=360)
             fitdict = {'xv': xvs, 'yv': yvs, 'fitv': fitv, 'n_intervals_interp': n_intervals_interp} 
             # Create dataframe of all fit params
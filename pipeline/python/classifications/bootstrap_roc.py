@@ -26,41 +26,88 @@ import pylab as pl
 import seaborn as sns
 import multiprocessing as mp
 
-from sklearn.utils import shuffle
 
 #from pipeline.python.classifications import experiment_classes as util #utils as util
 from pipeline.python.classifications import test_responsivity as resp
 from pipeline.python.utils import label_figure, natural_keys
 
-def get_hits_and_fas(resp_stim, resp_bas, n_crit=50):
+def get_condition_ixs(resp_list):
+    '''
+    (start, end) index of each condition's trials, once all conditions are concatenated.
+    '''
+    ends = np.cumsum([len(r) for r in resp_list])
+    return list(zip(np.r_[0, ends[0:-1]], ends))
+
+def count_above_crit(values, crit_vals, ixs):
+    '''
+    Count values > each criterion, within each condition.
+    values (n_sets x n_values), crit_vals (n_sets x n_crit, evenly spaced and increasing), ixs (start, end) of each condition.
+
+    Each value is assigned the N criteria below it (as np.searchsorted), estimated from the spacing of crit_vals
+    and corrected at bin edges, so there is no (n_values x n_crit) comparison.
+    Returns (n_sets, n_conditions, n_crit) counts.
+    '''
+    n_sets, n_values = values.shape
+    n_crit = crit_vals.shape[1]
+    n_conditions = len(ixs)
+    rows = np.arange(0, n_sets)[:, np.newaxis]
+
+    min_vals = crit_vals[:, 0:1]
+    crit_range = crit_vals[:, -1:] - min_vals
+    with np.errstate(divide='ignore', invalid='ignore'):
+        nbelow = np.floor((values - min_vals) / crit_range * (n_crit - 1)) + 1
+    nbelow = np.clip(np.nan_to_num(nbelow), 0, n_crit).astype(int)
+    nbelow[(nbelow > 0) & (crit_vals[rows, np.maximum(nbelow-1, 0)] >= values)] -= 1
+    nbelow[(nbelow < n_crit) & (crit_vals[rows, np.minimum(nbelow, n_crit-1)] < values)] += 1
+
+    # Histogram of N crit below each value per set and condition --> N values above each crit
+    cond_ids = np.hstack([np.ones(ei-si, dtype=int)*ci for ci, (si, ei) in enumerate(ixs)])
+    bins = ((rows * n_conditions + cond_ids[np.newaxis, :]) * (n_crit + 1) + nbelow).ravel()
+    counts = np.bincount(bins, minlength=n_sets*n_conditions*(n_crit+1)).reshape((n_sets, n_conditions, n_crit+1))
+
+    return counts[:, :, ::-1].cumsum(axis=-1)[:, :, ::-1][:, :, 1:]
+
+def get_hits_and_fas_batch(stim_values, bas_values, stim_ixs, bas_ixs=None, n_crit=50):
+    '''
+    Batched version of get_hits_and_fas().
+    Each row of stim_values and bas_values is one set of responses (e.g., one shuffle), with
+    all conditions concatenated. stim_ixs and bas_ixs are (start, end) of each condition (see get_condition_ixs()).
+
+    Returns:
+        p_hits, p_fas : (n_sets, n_conditions, n_crit) arrays of p(resp > crit)
+        crit_vals     : (n_sets, n_crit) array of criterion values, spanning min/max of each set's stim responses
+    '''
+    if bas_ixs is None:
+        bas_ixs = stim_ixs
+    stim_values = np.atleast_2d(stim_values)
+    bas_values = np.atleast_2d(bas_values)
+
+    # Set criterion (range between min/max response), same spacing as np.linspace():
+    min_vals = stim_values.min(axis=1)
+    max_vals = stim_values.max(axis=1)
+    step = (max_vals - min_vals) / float(n_crit - 1)
+    crit_vals = min_vals[:, np.newaxis] + np.arange(0, n_crit)[np.newaxis, :] * step[:, np.newaxis]
+    crit_vals[:, -1] = max_vals
+
+    # For each crit level, calculate p > crit (out of N trials):
+    p_hits = count_above_crit(stim_values, crit_vals, stim_ixs) \
+                / np.array([float(ei-si) for si, ei in stim_ixs])[np.newaxis, :, np.newaxis]
+    p_fas = count_above_crit(bas_values, crit_vals, bas_ixs) \
+                / np.array([float(ei-si) for si, ei in bas_ixs])[np.newaxis, :, np.newaxis]
 
-    # Get N configurations    
-    #curr_cfg_ixs = np.arange(0, len(resp_stim))
-    
-    # Get N conditions
-    #n_conditions, n_trials = resp_stim.shape
-    n_conditions = len(resp_stim) #curr_cfg_ixs)
- 
-    # Set criterion (range between min/max response)
-    min_val = min(list(itertools.chain(*resp_stim))) #resp_stim.min()
-    max_val = max(list(itertools.chain(*resp_stim))) #[r.max() for r in resp_stim]) #resp_stim.max() 
-    crit_vals = np.linspace(min_val, max_val, n_crit)
-   
-    # For each crit level, calculate p > crit (out of N trials)   
-    #p_hits = np.empty((n_conditions, len(crit_vals)))
-    #p_fas = np.empty((n_conditions, len(crit_vals)))
-    p_hits = np.array([[sum(rs > crit)/float(len(rs)) for crit in crit_vals] for rs in resp_stim])
-    p_fas = np.array([[sum(rs > crit)/float(len(rs)) for crit in crit_vals] for rs in resp_bas])
-    #print(n_conditions, len(crit_vals), p_hits.shape)
-#    for ci in np.arange(0, n_conditions):
-#        n_trials = float(len(resp_stim[ci]))
-#        p_hits = np.array([float(sum(rs > crit))/float(len(rs)) for crit in crit_vals] for rs in resp_stim])
-#        p_fas = [float(sum(resp_bas[ci] > crit)) / n_trials for crit in crit_vals]
-#        p_hits[ci, :] = p_hit
-#        p_fas[ci, :] = p_fa
-#        
     return p_hits, p_fas, crit_vals
 
+def get_hits_and_fas(resp_stim, resp_bas, n_crit=50):
+    '''
+    resp_stim, resp_bas : list of arrays, responses of each condition (stim period and baseline, respectively)
+
+    Returns p_hits, p_fas (n_conditions x n_crit) and crit_vals (n_crit,)
+    '''
+    p_hits, p_fas, crit_vals = get_hits_and_fas_batch(np.hstack(resp_stim), np.hstack(resp_bas),
+                                                      get_condition_ixs(resp_stim), bas_ixs=get_condition_ixs(resp_bas),
+                                                      n_crit=n_crit)
+        
+    return p_hits[0], p_fas[0], crit_vals[0]
 
 #def get_hits_and_fas(resp_stim, resp_bas):
 #
@@ -125,7 +172,7 @@ def load_experiment_data(experiment_name, animalid, session, fov, traceid,
 
     return exp, gdf        
 
-def calculate_roc_bootstrap(roi_df, n_iters=1000, dst_dir='/tmp', create_new=False):
+def calculate_roc_bootstrap(roi_df, n_iters=1000, dst_dir='/tmp', create_new=False, n_crit=50):
 
     rid = int(roi_df['cell'].unique())
     out_fn = os.path.join(dst_dir, 'results', 'roc_%03d.pkl' % int(rid+1))
@@ -149,41 +196,29 @@ def calculate_roc_bootstrap(roi_df, n_iters=1000, dst_dir='/tmp', create_new=Fal
     # Generate ROC curve 
     #n_conditions, n_trials = resp_stim.shape
     n_conditions = len(resp_stim)
-    p_hits, p_fas, crit_vals = get_hits_and_fas(resp_stim, resp_bas)
-    true_auc = []
-    for ci in range(n_conditions):
-        true_auc.append(-np.trapz(p_hits[ci, :], x=p_fas[ci, :]))
+    p_hits, p_fas, crit_vals = get_hits_and_fas(resp_stim, resp_bas, n_crit=n_crit)
+    true_auc = list(-np.trapz(p_hits, x=p_fas, axis=-1))
     max_true_auc = np.max(true_auc)
     
     #### Shuffle
-    all_values = np.hstack([list(itertools.chain(*resp_stim)), list(itertools.chain(*resp_bas))])
-    #all_values = np.vstack([resp_stim, resp_bas])
-    #print(all_values.shape)
-
-    # Shuffle values, group into stim and bas again
-    ixs = [(ri,rs.shape[0]) if ri==0 else
-           (sum([r.shape[0] for r in resp_stim[0:ri]]), sum([r.shape[0] for r in resp_stim[0:ri]])+rs.shape[0]) \
-                for ri, rs in enumerate(resp_stim)]
+    all_values = np.hstack([np.hstack(resp_stim), np.hstack(resp_bas)])
+
+    # Shuffle values, group into stim and bas again (same N trials per condition for stim and bas)
+    ixs = get_condition_ixs(resp_stim)
     last_ix = ixs[-1][1]
-    ixs2 = [(si+last_ix, ei+last_ix) for (si, ei) in ixs]
-    t1 =[all_values[si:ei] for (si, ei) in ixs]
-    t2 =[all_values[si:ei] for (si, ei) in ixs2]
-    assert all([len(s1)==len(b1) for s1, b1 in zip(t1, t2)]), "bad shuffle indices..."
+    assert len(all_values) == 2*last_ix, "bad shuffle indices..."
 
+    # Do shuffles in batches (n_shuffles x n_values)
+    n_values = len(all_values)
+    batch_size = max(1, min(n_iters, int(1E7 / n_values)))
     shuff_auc = []
-    #print("... getting shuffle")
-    for i in range(n_iters):
-        #if i%20==0:
-        #    print('%i of %i' % ((i+1), n_iters))
-        X = shuffle(all_values) #.ravel())
-        #X = np.reshape(X, (n_conditions*2, n_trials))
-        #shuff_stim = X[0:n_conditions, :]
-        #shuff_bas = X[n_conditions:, :]
-        shuff_stim = [X[si:ei] for (si, ei) in ixs]
-        shuff_bas = [X[si:ei] for (si, ei) in ixs2]
-        shuff_p_hits, shuff_p_fas, shuff_crit_vals = get_hits_and_fas(shuff_stim, shuff_bas)
-        shuff_auc.append(np.max([-np.trapz(shuff_p_hits[ci, :], x=shuff_p_fas[ci, :]) \
-                    for ci in range(n_conditions)]))
+    for i in range(0, n_iters, batch_size):
+        n_curr = min(batch_size, n_iters - i)
+        X = all_values[np.random.rand(n_curr, n_values).argsort(axis=1)]
+        shuff_p_hits, shuff_p_fas, shuff_crit_vals = get_hits_and_fas_batch(X[:, 0:last_ix], X[:, last_ix:], ixs,
+                                                                            n_crit=n_crit)
+        shuff_auc.append(np.max(-np.trapz(shuff_p_hits, x=shuff_p_fas, axis=-1), axis=1))
+    shuff_auc = np.hstack(shuff_auc)
 
     pval = sum(shuff_auc >= max_true_auc)/ float(len(shuff_auc))
 
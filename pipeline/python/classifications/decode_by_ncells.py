@@ -260,7 +260,7 @@ def decode_by_ncells(n_cells, visual_area, CELLS, NEURALDATA, sdf=None,
                     n_iterations=50, n_processes=2, 
                     class_name='morphlevel', class_a=0, class_b=106, match_all_configs=True,
                     do_shuffle=True, test_type=None, n_train_configs=4, 
-                    verbose=False, with_replacement=False,
+                    verbose=False, with_replacement=False, reuse_C=True,
                     dst_dir='/n/coxfs01/julianarhee/aggregate-visual-areas/decoding/by_ncells'):
     '''
     Create psuedo-population by sampling n_cells from global_rois.
@@ -294,7 +294,7 @@ def decode_by_ncells(n_cells, visual_area, CELLS, NEURALDATA, sdf=None,
                         C_value=C_value, cv_nfolds=cv_nfolds, test_split=test_split, 
                         test_type=test_type, n_train_configs=n_train_configs, verbose=verbose, within_fov=True,
                         class_name=class_name, class_a=class_a, class_b=class_b, do_shuffle=do_shuffle, 
-                        match_all_configs=True, with_replacement=with_replacement)
+                        match_all_configs=True, with_replacement=with_replacement, reuse_C=reuse_C)
                         #feature_name=feature_name, n_cuts=n_cuts, 
                         #equalize_by=equalize_by, match_all_configs=match_all_configs)
     except Exception as e:
@@ -924,6 +924,8 @@ def extract_options(options):
             default=None, help="tune for C (default: None, tunes C)")
     parser.add_option('--folds', action='store', dest='cv_nfolds', 
             default=5, help="N folds for CV tuning C (default: 5")
+    parser.add_option('--tune-shuffled', action='store_false', dest='reuse_C', 
+            default=True, help="Re-tune C for shuffled-label fits (default: reuse C tuned on true-label train split)")
 
 
 
@@ -1019,6 +1021,7 @@ def main(options):
  
     C_value = None if opts.C_value in ['None', None] else float(opts.C_value)
     do_cv = C_value in ['None', None]
+    reuse_C = opts.reuse_C
     print("Do CV -%s- (C=%s)" % (str(do_cv), str(C_value)))
 
     # Dataset filtering --------------------------------
@@ -1395,7 +1398,8 @@ def main(options):
                                 n_iterations=n_iterations, n_processes=n_processes, 
                                 class_a=class_a, class_b=class_b, dst_dir=dst_dir, verbose=verbose, 
                                 match_all_configs=match_all_configs, with_replacement=with_replacement,
-                                do_shuffle=do_shuffle, test_type=test_type, n_train_configs=n_train_configs) 
+                                do_shuffle=do_shuffle, test_type=test_type, n_train_configs=n_train_configs,
+                                reuse_C=reuse_C) 
                 print("***** finished %s, ncells=%i *******" % (curr_visual_area, curr_ncells))
             else:
                 # ----------------------------------------------
@@ -1415,7 +1419,8 @@ def main(options):
                                     n_iterations=n_iterations, n_processes=n_processes, 
                                     class_a=class_a, class_b=class_b, do_shuffle=do_shuffle,
                                     dst_dir=dst_dir, verbose=verbose, 
-                                    match_all_configs=match_all_configs, with_replacement=with_replacement)
+                                    match_all_configs=match_all_configs, with_replacement=with_replacement,
+                                    reuse_C=reuse_C)
                 print("********* finished %s, (ncells looped: %s) **********" % (curr_visual_area, str(NCELLS)))
         else:
             # ----------------------------------------------
@@ -1453,7 +1458,7 @@ def main(options):
                                         class_a=class_a, class_b=class_b,
                                         dst_dir=dst_dir, create_new=create_new, 
                                         verbose=verbose, match_all_configs=match_all_configs, 
-                                        with_replacement=with_replacement)
+                                        with_replacement=with_replacement, reuse_C=reuse_C)
                     print("********* finished **********")
             except Exception as e:
                 traceback.print_exc()
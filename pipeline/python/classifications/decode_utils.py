@@ -313,10 +313,54 @@ def initializer(terminating_):
     global terminating
     terminating = terminating_
 
+def neuraldf_to_shared(neuraldf):
+    '''
+    Copy the trial x cell matrix of neuraldf (all cols but 'config') into shared memory, once.
+    Returns shared array (mp.RawArray) and the info needed to rebuild neuraldf in workers (get_shared_neuraldf()).
+    '''
+    cell_cols = [c for c in neuraldf.columns if c!='config']
+    cell_data = neuraldf[cell_cols].values.astype(float)
+    shared_data = mp.RawArray('d', cell_data.size)
+    np.frombuffer(shared_data, dtype=float)[:] = cell_data.ravel()
+    shared_info = {'shape': cell_data.shape, 'columns': cell_cols, 
+                   'index': neuraldf.index.tolist(), 'config': neuraldf['config'].values}
+
+    return shared_data, shared_info
+
+def init_decode_worker(terminating_, shared_data_, decode_args_):
+    # As initializer(), and places the shared trial x cell matrix + fit args in the worker's global namespace,
+    # so that the data are sent to each worker once (not pickled with each task).
+    global terminating, shared_data, decode_args
+    terminating = terminating_
+    shared_data = shared_data_
+    decode_args = decode_args_
+
+def get_shared_neuraldf():
+    # Rebuild neuraldf from shared matrix (no copy of the data)
+    shared_info = decode_args['shared_info']
+    cell_data = np.frombuffer(shared_data, dtype=float).reshape(shared_info['shape'])
+    neuraldf = pd.DataFrame(cell_data, columns=shared_info['columns'], index=shared_info['index'], copy=False)
+    neuraldf['config'] = shared_info['config']
+
+    return neuraldf
+
+def decode_worker(iter_num):
+    if terminating.is_set():
+        return None
+    neuraldf = get_shared_neuraldf()
+    fit_args = dict((k, v) for k, v in decode_args.items() if k not in ['shared_info', 'sdf'])
+    try:
+        curr_iter = run_select_test(iter_num, neuraldf, decode_args['sdf'], **fit_args)
+    except Exception as e:
+        # Send the traceback back to the parent (see pool_bootstrap())
+        return traceback.format_exc()
+
+    return curr_iter
+
 def pool_bootstrap(neuraldf, sdf, n_iterations=50, n_processes=1, 
                    C_value=None, cv_nfolds=5, test_split=0.2, 
                    test_type=None, n_train_configs=4, verbose=False, within_fov=True,
-                   class_a=0, class_b=106, do_shuffle=True, balance_configs=True):   
+                   class_a=0, class_b=106, do_shuffle=True, balance_configs=True, reuse_C=True):   
     '''
     This function replaces fit_svm_mp() -- includes opts for generalization test.
     Only tested for within-fov analyses (by_fov).
@@ -328,54 +372,38 @@ def pool_bootstrap(neuraldf, sdf, n_iterations=50, n_processes=1,
                 single=True to train/test on each size
         size  : Train on specific size(s), test on un-trained sizes
                 single=True to train/test on each size
+
+    The trial x cell matrix is placed in shared memory once (see init_decode_worker()).
+    Failed iterations are dropped; the traceback of the 1st failure is printed.
+
+    reuse_C (bool)
+        If C_value is None, C is tuned once per iteration on the true-label training split,
+        and reused for the shuffled-label fit of that iteration (same split). Set False to also 
+        re-tune C for the shuffled-label fit.
     '''
     iter_df = None
 
-    C=C_value
-    vb = verbose 
-    results = []
-    terminating = mp.Event()
+    shared_data, shared_info = neuraldf_to_shared(neuraldf)
+    decode_args = {'shared_info': shared_info, 'sdf': sdf, 'test_type': test_type,
+                   'C_value': C_value, 'cv_nfolds': cv_nfolds, 'test_split': test_split,
+                   'n_train_configs': n_train_configs, 'verbose': verbose, 
+                   'class_a': class_a, 'class_b': class_b, 
+                   'do_shuffle': do_shuffle, 'balance_configs': balance_configs, 'reuse_C': reuse_C}
 
-    pool = mp.Pool(initializer=initializer, initargs=(terminating, ), processes=n_processes)  
+    terminating = mp.Event()
+    pool = mp.Pool(initializer=init_decode_worker, initargs=(terminating, shared_data, decode_args), 
+                   processes=n_processes)  
     try:
         ntrials, sample_size = neuraldf.shape
         print("[%s]... n: %i (%i procs)" % (test_type, int(sample_size-1), n_processes))
-        if test_type=='morph':
-            func = partial(train_test_morph, curr_data=neuraldf, sdf=sdf, 
-                                verbose=verbose, C_value=C_value, test_split=test_split, cv_nfolds=cv_nfolds,
-                                class_a=class_a, class_b=class_b, balance_configs=balance_configs) 
-#                               MEANS=MEANS, sdf=sdf, sample_size=sample_size)
-        elif test_type=='morph_single':
-            func = partial(train_test_morph_single, curr_data=neuraldf, sdf=sdf, 
-                                verbose=verbose, C_value=C_value, test_split=test_split, cv_nfolds=cv_nfolds,
-                                class_a=class_a, class_b=class_b, balance_configs=balance_configs) 
-#
-#            if single: # train on 1 size, test on other sizes
-#                func = partial(dutils.do_fit_train_single_test_morph, global_rois=global_rois, 
-#                               MEANS=MEANS, sdf=sdf, sample_size=sample_size)
-#            else: # combine data across sizes
-#                func = partial(dutils.do_fit_train_test_morph, global_rois=global_rois, 
-#                               MEANS=MEANS, sdf=sdf, sample_size=sample_size)             
-        elif test_type=='size_single':
-            func = partial(train_test_size_single, curr_data=neuraldf, sdf=sdf,
-                                verbose=verbose, C_value=C_value, balance_configs=balance_configs) 
-#                func = partial(dutils.do_fit_train_test_single, global_rois=global_rois, 
-#                               MEANS=MEANS, sdf=sdf, sample_size=sample_size)
-        elif test_type=='size_subset':
-            func = partial(train_test_size_subset, curr_data=neuraldf, sdf=sdf,
-                                verbose=verbose, C_value=C_value, n_train_configs=n_train_configs,
-                                balance_configs=balance_configs) 
-#                func = partial(dutils.cycle_train_sets, global_rois=global_rois, 
-#                               MEANS=MEANS, sdf=sdf, sample_size=sample_size, 
-#                                n_train_configs=n_train_configs)
-        else:
-            func = partial(do_fit_within_fov, curr_data=neuraldf, sdf=sdf, verbose=verbose,
-                                C_value=C_value, balance_configs=balance_configs)
-        output = pool.map_async(func, range(n_iterations)).get() #999999)
-        #results = [pool.apply_async(do_fit_within_fov, args=(i, neuraldf, sdf, vb, C)) \
-        #            for i in range(n_iterations)]
-        #output= [p.get(99999999) for p in results]
-        iter_df = pd.concat(output, axis=0)
+        output = pool.map_async(decode_worker, range(n_iterations)).get() #999999)
+        errors = [o for o in output if isinstance(o, str)]
+        output = [o for o in output if o is not None and not isinstance(o, str)]
+        if len(errors) > 0:
+            print("... %i of %i iters failed, 1st error:" % (len(errors), n_iterations))
+            print(errors[0])
+        if len(output) > 0:
+            iter_df = pd.concat(output, axis=0)
  
     except KeyboardInterrupt:
         terminating.set()
@@ -397,7 +425,12 @@ def iterate_by_ncells(n_cells, NEURALDATA, CELLS, sdf, n_iterations=100, n_proce
                         test_type=None, n_train_configs=4, verbose=False, within_fov=False,
                         class_name='morphlevel', class_a=0, class_b=106, do_shuffle=True, balance_configs=True,
                         feature_name='pupil_fraction', n_cuts=3, equalize_by='config', match_all_configs=True,
-                        with_replacement=False):   
+                        with_replacement=False, reuse_C=True):   
+    '''
+    reuse_C (bool)
+        If C_value is None, C is tuned on the true-label training split of each iteration, 
+        and reused for the shuffled-label fit (see pool_bootstrap()).
+    '''
     #from pipeline.python.eyetracker import dlc_utils as dlcutils
     iterdf = None 
 
@@ -405,10 +438,13 @@ def iterate_by_ncells(n_cells, NEURALDATA, CELLS, sdf, n_iterations=100, n_proce
     train_labels = sdf[sdf[class_name].isin([class_a, class_b])][equalize_by].unique()
     common_labels = None if match_all_configs else train_labels
 
+    #### Index cells/trials once, for sampling
+    pop_index = get_population_index(NEURALDATA, CELLS)
+
     #### Define MP worker
     results = []
     terminating = mp.Event() 
-    def worker_by_ncells(out_q, n_iters, n_cells, NEURALDATA, CELLS, sdf, common_labels, test_type,
+    def worker_by_ncells(out_q, n_iters, n_cells, pop_index, CELLS, sdf, common_labels, test_type,
                     C_value=None, verbose=False, class_a=0, class_b=106, cv_nfolds=5, test_split=0.2):
         r_ = []        
         i_=[]
@@ -416,7 +452,7 @@ def iterate_by_ncells(n_cells, NEURALDATA, CELLS, sdf, n_iterations=100, n_proce
             randi = random.randint(1, 10000)
             #### Get new sample set
             print("... sampling data, n=%i cells" % n_cells)
-            neuraldf = sample_neuraldata(n_cells, CELLS, NEURALDATA, with_replacement=with_replacement,
+            neuraldf = sample_neuraldata(n_cells, CELLS, pop_index, with_replacement=with_replacement,
                                                     train_configs=common_labels, randi=randi)
             neuraldf = aggr.zscore_neuraldf(neuraldf)
             n_cells = int(neuraldf.shape[1]-1) 
@@ -429,7 +465,7 @@ def iterate_by_ncells(n_cells, NEURALDATA, CELLS, sdf, n_iterations=100, n_proce
                             C_value=C_value, class_a=class_a, class_b=class_b, 
                             cv_nfolds=cv_nfolds, test_split=test_split, 
                             verbose=verbose, do_shuffle=True, balance_configs=True,
-                            test_type=test_type, n_train_configs=n_train_configs)  
+                            test_type=test_type, n_train_configs=n_train_configs, reuse_C=reuse_C)  
             if i_df is None:
                 out_q.put(None)
                 raise ValueError("No results for current iter")
@@ -448,7 +484,7 @@ def iterate_by_ncells(n_cells, NEURALDATA, CELLS, sdf, n_iterations=100, n_proce
         for i in range(n_processes):
             p = mp.Process(target=worker_by_ncells,
                            args=(out_q, iter_list[chunksize * i:chunksize * (i + 1)],
-                                    n_cells, NEURALDATA, CELLS, sdf, common_labels, test_type))
+                                    n_cells, pop_index, CELLS, sdf, common_labels, test_type))
             procs.append(p)
             p.start() # start asynchronously
         # Collect all results into 1 results dict. We should know how many dicts to expect:
@@ -517,38 +553,52 @@ def select_test_return_clf(ni, neuraldf, sdf, C_value=None, cv_nfolds=5, test_sp
 
 
 
+def run_select_test(ni, neuraldf, sdf, C_value=None, cv_nfolds=5, test_split=0.2, 
+                   test_type=None, n_train_configs=4, verbose=False, within_fov=True,
+                   class_a=0, class_b=106, do_shuffle=True, balance_configs=True, reuse_C=True):   
+    '''
+    As select_test(), but errors are raised (not swallowed).
+    '''
+    if test_type=='size_subset':
+        curr_iter = train_test_size_subset(ni, curr_data=neuraldf, sdf=sdf, 
+                                        C_value=C_value, class_a=class_a, class_b=class_b, 
+                                        cv_nfolds=cv_nfolds, test_split=test_split, 
+                                        verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs,
+                                        n_train_configs=n_train_configs, reuse_C=reuse_C)
+    elif test_type=='size_single':
+        curr_iter = train_test_size_single(ni, curr_data=neuraldf, sdf=sdf, 
+                                        C_value=C_value, class_a=class_a, class_b=class_b, 
+                                        cv_nfolds=cv_nfolds, test_split=test_split, 
+                                        verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs, reuse_C=reuse_C) 
+    elif test_type=='morph_single':
+        curr_iter = train_test_morph_single(ni, curr_data=neuraldf, sdf=sdf, 
+                                        C_value=C_value, class_a=class_a, class_b=class_b, 
+                                        cv_nfolds=cv_nfolds, test_split=test_split, 
+                                        verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs, reuse_C=reuse_C) 
+    elif test_type=='morph':
+        curr_iter = train_test_morph(ni, curr_data=neuraldf, sdf=sdf, 
+                                        C_value=C_value, class_a=class_a, class_b=class_b, 
+                                        cv_nfolds=cv_nfolds, test_split=test_split, 
+                                        verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs, reuse_C=reuse_C)  
+    else: 
+        curr_iter = do_fit_within_fov(ni, curr_data=neuraldf, sdf=sdf, 
+                                        C_value=C_value, class_a=class_a, class_b=class_b, 
+                                        cv_nfolds=cv_nfolds, test_split=test_split, 
+                                        verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs, reuse_C=reuse_C)
+    curr_iter['iteration'] = ni 
+    return curr_iter
+
+
 def select_test(ni, neuraldf, sdf, C_value=None, cv_nfolds=5, test_split=0.2, 
                    test_type=None, n_train_configs=4, verbose=False, within_fov=True,
-                   class_a=0, class_b=106, do_shuffle=True, balance_configs=True):   
+                   class_a=0, class_b=106, do_shuffle=True, balance_configs=True, reuse_C=True):   
     curr_iter = None
     try:
-        if test_type=='size_subset':
-            curr_iter = train_test_size_subset(ni, curr_data=neuraldf, sdf=sdf, 
-                                            C_value=C_value, class_a=class_a, class_b=class_b, 
-                                            cv_nfolds=cv_nfolds, test_split=test_split, 
-                                            verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs,
-                                            n_train_configs=n_train_configs)
-        elif test_type=='size_single':
-            curr_iter = train_test_size_single(ni, curr_data=neuraldf, sdf=sdf, 
-                                            C_value=C_value, class_a=class_a, class_b=class_b, 
-                                            cv_nfolds=cv_nfolds, test_split=test_split, 
-                                            verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs) 
-        elif test_type=='morph_single':
-            curr_iter = train_test_morph_single(ni, curr_data=neuraldf, sdf=sdf, 
-                                            C_value=C_value, class_a=class_a, class_b=class_b, 
-                                            cv_nfolds=cv_nfolds, test_split=test_split, 
-                                            verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs) 
-        elif test_type=='morph':
-            curr_iter = train_test_morph(ni, curr_data=neuraldf, sdf=sdf, 
-                                            C_value=C_value, class_a=class_a, class_b=class_b, 
-                                            cv_nfolds=cv_nfolds, test_split=test_split, 
-                                            verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs)  
-        else: 
-            curr_iter = do_fit_within_fov(ni, curr_data=neuraldf, sdf=sdf, 
-                                            C_value=C_value, class_a=class_a, class_b=class_b, 
-                                            cv_nfolds=cv_nfolds, test_split=test_split, 
-                                            verbose=verbose, do_shuffle=do_shuffle, balance_configs=balance_configs)
-        curr_iter['iteration'] = ni 
+        curr_iter = run_select_test(ni, neuraldf, sdf, C_value=C_value, cv_nfolds=cv_nfolds, 
+                                    test_split=test_split, test_type=test_type, 
+                                    n_train_configs=n_train_configs, verbose=verbose, 
+                                    class_a=class_a, class_b=class_b, do_shuffle=do_shuffle, 
+                                    balance_configs=balance_configs, reuse_C=reuse_C)
     except Exception as e:
         return None
 
@@ -1170,9 +1220,103 @@ def get_trials_for_N_cells_df(curr_ncells, gdf, NEURALDATA, with_replacement=Fal
     
     return df
 
+def get_population_index(NEURALDATA, CELLS):
+    '''
+    Array-backed index of NEURALDATA for drawing pseudo-populations by integer indexing
+    (same sampling as get_trials_for_N_cells_df(), see sample_population_index()).
+    Built once, instead of filtering NEURALDATA on every draw.
+
+    NEURALDATA: long-form dataframe (datakey, cell, config, trial, response) or dict (as aggr.neuraldf_dict_to_dataframe())
+    CELLS: cells to sample from (roi, datakey, dset_roi)
+
+    Returns dict:
+        'datakeys'  : datakeys with sampled cells 
+        'configs'   : configs (sorted), same for all datakeys
+        'responses' : per datakey, (nconfigs x max_ntrials x ncells) response tensor, NaN-padded
+        'trials'    : per datakey, (nconfigs x max_ntrials) trial numbers (-1 if padded)
+        'ntrials'   : per datakey, (nconfigs,) n trials per config
+        'roi', 'dkey_ix', 'cell_ix' : (ncells_total,) global roi id, datakey index and tensor column of each row of CELLS
+    '''
+    if isinstance(NEURALDATA, dict):
+        NEURALDATA = aggr.neuraldf_dict_to_dataframe(NEURALDATA)
+
+    datakeys = sorted(CELLS['datakey'].unique())
+    configs = sorted(NEURALDATA[NEURALDATA['datakey'].isin(datakeys)]['config'].unique())
+    pop_index = {'datakeys': datakeys, 'configs': configs, 'responses': [], 'trials': [], 'ntrials': []}
+    cell_lut = {}
+    for di, (datakey, currd) in enumerate(NEURALDATA[NEURALDATA['datakey'].isin(datakeys)].groupby('datakey')):
+        assert sorted(currd['config'].unique())==configs, "ERROR: %s, missing configs" % datakey
+        cells = np.array(sorted(currd['cell'].astype(float).unique()))
+        trialdf = currd[['config', 'trial']].drop_duplicates().sort_values(by=['config', 'trial'])
+        trialdf['trial_ix'] = trialdf.groupby('config').cumcount().values
+        trialdf['config_ix'] = np.searchsorted(configs, trialdf['config'].values)
+        currd = currd.merge(trialdf, on=['config', 'trial'], how='left')
+
+        ntrials = trialdf.groupby('config_ix').size().values
+        responses = np.empty((len(configs), ntrials.max(), len(cells)))
+        responses.fill(np.nan)
+        responses[currd['config_ix'].values, currd['trial_ix'].values, 
+                  np.searchsorted(cells, currd['cell'].astype(float).values)] = currd['response'].values
+        trials = -1*np.ones((len(configs), ntrials.max()), dtype=int)
+        trials[trialdf['config_ix'].values, trialdf['trial_ix'].values] = trialdf['trial'].values
+
+        pop_index['responses'].append(responses)
+        pop_index['trials'].append(trials)
+        pop_index['ntrials'].append(ntrials)
+        cell_lut.update(dict(((datakey, c), (di, ci)) for ci, c in enumerate(cells)))
+
+    cell_ixs = np.array([cell_lut[(dk, float(rid))] for dk, rid in CELLS[['datakey', 'dset_roi']].values])
+    pop_index.update({'roi': CELLS['roi'].values.copy(), 'dkey_ix': cell_ixs[:, 0], 'cell_ix': cell_ixs[:, 1]})
+
+    return pop_index
+
+def sample_population_index(curr_ncells, pop_index, with_replacement=False, train_configs=None, randi=None):
+    '''
+    Draw curr_ncells cells (w/ randi, as CELLS.sample()) from pop_index (get_population_index()), 
+    and for each cell, draw the same N trials per config (min N over sampled datakeys), without replacement.
+    As in get_trials_for_N_cells_df(), trials are drawn independently for each cell (repeated cells, if
+    with_replacement, have the same trials).
+
+    Returns dataframe (nconfigs*ntrials x curr_ncells), columns are global roi ids + 'config'
+    '''
+    rs = np.random if randi is None else np.random.RandomState(randi)
+    sample_ixs = rs.choice(len(pop_index['roi']), size=curr_ncells, replace=with_replacement)
+    # Draw trials for each unique cell (repeats share trials)
+    sampled_cells, cell_order = np.unique(sample_ixs, return_inverse=True)
+    dkey_ixs = pop_index['dkey_ix'][sampled_cells]
+    curr_dkeys = np.unique(dkey_ixs)
+
+    # Make sure equal num trials per condition for all dsets
+    configs = pop_index['configs']
+    config_ixs = np.arange(0, len(configs)) if train_configs is None \
+                    else np.where(np.in1d(configs, train_configs))[0]
+    min_ntrials_by_config = min([pop_index['ntrials'][di][config_ixs].min() for di in curr_dkeys])
+    print("Min samples per config: %i" % min_ntrials_by_config)
+
+    sampled_data = np.empty((len(configs), min_ntrials_by_config, len(sampled_cells)))
+    for di in curr_dkeys:
+        curr_cells = np.where(dkey_ixs==di)[0]
+        ntrials = pop_index['ntrials'][di]
+        if ntrials.min() < min_ntrials_by_config:
+            raise ValueError("%s: <%i trials for some configs" % (pop_index['datakeys'][di], min_ntrials_by_config))
+        # Random trial order per config and cell (padded trials last), keep first N
+        rand_order = np.random.random((len(configs), ntrials.max(), len(curr_cells)))
+        rand_order[np.arange(0, ntrials.max())[np.newaxis, :] >= ntrials[:, np.newaxis]] = np.inf
+        trial_ixs = np.argsort(rand_order, axis=1)[:, 0:min_ntrials_by_config, :]
+        curr_responses = pop_index['responses'][di][:, :, pop_index['cell_ix'][sampled_cells[curr_cells]]]
+        sampled_data[:, :, curr_cells] = np.take_along_axis(curr_responses, trial_ixs, axis=1)
+
+    curr_neuraldf = pd.DataFrame(sampled_data.reshape((-1, len(sampled_cells)))[:, cell_order],
+                                 columns=pop_index['roi'][sample_ixs])
+    curr_neuraldf['config'] = np.repeat(configs, min_ntrials_by_config)
+
+    return curr_neuraldf
+
 # ======================================================================
 # Fitting functions 
 # ======================================================================
+C_grid = [0.001, 0.01, 0.1, 1, 10, 100, 1000]
+
 def tune_C(sample_data, target_labels, scoring_metric='accuracy', 
                         cv_nfolds=3, test_split=0.2, verbose=False, n_processes=1):
     
@@ -1186,15 +1330,17 @@ def tune_C(sample_data, target_labels, scoring_metric='accuracy',
     #test_data = scaler.transform(test_data)
 
     # Set the parameters by cross-validation
-    tuned_parameters = [{'C': [0.001, 0.01, 0.1, 1, 10, 100, 1000]}]
+    tuned_parameters = [{'C': C_grid}]
 
     results ={} 
     if verbose:
         print("# Tuning hyper-parameters for %s" % scoring_metric)
     #print()
-    clf = GridSearchCV(svm.SVC(kernel='linear'), tuned_parameters, 
+    # Linear kernel (same fits as kernel='linear'), computed once for all folds and C values
+    train_kernel = np.dot(train_data, train_data.T)
+    clf = GridSearchCV(svm.SVC(kernel='precomputed'), tuned_parameters, 
                             scoring=scoring_metric, cv=cv_nfolds, n_jobs=1) #n_processes)  
-    clf.fit(train_data, train_labels)
+    clf.fit(train_kernel, train_labels)
     if verbose:
         print("Best parameters set found on development set:")
         print(clf.best_params_)
@@ -1397,7 +1543,7 @@ def get_mutual_info_metrics(curr_test_labels, predicted_labels):
 # --------------------------------------------------------------------------------
 def do_fit_within_fov(iter_num, curr_data=None, sdf=None, verbose=False,
                     C_value=None, test_split=0.2, cv_nfolds=5, class_a=0, class_b=106,
-                    do_shuffle=True, balance_configs=True, return_clf=False):
+                    do_shuffle=True, balance_configs=True, return_clf=False, reuse_C=True):
 
     #[gdf, MEANS, sdf, sample_size, cv] * n_times)
     '''
@@ -1406,6 +1552,8 @@ def do_fit_within_fov(iter_num, curr_data=None, sdf=None, verbose=False,
     Classes (class_a, class_b) should be the labels of the target (i.e., value of morph level).
    
     do_shuffle (bool):  Runs fit_svm() twice, once reg and once with labels shuffled. 
+    reuse_C (bool):     Shuffled-label fit uses the C tuned for the true-label fit (same train split), 
+                        instead of re-tuning C. 
     '''   
     i_list=[]
     #### Select train/test configs for clf A vs B
@@ -1445,8 +1593,8 @@ def do_fit_within_fov(iter_num, curr_data=None, sdf=None, verbose=False,
 
     #### Shuffle labels
     if do_shuffle:
-        tmpdf_shuffled = fit_shuffled(zdata, targets, C_value=C_value, verbose=verbose,
-                                test_split=test_split, cv_nfolds=cv_nfolds, randi=randi)
+        tmpdf_shuffled = fit_shuffled(zdata, targets, C_value=curr_iter['C'] if reuse_C else C_value, 
+                                verbose=verbose, test_split=test_split, cv_nfolds=cv_nfolds, randi=randi)
         tmpdf_shuffled.index = [iter_num]   
         i_list.append(tmpdf_shuffled)
  
@@ -1473,6 +1621,11 @@ def sample_neuraldata(sample_size, global_rois, MEANS, with_replacement=False, t
 #                                        MEANS, train_configs=train_configs)
 #    else:
 #   
+    if isinstance(MEANS, dict) and 'responses' in MEANS.keys(): # from get_population_index()
+        curr_data = sample_population_index(sample_size, MEANS, train_configs=train_configs, 
+                                            with_replacement=with_replacement, randi=randi)
+        return curr_data
+
     if isinstance(MEANS, dict):
         MEANS = aggr.neuraldf_dict_to_dataframe(MEANS)
 
@@ -1595,7 +1748,7 @@ def fit_shuffled(zdata, targets, C_value=None, test_split=0.2, cv_nfolds=5, rand
 # ------
 def train_test_size_single(iter_num, curr_data=None, sdf=None, verbose=False,
                     C_value=None, test_split=0.2, cv_nfolds=5, class_a=0, class_b=106,
-                    do_shuffle=True, balance_configs=True):
+                    do_shuffle=True, balance_configs=True, reuse_C=True):
 
     #[gdf, MEANS, sdf, sample_size, cv] * n_times)
     '''
@@ -1657,8 +1810,8 @@ def train_test_size_single(iter_num, curr_data=None, sdf=None, verbose=False,
 
         #### Shuffle labels
         if do_shuffle:
-            tmpdf_shuffled = fit_shuffled(train_data, targets, C_value=C_value, verbose=verbose,
-                                    test_split=test_split, cv_nfolds=cv_nfolds, randi=randi, i=i)
+            tmpdf_shuffled = fit_shuffled(train_data, targets, C_value=iterdict['C'] if reuse_C else C_value, 
+                                    verbose=verbose, test_split=test_split, cv_nfolds=cv_nfolds, randi=randi, i=i)
             tmpdf_shuffled['train_transform'] = train_transform
             tmpdf_shuffled['test_transform'] = train_transform
             tmpdf_shuffled['n_trials'] = len(targets)
@@ -1712,7 +1865,7 @@ def train_test_size_single(iter_num, curr_data=None, sdf=None, verbose=False,
 
 def train_test_size_subset(iter_num, curr_data=None, sdf=None, verbose=False,
                     C_value=None, test_split=0.2, cv_nfolds=5, class_a=0, class_b=106,
-                    do_shuffle=True, n_train_configs=4, balance_configs=True):
+                    do_shuffle=True, n_train_configs=4, balance_configs=True, reuse_C=True):
 
     #[gdf, MEANS, sdf, sample_size, cv] * n_times)
     '''
@@ -1773,8 +1926,8 @@ def train_test_size_subset(iter_num, curr_data=None, sdf=None, verbose=False,
     
         #### Shuffle labels
         if do_shuffle:
-            tmpdf_shuffled = fit_shuffled(train_data, targets, C_value=C_value, verbose=verbose,
-                                    test_split=test_split, cv_nfolds=cv_nfolds, randi=randi, i=i)
+            tmpdf_shuffled = fit_shuffled(train_data, targets, C_value=iterdict['C'] if reuse_C else C_value, 
+                                    verbose=verbose, test_split=test_split, cv_nfolds=cv_nfolds, randi=randi, i=i)
             tmpdf_shuffled['train_transform'] = train_transform
             tmpdf_shuffled['test_transform'] = train_transform
             tmpdf_shuffled['n_trials'] = len(targets)
@@ -1970,7 +2123,7 @@ def get_pchoose(predicted_labels, true_labels, class_a=0, class_b=106):
 
 def train_test_morph(iter_num, curr_data=None, sdf=None, verbose=False,
                     C_value=None, test_split=0.2, cv_nfolds=5, class_a=0, class_b=106, midp=53,
-                    do_shuffle=True, balance_configs=True, 
+                    do_shuffle=True, balance_configs=True, reuse_C=True,
                     fit_psycho=True, P_model='weibull', par0=np.array([0.5, 0.5, 0.1]), nfits=20):
 
     #[gdf, MEANS, sdf, sample_size, cv] * n_times)
@@ -2043,7 +2196,7 @@ def train_test_morph(iter_num, curr_data=None, sdf=None, verbose=False,
  
     #### Shuffle labels
     if do_shuffle:
-        tmpdf_shuffled, shuffled_svc, shuffled_scaler = fit_shuffled(train_data, targets, C_value=C_value, 
+        tmpdf_shuffled, shuffled_svc, shuffled_scaler = fit_shuffled(train_data, targets, C_value=iterdict['C'] if reuse_C else C_value, 
                                                     verbose=verbose, test_split=test_split, 
                                                     cv_nfolds=cv_nfolds, randi=randi, do_pchoose=True, 
                                                     class_types=[class_a, class_b], class_name=class_name,
@@ -2154,7 +2307,7 @@ def train_test_morph(iter_num, curr_data=None, sdf=None, verbose=False,
 
 def train_test_morph_single(iter_num, curr_data=None, sdf=None, verbose=False,
                     C_value=None, test_split=0.2, cv_nfolds=5, class_a=0, class_b=106, midp=53,
-                    do_shuffle=True, balance_configs=True,
+                    do_shuffle=True, balance_configs=True, reuse_C=True,
                     fit_psycho=True, P_model='weibull', par0=np.array([0.5, 0.5, 0.1]), nfits=20):
 
     '''
@@ -2223,7 +2376,7 @@ def train_test_morph_single(iter_num, curr_data=None, sdf=None, verbose=False,
      
         #### Shuffle labels
         if do_shuffle:
-            tmpdf_shuffled, shuffled_svc, shuffled_scaler = fit_shuffled(train_data, targets, C_value=C_value, 
+            tmpdf_shuffled, shuffled_svc, shuffled_scaler = fit_shuffled(train_data, targets, C_value=iterdict['C'] if reuse_C else C_value, 
                                                     verbose=verbose, test_split=test_split, 
                                                     cv_nfolds=cv_nfolds, randi=randi, do_pchoose=True, 
                                                     class_types=[class_a, class_b], class_name=class_name,
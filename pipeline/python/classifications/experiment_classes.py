@@ -585,8 +585,7 @@ def calculate_nframes_above_nstds(animalid, session, fov, run=None, traceid='tra
         
         # Calculate N frames 
         print("... Traces: %s, Labels: %s" % (str(traces.shape), str(labels.shape)))
-        framesdf = pd.concat([resp.find_n_responsive_frames(traces[roi], labels, 
-                                n_stds=n_stds) for roi in range(ncells_total)], axis=1)
+        framesdf = resp.find_n_responsive_frames_all(traces[range(ncells_total)], labels, n_stds=n_stds)
         results = {'nframes_above': framesdf,
                    'nstds': n_stds}
         # Save    
@@ -23,6 +23,7 @@ import pandas as pd
 import importlib
 import scipy as sp
 import itertools
+import time
 
 
 # #########################
@@ -510,16 +511,15 @@ def group_fit_psignifit(auc_, opts, ni=0, sigmoid='gauss', normalize=True,
         return df_
 
 
-def do_split_pupil_fits(curr_visual_area, curr_datakey, param='morphlevel', 
-                    sigmoid='gauss', fit_experiment='2AFC', 
-                    max_auc=0.70, fit_new=False, by_iter=True,
-                    allow_negative=True, single_eff=False, normalize=True,
-                    traceid='traces001', responsive_test='ROC', responsive_thr=0.05,
-                    experiment='blobs', src_response_type='dff', 
-                    overlap_thr=None, trial_epoch='plushalf',
-                    anchors_=[0, 14, 92, 106],
-                    n_processes=1,  n_iterations=100):
+def load_split_pupil_aucs(curr_visual_area, curr_datakey, param='morphlevel', single_eff=False, 
+                    traceid='traces001', experiment='blobs', src_response_type='dff', 
+                    responsive_test='ROC', overlap_thr=None, trial_epoch='plushalf'):
+    '''
+    Load split_pupil AUCs (auc per iter, size, arousal state, shuffle cond) for 1 datakey.
+    If single_eff and no single-Eff file exists, assign Eff (best anchor object) per cell and save.
 
+    Returns auc_fov_iters, curr_decode_id, auc_outfile 
+    '''
     # Get split_arousal AUCs (auc per iter, size, arousal state, shuffle cond)      
     overlap_str = 'noRF' if overlap_thr is None else 'overlap%.2f' % overlap_thr 
     decode_id = decode_analysis_id(visual_area=curr_visual_area, 
@@ -537,8 +537,6 @@ def do_split_pupil_fits(curr_visual_area, curr_datakey, param='morphlevel',
 
     if param=='morphstep':
         single_eff=False
-        allow_negative=False
-        normalize=False
     
     # Get input aucs
     curr_decode_id = '__'.join(decode_id.split('__')[1:])
@@ -582,6 +580,28 @@ def do_split_pupil_fits(curr_visual_area, curr_datakey, param='morphlevel',
         with open(auc_outfile, 'wb') as f:
             pkl.dump(auc_fov_iters, f, protocol=2)
 
+    return auc_fov_iters, curr_decode_id, auc_outfile
+
+def do_split_pupil_fits(curr_visual_area, curr_datakey, param='morphlevel', 
+                    sigmoid='gauss', fit_experiment='2AFC', 
+                    max_auc=0.70, fit_new=False, by_iter=True,
+                    allow_negative=True, single_eff=False, normalize=True,
+                    traceid='traces001', responsive_test='ROC', responsive_thr=0.05,
+                    experiment='blobs', src_response_type='dff', 
+                    overlap_thr=None, trial_epoch='plushalf',
+                    anchors_=[0, 14, 92, 106],
+                    n_processes=1,  n_iterations=100):
+
+    if param=='morphstep':
+        single_eff=False
+        allow_negative=False
+        normalize=False
+
+    auc_fov_iters, curr_decode_id, auc_outfile = load_split_pupil_aucs(curr_visual_area, curr_datakey,
+                    param=param, single_eff=single_eff, traceid=traceid, experiment=experiment,
+                    src_response_type=src_response_type, responsive_test=responsive_test,
+                    overlap_thr=overlap_thr, trial_epoch=trial_epoch)
+
     # mean AUC over iters 
     group_cols = ['visual_area', 'datakey', 'cell', 'arousal', 'true_labels', param, 'size', 'Eff']
     auc_fov = auc_fov_iters.groupby(group_cols).mean().reset_index()
@@ -622,6 +642,341 @@ def do_split_pupil_fits(curr_visual_area, curr_datakey, param='morphlevel',
     return
 
 
+# SPLIT_PUPIL (Batched Weibull MLE fits, all curves at once).
+# -----------------------------------------------------------
+def weibull_batch(pars, xx, P_model='weibull'):
+    '''
+    Weibull functions (as decode_utils.weibull, weibull50, weibull_wh) for many curves at once.
+    pars: (ncurves x 3), xx: (ncurves x npoints)
+    '''
+    alpha, beta, c = [pars[:, i][:, np.newaxis] for i in range(3)]
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        expx = np.exp(-((xx / alpha)**beta))
+    if P_model=='weibull':
+        return (1 - c) - (1 - 2*c) * expx
+    elif P_model=='weibull50':
+        return (1 - c) - (.5 - c) * expx
+    elif P_model=='weibull_wh':
+        return c - (c - 0.5) * expx
+    else:
+        raise ValueError('invalid model, options are "weibull", "weibull50", "weibull_wh"')
+
+def neg_likelihood_batch(pars, data, P_model='weibull', parmin=None, parmax=None):
+    '''
+    Negative log-likelihood (as decode_utils.neg_likelihood) of each curve.
+    pars: (ncurves x 3)
+    data: (ncurves x 3 x npoints), stim levels, n trials, proportion (NaN for missing points) 
+    parmin, parmax: (ncurves x 3), params out of bounds give 1E7
+    Returns (ncurves,)
+    '''
+    xx, nn, pp = data[:, 0, :], data[:, 1, :], data[:, 2, :]
+    probs = weibull_batch(pars, xx, P_model=P_model)
+    probs[probs == 0] = np.finfo(float).eps
+    probs[probs == 1] = 1 - np.finfo(float).eps
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ll = nn * (pp * np.log(probs) + (1 - pp) * np.log(1 - probs))
+    l = -np.where(np.isfinite(pp), ll, 0).sum(axis=1)
+    l[~np.isfinite(l)] = 10000000
+    if parmin is not None:
+        l[(pars < parmin).any(axis=1)] = 10000000
+    if parmax is not None:
+        l[(pars > parmax).any(axis=1)] = 10000000
+
+    return l
+
+def fmin_batch(func, x0, xtol=1e-4, ftol=1e-4, maxiter=None, maxfun=None):
+    '''
+    Nelder-Mead simplex (as scipy.optimize.fmin) for many problems in 1 shared loop.
+    func(pars, ixs): values (n,) of problems ixs at pars (n x N). x0: (nproblems x N) starts.
+    Each problem stops updating once converged (xtol, ftol) or out of function calls.
+    Returns xopt (nproblems x N), fopt (nproblems,)
+    '''
+    nprob, N = x0.shape
+    maxiter = N*200 if maxiter is None else maxiter
+    maxfun = N*200 if maxfun is None else maxfun
+    rho, chi, psi, sigma = 1., 2., 0.5, 0.5
+    all_ixs = np.arange(0, nprob)
+
+    # Initial simplex
+    sim = np.repeat(np.asarray(x0, dtype=float)[:, np.newaxis, :], N+1, axis=1)
+    for k in range(N):
+        sim[:, k+1, k] = np.where(sim[:, k+1, k] != 0, 1.05*sim[:, k+1, k], 0.00025)
+    fsim = np.column_stack([func(sim[:, k, :], all_ixs) for k in range(N+1)])
+    fcalls = np.ones(nprob)*(N+1)
+
+    def sort_simplex(sim, fsim):
+        order = np.argsort(fsim, axis=1)
+        return np.take_along_axis(sim, order[:, :, np.newaxis], axis=1), np.take_along_axis(fsim, order, axis=1)
+    sim, fsim = sort_simplex(sim, fsim)
+
+    active = np.ones(nprob, dtype=bool)
+    for iteration in range(1, maxiter):
+        converged = (np.abs(sim[:, 1:, :] - sim[:, 0:1, :]).max(axis=(1, 2)) <= xtol) \
+                    & (np.abs(fsim[:, 0:1] - fsim[:, 1:]).max(axis=1) <= ftol)
+        active = active & ~converged & (fcalls < maxfun)
+        if not active.any():
+            break
+        ai = np.where(active)[0]
+        s, fs = sim[ai], fsim[ai]
+        xbar = s[:, 0:-1, :].mean(axis=1)
+        xlast = s[:, -1, :]
+
+        # Reflect, then expand / contract (outside, inside) / shrink, per problem
+        xr = (1 + rho)*xbar - rho*xlast
+        fxr = func(xr, ai)
+        xnew, fnew = xr.copy(), fxr.copy()
+        nevals = np.ones(len(ai))
+        expand = fxr < fs[:, 0]
+        contract_out = ~expand & (fxr >= fs[:, -2]) & (fxr < fs[:, -1])
+        contract_in = ~expand & (fxr >= fs[:, -1])
+        shrink = np.zeros(len(ai), dtype=bool)
+        if expand.any():
+            ei = np.where(expand)[0]
+            xe = (1 + rho*chi)*xbar[ei] - rho*chi*xlast[ei]
+            fxe = func(xe, ai[ei])
+            use_e = fxe < fxr[ei]
+            xnew[ei[use_e]], fnew[ei[use_e]] = xe[use_e], fxe[use_e]
+            nevals[ei] += 1
+        if contract_out.any():
+            ci = np.where(contract_out)[0]
+            xc = (1 + psi*rho)*xbar[ci] - psi*rho*xlast[ci]
+            fxc = func(xc, ai[ci])
+            use_c = fxc <= fxr[ci]
+            xnew[ci[use_c]], fnew[ci[use_c]] = xc[use_c], fxc[use_c]
+            shrink[ci[~use_c]] = True
+            nevals[ci] += 1
+        if contract_in.any():
+            ci = np.where(contract_in)[0]
+            xcc = (1 - psi)*xbar[ci] + psi*xlast[ci]
+            fxcc = func(xcc, ai[ci])
+            use_c = fxcc < fs[ci, -1]
+            xnew[ci[use_c]], fnew[ci[use_c]] = xcc[use_c], fxcc[use_c]
+            shrink[ci[~use_c]] = True
+            nevals[ci] += 1
+        s[~shrink, -1, :] = xnew[~shrink]
+        fs[~shrink, -1] = fnew[~shrink]
+        if shrink.any():
+            si = np.where(shrink)[0]
+            s[si, 1:, :] = s[si, 0:1, :] + sigma*(s[si, 1:, :] - s[si, 0:1, :])
+            fs[si, 1:] = np.column_stack([func(s[si, j, :], ai[si]) for j in range(1, N+1)])
+            nevals[si] += N
+        fcalls[ai] += nevals
+        sim[ai], fsim[ai] = sort_simplex(s, fs)
+
+    return sim[:, 0, :], fsim[:, 0]
+
+def init_weibull_pars(data, P_model='weibull', parmin=None, parmax=None):
+    '''
+    Analytic start for each curve: with the floor/ceiling set from the data, 
+    log(-log((top-p)/(top-bottom))) = beta*log(x) - beta*log(alpha), solved by weighted (n trials) linear regression.
+    Curves w/ <2 usable points start at [mean x, 1, c]. 
+    Returns (ncurves x 3), clipped to [parmin, parmax]
+    '''
+    xx, nn, pp = data[:, 0, :], data[:, 1, :], data[:, 2, :]
+    valid = np.isfinite(pp) & np.isfinite(xx)
+    pmin = np.where(valid, pp, np.inf).min(axis=1)
+    pmax = np.where(valid, pp, -np.inf).max(axis=1)
+    if P_model=='weibull':
+        c0 = np.clip(np.minimum(pmin, 1-pmax), parmin[:, 2], np.minimum(parmax[:, 2], 0.45))
+        top, bottom = 1-c0, c0
+    elif P_model=='weibull50':
+        c0 = np.clip(1-pmax, parmin[:, 2], np.minimum(parmax[:, 2], 0.45))
+        top, bottom = 1-c0, 0.5*np.ones(c0.shape)
+    else:
+        c0 = np.clip(pmax, np.maximum(parmin[:, 2], 0.55), parmax[:, 2])
+        top, bottom = c0, 0.5*np.ones(c0.shape)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = (top[:, np.newaxis] - pp) / (top - bottom)[:, np.newaxis]
+        use = valid & (xx > 0) & (nn > 0) & (q > 0) & (q < 1)
+        lx = np.where(use, np.log(np.where(use, xx, 1)), 0)
+        ly = np.where(use, np.log(-np.log(np.where(use, q, 0.5))), 0)
+        w = np.where(use, nn, 0)
+        sw = w.sum(axis=1)
+        mx = (w*lx).sum(axis=1) / sw
+        my = (w*ly).sum(axis=1) / sw
+        sxx = (w*(lx - mx[:, np.newaxis])**2).sum(axis=1)
+        sxy = (w*(lx - mx[:, np.newaxis])*(ly - my[:, np.newaxis])).sum(axis=1)
+        beta = sxy / sxx
+        alpha = np.exp(mx - my/beta)
+    bad = (use.sum(axis=1) < 2) | ~(beta > 0) | ~np.isfinite(alpha)
+    alpha[bad] = np.nanmean(np.where(valid, xx, np.nan), axis=1)[bad]
+    beta[bad] = 1.
+
+    parstart = np.column_stack([alpha, beta, c0])
+
+    return np.clip(parstart, parmin, parmax)
+
+def mle_weibull_batch(data, P_model='weibull', parstart=None, parmin=None, parmax=None, nfits=3):
+    '''
+    MLE fits (as decode_utils.mle_weibull) of many curves at once.
+    data: (ncurves x 3 x npoints), stim levels, n trials, proportion (NaN-padded)
+    Fit 1 starts at init_weibull_pars() (or parstart), fit 2 at mle_weibull's default start, 
+    others at random (within bounds). Best fit per curve is kept.
+
+    Returns pars (ncurves x 3), likelihoods (ncurves,)
+    '''
+    data = np.asarray(data, dtype=float)
+    if data.ndim==2:
+        data = data[np.newaxis, :, :]
+    ncurves = data.shape[0]
+    xx = np.where(np.isfinite(data[:, 0, :]), data[:, 0, :], np.nan)
+    if parmin is None:
+        parmin = np.column_stack([np.nanmin(xx, axis=1), np.zeros(ncurves), np.zeros(ncurves)])
+    if parmax is None:
+        parmax = np.column_stack([np.nanmax(xx, axis=1), 10.*np.ones(ncurves), .5*np.ones(ncurves)])
+    parmin = np.broadcast_to(np.asarray(parmin, dtype=float), (ncurves, 3))
+    parmax = np.broadcast_to(np.asarray(parmax, dtype=float), (ncurves, 3))
+
+    if parstart is None:
+        parstarts = [init_weibull_pars(data, P_model=P_model, parmin=parmin, parmax=parmax)]
+    else:
+        parstarts = [np.broadcast_to(np.asarray(parstart, dtype=float), (ncurves, 3))]
+    if nfits > 1:
+        parstarts.append(np.column_stack([np.nanmean(xx, axis=1), .5*np.ones(ncurves), .5*np.ones(ncurves)]))
+    for ifit in range(2, nfits):
+        parstarts.append(parmin + np.random.rand(ncurves, 3) * (parmax-parmin))
+
+    f = lambda pars, ixs: neg_likelihood_batch(pars, data[ixs], P_model=P_model, 
+                                               parmin=parmin[ixs], parmax=parmax[ixs])
+    pars = np.empty((len(parstarts), ncurves, 3))
+    likelihoods = np.empty((len(parstarts), ncurves))
+    for ifit, curr_start in enumerate(parstarts):
+        pars[ifit], fopt = fmin_batch(f, curr_start)
+        likelihoods[ifit] = -fopt
+
+    best_fit = likelihoods.argmax(axis=0)
+    
+    return pars[best_fit, np.arange(0, ncurves)], likelihoods[best_fit, np.arange(0, ncurves)]
+
+def weibull_data_from_aucs(auc_df, param='morphlevel', normalize=True, allow_negative=True,
+                curve_cols=['visual_area', 'datakey', 'cell', 'size', 'arousal', 'true_labels', 'Eff']):
+    '''
+    Stack AUC curves (1 per unique curve_cols) for mle_weibull_batch(), as data_matrix_from_auc():
+    stim level (/max if normalize), n trials, proportion chooseB (NaN-padded).
+    If allow_negative, curves w/ Eff=0 are fit on the reversed stim axis (as neg_ sigmoids).
+
+    Returns curvedf (curve_cols + 'reversed', 1 row per curve), data (ncurves x 3 x npoints)
+    '''
+    curve_cols = [c for c in curve_cols if c in auc_df.columns]
+    df = auc_df.sort_values(by=curve_cols + [param]).reset_index(drop=True)
+    df['n_chooseB'] = np.round(df['AUC'].values * df['n_trials'].values)
+    curve_groups = df.groupby(curve_cols, sort=False)
+    curve_ixs = curve_groups.ngroup().values
+    point_ixs = curve_groups.cumcount().values
+
+    xx = df[param].values.astype(float)
+    if normalize:
+        xx = xx / curve_groups[param].transform('max').values.astype(float)
+    reversed_ = (df['Eff'].values==0) if (allow_negative and 'Eff' in df.columns) else np.zeros(len(df), dtype=bool)
+    xx_min = pd.Series(xx).groupby(curve_ixs).transform('min').values
+    xx_max = pd.Series(xx).groupby(curve_ixs).transform('max').values
+    xx = np.where(reversed_, xx_max + xx_min - xx, xx)
+
+    data = np.empty((curve_ixs.max()+1, 3, point_ixs.max()+1))
+    data.fill(np.nan)
+    data[curve_ixs, 0, point_ixs] = xx
+    data[curve_ixs, 1, point_ixs] = df['n_trials'].values
+    data[curve_ixs, 2, point_ixs] = df['n_chooseB'].values / df['n_trials'].values.astype(float)
+
+    first_rows = np.unique(curve_ixs, return_index=True)[1]
+    curvedf = df.iloc[first_rows][curve_cols].reset_index(drop=True)
+    curvedf['reversed'] = reversed_[first_rows]
+
+    return curvedf, data
+
+def fit_weibull_curves(auc_df, param='morphlevel', normalize=True, allow_negative=True,
+                P_model='weibull', nfits=3,
+                curve_cols=['visual_area', 'datakey', 'cell', 'size', 'arousal', 'true_labels', 'Eff']):
+    '''
+    Fit Weibull (MLE) to all AUC curves in auc_df at once (see weibull_data_from_aucs(), mle_weibull_batch()).
+    thr: stim level at alpha (in original stim axis), slope: dP/dx at thr (negative if reversed)
+    '''
+    curvedf, data = weibull_data_from_aucs(auc_df, param=param, normalize=normalize, 
+                                allow_negative=allow_negative, curve_cols=curve_cols)
+    t_ = time.time()
+    pars, likelihoods = mle_weibull_batch(data, P_model=P_model, nfits=nfits)
+    print("... fit %i curves (%.2f sec)" % (data.shape[0], time.time()-t_))
+
+    alpha, beta, c = pars[:, 0], pars[:, 1], pars[:, 2]
+    if P_model=='weibull':
+        top, bottom = 1-c, c
+    elif P_model=='weibull50':
+        top, bottom = 1-c, 0.5
+    else:
+        top, bottom = c, 0.5
+    xx_min, xx_max = np.nanmin(data[:, 0, :], axis=1), np.nanmax(data[:, 0, :], axis=1)
+    rev = curvedf['reversed'].values
+
+    fitdf = curvedf.copy()
+    fitdf['alpha'] = alpha
+    fitdf['beta'] = beta
+    fitdf['lambda' if P_model=='weibull_wh' else 'gamma'] = c
+    fitdf['likelihood'] = likelihoods
+    fitdf['thr'] = np.where(rev, xx_max + xx_min - alpha, alpha)
+    fitdf['slope'] = np.where(rev, -1, 1) * (top - bottom) * np.exp(-1.) * beta / alpha
+
+    return fitdf
+
+def do_split_pupil_weibull_fits(datakeys=None, param='morphlevel', max_auc=0.70, 
+                    allow_negative=True, single_eff=False, normalize=True, P_model='weibull', nfits=3,
+                    traceid='traces001', responsive_test='ROC', responsive_thr=0.05,
+                    experiment='blobs', src_response_type='dff', 
+                    overlap_thr=None, trial_epoch='plushalf'):
+    '''
+    Weibull fits to mean split_pupil AUCs of all passing cells (as do_split_pupil_fits(), by_iter=False), 
+    for all datakeys in 1 batched fit (fit_weibull_curves()).
+    datakeys: list of (visual_area, datakey), or None for all in DATA.
+
+    Saves fits per datakey (<traceid_dir>/neurometric/split_pupil/fits/weibull[_reverse]), returns all fits.
+    '''
+    if param=='morphstep':
+        single_eff=False
+        allow_negative=False
+        normalize=False
+
+    if datakeys is None:
+        DATA, SDF, selective_df = get_data(traceid=traceid, 
+                        responsive_test=responsive_test, responsive_thr=responsive_thr)
+        datakeys = [tuple(k) for k in DATA[['visual_area', 'datakey']].drop_duplicates().values]
+
+    group_cols = ['visual_area', 'datakey', 'cell', 'arousal', 'true_labels', param, 'size', 'Eff']
+    a_=[]
+    dst_dirs = {}
+    for (va, dk) in datakeys:
+        try:
+            auc_fov_iters, curr_decode_id, auc_outfile = load_split_pupil_aucs(va, dk, 
+                        param=param, single_eff=single_eff, traceid=traceid, experiment=experiment,
+                        src_response_type=src_response_type, responsive_test=responsive_test,
+                        overlap_thr=overlap_thr, trial_epoch=trial_epoch)
+        except Exception as e:
+            traceback.print_exc()
+            continue
+        # mean AUC over iters 
+        auc_fov = auc_fov_iters.groupby(group_cols).mean().reset_index()
+        pass_cells = auc_fov[auc_fov['AUC']>=max_auc]['cell'].unique() 
+        print("[%s] %s: %i of %i cells pass (crit>=%.2f)" \
+                % (va, dk, len(pass_cells), len(auc_fov['cell'].unique()), max_auc))
+        a_.append(auc_fov[auc_fov['cell'].isin(pass_cells)])
+        dst_dirs[(va, dk)] = os.path.split(auc_outfile)[0]
+
+    fitdf = fit_weibull_curves(pd.concat(a_, axis=0), param=param, normalize=normalize,
+                        allow_negative=allow_negative, P_model=P_model, nfits=nfits)
+
+    # Save, per datakey
+    fit_dir = P_model if allow_negative else '%s_reverse' % P_model
+    for (va, dk), fitd in fitdf.groupby(['visual_area', 'datakey']):
+        curr_dst_dir = os.path.join(dst_dirs[(va, dk)], 'fits', fit_dir)
+        if not os.path.exists(curr_dst_dir):
+            os.makedirs(curr_dst_dir)
+        outfile = os.path.join(curr_dst_dir, '%s_meanAUC_%s.pkl' % (param, P_model))
+        with open(outfile, 'wb') as f:
+            pkl.dump(fitd, f, protocol=2)
+        print('... saved: %s' % outfile)
+
+    return fitdf
+
+
 
 
 
@@ -1337,6 +1692,9 @@ def extract_options(options):
     parser.add_option('--pupil', action='store_true', dest='split_pupil',
                       default=False, help='Fit curves from averaged AUC curves (over split_pupil iterations)')
 
+    parser.add_option('--weibull', action='store_true', dest='fit_weibull',
+                      default=False, help='[SPLIT_PUPIL]: Batched Weibull MLE fits to averaged AUC curves, all datakeys (or -k) at once')
+
     parser.add_option('--iter', action='store_true', dest='by_iter',
                       default=False, help='Fit curves to each iter (over split_pupil iterations)')
 
@@ -1406,7 +1764,15 @@ def main(options):
     else:
         normalize=param=='morphlevel'
         
-        if split_pupil:
+        if split_pupil and opts.fit_weibull:
+            datakeys = None if curr_datakey is None else [(curr_visual_area, curr_datakey)]
+            do_split_pupil_weibull_fits(datakeys, param=param, max_auc=max_auc, 
+                        allow_negative=allow_negative, single_eff=single_eff, normalize=normalize,
+                        traceid=traceid, experiment=experiment,
+                        responsive_test=responsive_test, responsive_thr=responsive_thr,
+                        src_response_type=src_response_type, 
+                        overlap_thr=overlap_thr, trial_epoch=trial_epoch)
+        elif split_pupil:
             do_split_pupil_fits(curr_visual_area, curr_datakey, param=param,sigmoid=sigmoid, 
                         fit_experiment=fit_experiment, allow_negative=allow_negative,
                         max_auc=max_auc, fit_new=fit_new, by_iter=by_iter,  
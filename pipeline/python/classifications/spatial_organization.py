@@ -32,7 +32,7 @@ from skimage import exposure
 from pipeline.python.rois.utils import load_roi_masks, get_roiid_from_traceid 
 from pipeline.python.retinotopy import convert_coords as cc
 from pipeline.python.classifications import experiment_classes as util
-from pipeline.python.utils import adjust_image_contrast, label_figure, natural_keys, get_pixel_size
+from pipeline.python.utils import adjust_image_contrast, label_figure, natural_keys, get_pixel_size, load_maskarray
 
 from pipeline.python.retinotopy import fit_2d_rfs as fitrf
 from pipeline.python.classifications import evaluate_receptivefield_fits as evalrf
@@ -146,7 +146,7 @@ def sort_rois_2D(traceid_dir):
     # Load masks and reshape to 2D:
     if ref_file not in maskfile.keys():
         ref_file = maskfile.keys()[0]
-    masks = np.array(maskfile[ref_file]['Slice01']['maskarray'])
+    masks = load_maskarray(maskfile[ref_file]['Slice01'], 'maskarray')
     dims = maskfile[ref_file]['Slice01']['zproj'].shape
     masks_r = np.reshape(masks, (dims[0], dims[1], masks.shape[-1]))
     print "Masks: (%i, %i), % rois." % (masks_r.shape[0], masks_r.shape[1], masks_r.shape[-1])
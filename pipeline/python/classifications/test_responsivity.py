@@ -351,6 +351,57 @@ def group_df_roidata_stimresponse(roidata, labels_df):
     
     return df_by_rois
 
+def build_trial_tensor(traces, labels):
+    '''
+    Reshape traces (frames x rois) into trials, using labels (1 row per frame, index = frame index in traces).
+
+    Returns
+        tensor (ntrials x nframes_per_trial x nrois), NaN-padded if trials have unequal N frames
+        trial_list (array of trial numbers, sorted as in labels.groupby(['trial']))
+        configs (array of config on each trial)
+    '''
+    trial_codes, trial_names = pd.factorize(labels['trial'], sort=True)
+    frame_ixs = labels.groupby(trial_codes).cumcount().values
+    nrois = traces.shape[1]
+
+    tensor = np.full((len(trial_names), frame_ixs.max()+1, nrois), np.nan)
+    tensor[trial_codes, frame_ixs, :] = traces.values[labels.index.values]
+
+    trial_list = np.array([int(trial[5:]) for trial in trial_names])
+    configs = labels['config'].values[np.unique(trial_codes, return_index=True)[1]]
+
+    return tensor, trial_list, configs
+
+def find_n_responsive_frames_all(traces, labels, n_stds=2.5):
+    '''
+    Same as find_n_responsive_frames(), for all ROIs (columns of traces) and configs at once.
+    Trial-averaged trace for each config is taken from the trial tensor (see build_trial_tensor()).
+
+    Returns (config x roi) dataframe of N stimulus frames outside baseline mean +/- n_stds * baseline std.
+    '''
+    stimon = int(labels['stim_on_frame'].unique()[0])
+    nframes_on = int(labels['nframes_on'].unique()[0])
+    tensor, trial_list, configs = build_trial_tensor(traces, labels)
+
+    # Average trials of each config (nconfigs x nframes x nrois)
+    config_codes, config_names = pd.factorize(configs, sort=True)
+    trial_order = np.argsort(config_codes, kind='mergesort')
+    config_starts = np.searchsorted(config_codes[trial_order], np.arange(0, len(config_names)))
+    ntrials = np.bincount(config_codes, minlength=len(config_names)).astype(float)
+    tr = np.add.reduceat(tensor[trial_order], config_starts, axis=0) / ntrials[:, np.newaxis, np.newaxis]
+
+    b_mean = np.nanmean(tr[:, 0:stimon, :], axis=1)
+    b_std = np.nanstd(tr[:, 0:stimon, :], axis=1)
+    thr_lo = np.abs(b_mean) - (b_std*n_stds)
+    thr_hi = np.abs(b_mean) + (b_std*n_stds)
+    stim_frames = np.abs(tr[:, stimon:stimon+nframes_on, :])
+    n_resp_frames = (stim_frames > thr_hi[:, np.newaxis, :]).sum(axis=1) \
+                        + (stim_frames < thr_lo[:, np.newaxis, :]).sum(axis=1)
+
+    cfs = pd.DataFrame(n_resp_frames, index=config_names, columns=traces.columns)
+
+    return cfs
+
 def find_n_responsive_frames(roi_traces, labels, n_stds=2.5):
     roi = roi_traces.name
     stimon = labels['stim_on_frame'].unique()[0]
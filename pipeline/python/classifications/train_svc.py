@@ -29,7 +29,7 @@ from collections import Counter
 from scipy import stats
 
 from pipeline.python.classifications import linearSVC_class as lsvc
-from pipeline.python.utils import print_elapsed_time, natural_keys, label_figure, replace_root
+from pipeline.python.utils import print_elapsed_time, natural_keys, label_figure, replace_root, load_maskarray
 from pipeline.python.rois import utils as util  #get_roi_contours, plot_roi_contours
 import matplotlib.gridspec as gridspec
 
@@ -131,7 +131,7 @@ def load_tid_rois(mask_fpath, file_key=None):
 
     if file_key is None:
         file_key = maskfile.keys()[0]
-    masks = np.array(maskfile[file_key]['Slice01']['maskarray'])
+    masks = load_maskarray(maskfile[file_key]['Slice01'], 'maskarray')
     dims = maskfile[file_key]['Slice01']['zproj'].shape
     masks_r = np.reshape(masks, (dims[0], dims[1], masks.shape[-1]))
     
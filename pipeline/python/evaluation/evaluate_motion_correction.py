@@ -23,7 +23,7 @@ import numpy as np
 import seaborn as sns
 import pandas as pd
 
-from pipeline.python.utils import natural_keys, get_source_info, print_elapsed_time
+from pipeline.python.utils import natural_keys, get_source_info, print_elapsed_time, iter_tiff_blocks
 
 #%%      
     
@@ -222,37 +222,92 @@ def evaluate_zproj(zproj_results, info, nstds=2, zproj='mean'):
     return zproj_results
     
 #%%
-def frame_corr_file(tiffpath, info, nstds=4, ref_frame=0, asdict=True):
-                    
+def phase_corr_shifts(frames, ref_fft):
+    '''
+    Rigid (integer-pixel) shift of each frame (... x d1 x d2) relative to reference image,
+    from the peak of the phase correlation. ref_fft is np.fft.fft2 of the reference image (broadcast against frames).
+
+    Returns (nframes x 2) array, over all leading dims of frames, of (row, col) shifts, where positive = frame displaced down/right of reference.
+    '''
+    d1, d2 = frames.shape[-2:]
+    R = np.fft.fft2(frames) * np.conj(ref_fft)
+    R /= (np.abs(R) + np.finfo(float).eps)
+    pcorr = np.fft.ifft2(R).real
+    peaks = np.argmax(np.reshape(pcorr, (-1, d1*d2)), axis=1)
+    shifts = np.vstack(np.unravel_index(peaks, (d1, d2))).T
+    shifts[shifts[:, 0] > d1//2, 0] -= d1
+    shifts[shifts[:, 1] > d2//2, 1] -= d2
+
+    return shifts
+
+def frame_corr_file(tiffpath, info, nstds=4, ref_frame=0, asdict=True, block_size=100):
+    '''
+    Streams volumes of the reference channel from tiffpath in blocks of block_size volumes, and gets:
+        frame_corrcoefs : correlation of each volume to ref_frame (all frames except ref_frame)
+        mean_corrcoefs  : correlation of each volume to the running mean of the volumes before it (nan for 1st)
+        shifts          : rigid (row, col) shift of each slice relative to ref_frame, by phase correlation (T x d3 x 2)
+    Correlations are normalized dot products of mean-subtracted volumes (same as pearson corr).
+    '''
     T = info['T']
     d1 = info['d1']; d2 = info['d2']; d3 = info['d3']
     mc_evaldir = info['output_dir']
     nchannels = info['nchannels']
     channelidx = int(info['ref_channel'][7:]) - 1
- 
-    mov = tf.imread(tiffpath)
-    mov = mov[channelidx::nchannels,:,:]
     curr_filename = str(re.search('File(\d{3})', tiffpath).group(0))
-    
-    
-    print "Loaded %s. Mov size:" % curr_filename, mov.shape      # T*d3, d1, d2 (d1 = lines/fr, d2 = pix/lin)
-    mov = np.squeeze(np.reshape(mov, [T, d3, d1, d2], order='C'))  # Reshape so that slices in vol are grouped together
-    movR = np.reshape(mov, [T, d1*d2*d3], order='C')
-    df = pd.DataFrame(movR)
+    ref_frame = int(ref_frame)
+
+    page_idxs = np.arange(channelidx, T*d3*nchannels, nchannels)
+    print "Loading %s in blocks of %i volumes. Mov size:" % (curr_filename, block_size), (T*d3, d1, d2)
+
+    # Reference volume:
+    ref_vol = np.vstack([block for _, block in iter_tiff_blocks(tiffpath, page_idxs[ref_frame*d3:(ref_frame+1)*d3], chunk_size=d3)])
+    ref_fft = np.fft.fft2(ref_vol.astype(float))
+    ref_vec = ref_vol.astype(float).ravel()
+    ref_vec -= ref_vec.mean()
+    ref_vec /= np.linalg.norm(ref_vec)
+
+    ref_corrs = np.zeros((T,))
+    mean_corrs = np.ones((T,)) * np.nan
+    shifts = np.zeros((T, d3, 2), dtype=int)
+    running_sum = np.zeros((d1*d2*d3,))
+    for start, block in iter_tiff_blocks(tiffpath, page_idxs, chunk_size=block_size*d3):
+        fr_start = start // d3
+        nvols = block.shape[0] // d3
+        vols = np.reshape(block.astype(float), (nvols, d1*d2*d3))
+        shifts[fr_start:fr_start+nvols] = np.reshape(phase_corr_shifts(np.reshape(block.astype(float), (nvols, d3, d1, d2)),
+                                                                       ref_fft), (nvols, d3, 2))
+
+        # Running mean of all volumes preceding each volume in block:
+        prev_sums = running_sum + np.vstack([np.zeros((1, vols.shape[1])), np.cumsum(vols[0:-1, :], axis=0)])
+        running_sum = prev_sums[-1] + vols[-1]
+        prev_means = prev_sums / np.arange(fr_start, fr_start+nvols)[:, np.newaxis].clip(min=1)
+        prev_means -= prev_means.mean(axis=1)[:, np.newaxis]
+
+        vols -= vols.mean(axis=1)[:, np.newaxis]
+        vol_norms = np.linalg.norm(vols, axis=1)
+        ref_corrs[fr_start:fr_start+nvols] = vols.dot(ref_vec) / vol_norms
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_corrs[fr_start:fr_start+nvols] = np.einsum('ij,ij->i', vols, prev_means) / (vol_norms * np.linalg.norm(prev_means, axis=1))
+    mean_corrs[0] = np.nan
+
     fr_idxs = [fr for fr in np.arange(0, T) if not fr==ref_frame]
-    corrcoefs = np.array([df.T[ref_frame].corr(df.T[fr]) for fr in fr_idxs])
+    corrcoefs = ref_corrs[fr_idxs]
+    shifts = np.squeeze(shifts)
+    dims = tuple([d for d in (T, d3, d1, d2) if d > 1])   # squeezed (T, d3, d1, d2)
     bad_frames, metric = evaluate_frame_corrs(corrcoefs, currfile=curr_filename, nstds=nstds, ref_frame=ref_frame, mc_evaldir=mc_evaldir)
- 
+
     if asdict is True:
         framecorr = dict()
         framecorr['frame_corrcoefs'] = corrcoefs
+        framecorr['mean_corrcoefs'] = mean_corrs
+        framecorr['shifts'] = shifts
         framecorr['file_source'] = tiffpath
-        framecorr['dims'] = mov.shape
+        framecorr['dims'] = dims
         framecorr['metric'] = metric
         framecorr['bad_frames'] = bad_frames
         return framecorr
     else:
-        return corrcoefs, tiffpath, mov.shape, metric, bad_frames
+        return corrcoefs, tiffpath, dims, metric, bad_frames
 
 ####
 def mp_frame_corr(filepaths, info, nstds=4, ref_frame=0, nprocs=12):
@@ -345,7 +400,7 @@ def get_frame_correlations(info, ref_frame=0, nstds=4, multiproc=True, nprocs=12
     else:
         framecorr_results = dict()
         for fidx,fn in enumerate(sorted(tiff_paths, key=natural_keys)):
-            curr_filename = str(re.search('File(\d{3})', fn.group(0)))
+            curr_filename = str(re.search('File(\d{3})', fn).group(0))
             framecorr = frame_corr_file(fn, info, nstds=nstds, ref_frame=ref_frame, asdict=True)
 #            bad_frames, metric = evaluate_frame_corrs(framecorr['corrcoefs'], currfile=curr_filename, nstds=nstds, ref_frame=ref_frame, mc_evaldir=mc_evaldir)
 #            framecorr['metric'] = metric
@@ -496,7 +551,20 @@ def evaluate_motion(options):
             dset_frame_corr_file.attrs['bad_frames'] = framecorr_results[fn]['bad_frames']
         else:
             dset_frame_corr_file = frame_corr_grp[fn]
-    
+
+    # Correlation of each frame to running mean of preceding frames, and rigid shifts to ref frame:
+    for grpname, key in [('within_file_mean', 'mean_corrcoefs'), ('frame_shifts', 'shifts')]:
+        if grpname not in metrics.keys():
+            grp = metrics.create_group(grpname)
+            grp.attrs['ref_frame'] = ref_frame
+            grp.attrs['ref_channel'] = info['ref_channel']
+        else:
+            grp = metrics[grpname]
+        for fn in framecorr_results.keys():
+            if fn not in grp.keys():
+                dset = grp.create_dataset(fn, data=framecorr_results[fn][key])
+                dset.attrs['file_source'] = framecorr_results[fn]['file_source']
+
     #%%
     # -------------------------------------------------------------------------
     # 3. Identify border pixels:
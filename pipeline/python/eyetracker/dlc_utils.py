@@ -1140,27 +1140,73 @@ def resample_traces(samples, in_rate=44.65, out_rate=20.0):
     
     return out_tpoints, out_samples
 
+def resample_trialmat(trialmat, in_rate=44.65, out_rate=20.0, axis=1, skip_nans=True):
+    '''
+    Resample all trials at once along axis (frames) of trialmat (ntrials x nframes [x nrois]), 
+    i.e., resample_traces() on every trial, as 1 linear interpolation.
+
+    skip_nans (bool)
+        True: NaNs are interpolated over (as pandas interpolate('values')), leading NaNs stay NaN.
+        False: NaNs propagate to neighboring resampled points (as resample_traces()).
+
+    Returns out_tpoints (n_out_samples,), resampled trialmat (n_out_samples along axis)
+    '''
+    tmat = np.moveaxis(np.asarray(trialmat, dtype=float), axis, -1)
+    nframes = tmat.shape[-1]
+    in_rows = tmat.reshape(-1, nframes)
+    out_tpoints, out_rows = resample_traces(in_rows.T, in_rate=in_rate, out_rate=out_rate)
+    out_rows = np.ascontiguousarray(out_rows.T)
+
+    # Trials w/ NaNs are done 1 by 1 (vectorized interp spreads NaNs to exact sample points)
+    in_tpoints = np.arange(0, nframes)
+    for ri in np.where(np.isnan(in_rows).any(axis=1))[0]:
+        valid_ixs = ~np.isnan(in_rows[ri, :])
+        if not skip_nans:
+            _, out_rows[ri, :] = resample_traces(in_rows[ri, :], in_rate=in_rate, out_rate=out_rate)
+        elif valid_ixs.sum() > 0:
+            out_rows[ri, :] = np.interp(out_tpoints, in_tpoints[valid_ixs], in_rows[ri, valid_ixs])
+            out_rows[ri, out_tpoints < in_tpoints[valid_ixs][0]] = np.nan
+
+    out_tmat = out_rows.reshape(tmat.shape[0:-1] + (len(out_tpoints),))
+
+    return out_tpoints, np.moveaxis(out_tmat, -1, axis)
+
+def pupil_traces_to_trialmat(pupiltraces, feature_name='pupil', min_nframes=None):
+    '''
+    Trial matrix (ntrials x min_nframes) of feature_name, trials padded with their last value 
+    or truncated to min_nframes (default: mean n frames/trial).
+    Returns sorted trial list, config of each trial, trialmat
+    '''
+    trial_list = np.array(sorted(pupiltraces['trial'].unique()))
+    trial_ixs = np.searchsorted(trial_list, pupiltraces['trial'].values)
+    frame_ixs = pupiltraces.groupby('trial').cumcount().values
+    nframes_per_trial = np.bincount(trial_ixs, minlength=len(trial_list))
+    if min_nframes is None:
+        min_nframes = int(round(np.mean(nframes_per_trial)))
+
+    trialmat = np.zeros((len(trial_list), min_nframes))
+    kept = frame_ixs < min_nframes
+    trialmat[trial_ixs[kept], frame_ixs[kept]] = pupiltraces[feature_name].values[kept]
+    # pad short trials with last value (np.pad mode='edge')
+    last_vals = trialmat[np.arange(0, len(trial_list)), np.minimum(nframes_per_trial, min_nframes)-1]
+    padded = np.arange(0, min_nframes)[np.newaxis, :] >= nframes_per_trial[:, np.newaxis]
+    trialmat = np.where(padded, last_vals[:, np.newaxis], trialmat)
+
+    configs = pupiltraces.groupby('trial')['config'].first().loc[trial_list].values
+
+    return trial_list, configs, trialmat
+
 def bin_pupil_traces(pupiltraces, feature_name='pupil',in_rate=20.0, out_rate=22.325, 
                           min_nframes=None, iti_pre_ms=1000):
-    pupildfs = []
-    if min_nframes is None:
-        min_nframes = int(round(np.mean([len(g) for p, g in pupiltraces.groupby(['trial'])])))
-    #print(min_nframes)
-    for trial, g in pupiltraces.groupby(['trial']):
-        if len(g[feature_name]) < min_nframes:
-            npad = min_nframes - len(g[feature_name])
-            vals = np.pad(g[feature_name].values, pad_width=((0, npad)), mode='edge')
-        else:
-            vals = g[feature_name].values[0:min_nframes]
-        #print(len(vals))
-        out_ixs, out_s = resample_traces(vals, in_rate=in_rate, out_rate=out_rate)
-        currconfig = g['config'].unique()[0]
-        new_stim_on = (iti_pre_ms/1E3)*out_rate #int(np.where(abs(out_ixs-stim_on) == min(abs(out_ixs-stim_on)))[0])
-        pupildfs.append(pd.DataFrame({feature_name: out_s, 
-                                       'stim_on': [new_stim_on for _ in np.arange(0, len(out_s))],
-                                       'config': [currconfig for _ in np.arange(0, len(out_s))],
-                                       'trial': [trial for _ in np.arange(0, len(out_s))]} ))
-    pupildfs = pd.concat(pupildfs, axis=0).reset_index(drop=True)
+    trial_list, configs, trialmat = pupil_traces_to_trialmat(pupiltraces, feature_name=feature_name, 
+                                                             min_nframes=min_nframes)
+    out_ixs, out_s = resample_trialmat(trialmat, in_rate=in_rate, out_rate=out_rate, skip_nans=False)
+    n_out = out_s.shape[1]
+    new_stim_on = (iti_pre_ms/1E3)*out_rate #int(np.where(abs(out_ixs-stim_on) == min(abs(out_ixs-stim_on)))[0])
+    pupildfs = pd.DataFrame({feature_name: out_s.ravel(), 
+                             'stim_on': np.ones(out_s.size)*new_stim_on,
+                             'config': np.repeat(configs, n_out),
+                             'trial': np.repeat(trial_list, n_out)})
     return pupildfs
 
 
@@ -1173,19 +1219,18 @@ def resample_pupil_traces(pupiltraces, in_rate=20., out_rate=20., iti_pre_ms=100
     '''
     resample pupil traces to make sure we have exactly the right # of frames to match neural data
     '''
-    binned_pupil = bin_pupil_traces(pupiltraces, feature_name=feature_name,
-                                         in_rate=in_rate, out_rate=out_rate, 
-                                         min_nframes=desired_nframes, iti_pre_ms=iti_pre_ms)
-    trials_ = sorted(pupiltraces['trial'].unique())
+    trials_, configs, trialmat = pupil_traces_to_trialmat(pupiltraces, feature_name=feature_name, 
+                                                          min_nframes=desired_nframes)
+    _, binned_pupil = resample_trialmat(trialmat, in_rate=in_rate, out_rate=out_rate, skip_nans=False)
     frames_ = np.arange(0, desired_nframes)
-    pupil_trialmat = pd.DataFrame(np.vstack([p[feature_name].values for trial, p in binned_pupil.groupby(['trial'])]),
-                                  index=trials_, columns=frames_)
-    pupil_r = pupil_trialmat.T.unstack().reset_index().rename(columns={'level_0': 'trial', 
-                                                                       'level_1': 'frame',
-                                                                       0: feature_name})
-    pupil_r['frame_int'] = [int(round(f)) for f in pupil_r['frame']]
-    interp_frame_ixs = list(sorted(pupil_r['frame'].unique()))
-    pupil_r['frame_ix'] = [interp_frame_ixs.index(f) for f in pupil_r['frame']]
+    assert binned_pupil.shape[1] == len(frames_), \
+            "Resampled to %i frames, expected %i" % (binned_pupil.shape[1], desired_nframes)
+    pupil_r = pd.DataFrame({'trial': np.repeat(trials_, len(frames_)),
+                            'frame': np.tile(frames_, len(trials_)),
+                            feature_name: binned_pupil.ravel()}, columns=['trial', 'frame', feature_name])
+    pupil_r['frame_int'] = np.round(pupil_r['frame'].values).astype(int)
+    interp_frame_ixs = np.unique(pupil_r['frame'].values)
+    pupil_r['frame_ix'] = np.searchsorted(interp_frame_ixs, pupil_r['frame'].values)
 
     return pupil_r
     
@@ -1396,42 +1441,59 @@ def get_valid_neuraldata_and_pupildata(pupildata, MEANS, SDF, verbose=False, ret
 # ===================================================================
 # Neural trace processing (should prob go somewhere else)
 # ====================================================================
-def resample_neural_traces(roi_traces, labels=None, in_rate=44.65, out_rate=20.0, 
-                           zscore=True, return_labels=True):
+def get_trial_frame_ixs(labels):
+    '''
+    Frame indices (ntrials x nframes_per_trial) of each trial in labels, 
+    with trial number and config of each trial.
+    '''
+    trial_groups = [(trial, tg) for trial, tg in labels.groupby('trial')]
+    trial_nums = [int(trial[5:]) for trial, tg in trial_groups]
+    configs_on_included_trials = [tg['config'].unique()[0] for trial, tg in trial_groups]
+    frame_ixs = np.vstack([tg.index for trial, tg in trial_groups])
 
-    # Create trial mat, downsampled: shape = (ntrials, nframes_per_trial)
-    trialmat = pd.DataFrame(np.vstack([roi_traces[tg.index] for trial, tg in labels.groupby(['trial'])]),\
-                            index=[int(trial[5:]) for trial, tg in labels.groupby(['trial'])])
+    return trial_nums, configs_on_included_trials, frame_ixs
 
-    #### Bin traces - Each tbin is a column, each row is a sample 
-    sample_data = trialmat.fillna(method='pad').copy()
-    ntrials, nframes_per_trial = sample_data.shape
+def resample_trial_traces(traces, labels, in_rate=44.65, out_rate=20., zscore=True):
+    '''
+    Resample each trial of each roi's trace (columns of traces, index matching labels) at once.
+    Missing values are padded from the previous trial (same frame), then interpolated over.
+    zscore: divide each roi's resampled traces by their std (over all trials and frames).
 
-    #### Get resampled indices of trial epochs
-    #print("%i frames/trial" % nframes_per_trial)
-    out_tpoints, out_ixs = resample_traces(np.arange(0, nframes_per_trial), 
-                                           in_rate=in_rate, out_rate=out_rate)
-    
-    #### Bin traces - Each tbin is a column, each row is a sample 
-    df = trialmat.fillna(method='pad').copy().T
-    xdf = df.reindex(df.index.union(out_ixs)).interpolate('values').loc[out_ixs]
-    binned_trialmat = xdf.T
-    n_tbins = binned_trialmat.shape[1]
+    Returns trial_nums, configs, out_tpoints, resampled traces (ntrials x n_tbins x nrois)
+    '''
+    trial_nums, configs, frame_ixs = get_trial_frame_ixs(labels)
+    ntrials, nframes_per_trial = frame_ixs.shape
+    nrois = traces.shape[1]
+
+    #### Create trial mat: shape = (ntrials, nframes_per_trial * nrois)
+    trialmat = traces.loc[frame_ixs.ravel()].values.reshape((ntrials, nframes_per_trial*nrois))
+    trialmat = pd.DataFrame(trialmat).ffill().values.reshape((ntrials, nframes_per_trial, nrois))
+
+    #### Interpolate resampled values
+    out_tpoints, binned_trialmat = resample_trialmat(trialmat, in_rate=in_rate, out_rate=out_rate, axis=1)
 
     #### Zscore traces 
     if zscore:
-        traces_r = binned_trialmat / binned_trialmat.values.ravel().std()
-    else:
-        traces_r = binned_trialmat.copy()
+        binned_trialmat = binned_trialmat / binned_trialmat.reshape((-1, nrois)).std(axis=0)
+
+    return trial_nums, configs, out_tpoints, binned_trialmat
+
+def resample_neural_traces(roi_traces, labels=None, in_rate=44.65, out_rate=20.0, 
+                           zscore=True, return_labels=True):
+
+    trial_nums, configs_on_included_trials, out_tpoints, binned_trialmat = resample_trial_traces(
+                                            roi_traces.to_frame(), labels, in_rate=in_rate, out_rate=out_rate, 
+                                            zscore=zscore)
+    ntrials, n_tbins, _ = binned_trialmat.shape
         
     # Reshape roi traces
-    curr_roi_traces = traces_r.T.unstack().reset_index() # level_0=trial number, level_1=frame number
-    curr_roi_traces.rename(columns={0: roi_traces.name}, inplace=True)
+    curr_roi_traces = pd.DataFrame({'level_0': np.repeat(trial_nums, n_tbins),
+                                    'level_1': np.tile(out_tpoints, ntrials),
+                                    roi_traces.name: binned_trialmat.ravel()}, 
+                                    columns=['level_0', 'level_1', roi_traces.name])
     
     if return_labels:
-        configs_on_included_trials = [tg['config'].unique()[0] for trial, tg in labels.groupby(['trial'])]
-        included_trials = [trial for trial, tg in labels.groupby(['trial'])]
-        cfg_list = np.hstack([[c for _ in np.arange(0, n_tbins)] for c in configs_on_included_trials])
+        cfg_list = np.repeat(configs_on_included_trials, n_tbins)
         curr_roi_traces.rename(columns={'level_0': 'trial', 'level_1': 'frame_interp'}, inplace=True)
         curr_roi_traces['config'] = cfg_list
         return curr_roi_traces
@@ -1440,35 +1502,20 @@ def resample_neural_traces(roi_traces, labels=None, in_rate=44.65, out_rate=20.0
 
 def resample_labels(labels, in_rate=44.65, out_rate=20):
     # Create trial mat, downsampled: shape = (ntrials, nframes_per_trial)
-    trialmat = pd.DataFrame(np.vstack([tg.index for trial, tg in labels.groupby(['trial'])]),\
-                            index=[int(trial[5:]) for trial, tg in labels.groupby(['trial'])])
-    configs_on_included_trials = [tg['config'].unique()[0] for trial, tg in labels.groupby(['trial'])]
-    included_trials = [trial for trial, tg in labels.groupby(['trial'])]
-
-    #### Bin traces - Each tbin is a column, each row is a sample 
-    sample_data = trialmat.fillna(method='pad').copy()
-    ntrials, nframes_per_trial = sample_data.shape
-    
+    trial_nums, configs_on_included_trials, frame_ixs = get_trial_frame_ixs(labels)
+    ntrials, nframes_per_trial = frame_ixs.shape
 
     #### Get resampled indices of trial epochs
     print("%i frames/trial" % nframes_per_trial)
-    out_tpoints, out_ixs = resample_traces(np.arange(0, nframes_per_trial), 
-                                           in_rate=in_rate, out_rate=out_rate)
-    
-    #### Bin traces - Each tbin is a column, each row is a sample 
-    df = trialmat.fillna(method='pad').copy().T
-    xdf = df.reindex(df.index.union(out_ixs)).interpolate('values').loc[out_ixs]
-    binned_trialmat = xdf.T
+    out_tpoints, binned_trialmat = resample_trialmat(frame_ixs, in_rate=in_rate, out_rate=out_rate)
     n_tbins = binned_trialmat.shape[1]
 
     # Reshape roi traces
-    curr_roi_traces = binned_trialmat.T.unstack().reset_index() # level_0=trial number, level_1=frame number
-    curr_roi_traces.rename(columns={0: 'index'}, inplace=True)
-    
-
-    cfg_list = np.hstack([[c for _ in np.arange(0, n_tbins)] for c in configs_on_included_trials])
-    curr_roi_traces.rename(columns={'level_0': 'trial', 'level_1': 'frame_interp'}, inplace=True)
-    curr_roi_traces['config'] = cfg_list
+    curr_roi_traces = pd.DataFrame({'trial': np.repeat(trial_nums, n_tbins),
+                                    'frame_interp': np.tile(out_tpoints, ntrials),
+                                    'index': binned_trialmat.ravel()}, 
+                                    columns=['trial', 'frame_interp', 'index'])
+    curr_roi_traces['config'] = np.repeat(configs_on_included_trials, n_tbins)
     
     return curr_roi_traces
 
@@ -1528,46 +1575,21 @@ def resample_roi_traces_mp(df, labels, in_rate=44.65, out_rate=20., zscore=True,
     return df #results
 
 def resample_all_roi_traces(traces, labels, in_rate=44.65, out_rate=20.):
+    '''
+    Resample (and zscore) trials of all rois at once (see resample_trial_traces()).
+    Returns long-form dataframe (ntrials*n_tbins x nrois), with trial, frame_ix and config columns.
+    '''
     roi_list = traces.columns.tolist()
-    configs_on_included_trials = [tg['config'].unique()[0] for trial, tg in labels.groupby(['trial'])]
-    included_trials = [trial for trial, tg in labels.groupby(['trial'])]
-
-    r_list=[]
-
-    for ri, rid in enumerate(roi_list):
-        if ri%20==0:
-            print("... %i of %i cells" % (int(ri+1), len(roi_list)))
-            
-        # Create trial mat, downsampled: shape = (ntrials, nframes_per_trial)
-        trialmat = pd.DataFrame(np.vstack([traces[rid][tg.index] for trial, tg in labels.groupby(['trial'])]),\
-                                index=[int(trial[5:]) for trial, tg in labels.groupby(['trial'])])
-
-        #### Bin traces - Each tbin is a column, each row is a sample 
-        sample_data = trialmat.fillna(method='pad').copy()
-        ntrials, nframes_per_trial = sample_data.shape
-
-        #### Get resampled indices of trial epochs
-        out_tpoints, out_ixs = resample_traces(np.arange(0, nframes_per_trial), 
-                                               in_rate=in_rate, out_rate=out_rate)
-
-        #### Bin traces - Each tbin is a column, each row is a sample 
-        df = sample_data.T
-        xdf = df.reindex(df.index.union(out_ixs)).interpolate('values').loc[out_ixs] # Interpolate resampled values
-        binned_trialmat = xdf.T # should be Ntrials # Nframes
-        n_trials, n_tbins = binned_trialmat.shape
-
-        #### Zscore traces 
-        zscored_neural = binned_trialmat / binned_trialmat.values.ravel().std()
-
-        # Reshape roi traces
-        cfg_list = np.hstack([[c for _ in np.arange(0, n_tbins)] for c in configs_on_included_trials])
-        curr_roi_traces = zscored_neural.T.unstack().reset_index() # level_0=trial number, level_1=frame number
-        curr_roi_traces.rename(columns={'level_0': 'trial', 'level_1': 'frame_ix', 0: rid}, inplace=True)
-        r_list.append(curr_roi_traces)
+    trial_nums, configs_on_included_trials, out_tpoints, zscored_neural = resample_trial_traces(
+                                            traces, labels, in_rate=in_rate, out_rate=out_rate, zscore=True)
+    n_trials, n_tbins, n_rois = zscored_neural.shape
+    print("... resampled %i cells (%i trials, %i tbins)" % (n_rois, n_trials, n_tbins))
 
     # Combine all traces into 1 dataframe (all frames x nrois)
-    traces_r = pd.concat(r_list, axis=1)
-    traces_r['config'] = cfg_list
+    traces_r = pd.DataFrame(zscored_neural.reshape((n_trials*n_tbins, n_rois)), columns=roi_list)
+    traces_r['trial'] = np.repeat(trial_nums, n_tbins)
+    traces_r['frame_ix'] = np.tile(out_tpoints, n_trials)
+    traces_r['config'] = np.repeat(configs_on_included_trials, n_tbins)
 
     _, dii = np.unique(traces_r.columns, return_index=True)
     traces_r = traces_r.iloc[:, dii]
@@ -11,6 +11,7 @@ import time
 import pickle
 
 import re
+from pipeline.python.eyetracker.pack_eye_frames import get_eye_frames_path, get_eye_frame_list, read_eye_frame
 
 def tryint(s):
     try:
@@ -52,8 +53,13 @@ def save_obj(obj, name ):
         json.dump(obj, outfile)
 
 #FUNCTIONS
-def read_image(im_file,flip_flag=0,cv_flag=0):
-    if cv_flag:
+def read_image(im_file,flip_flag=0,cv_flag=0,im_list=None,im_count=0):
+    if im_list is not None:
+        #from packed eye frames (BGR, as cv2.imread)
+        im0 = read_eye_frame(im_file, im_list, im_count)
+        if not cv_flag:
+            im0 = cv2.cvtColor(im0, cv2.COLOR_BGR2RGB)
+    elif cv_flag:
         im0 = cv2.imread(im_file)
     else:
         im0 = misc.imread(im_file)
@@ -228,16 +234,22 @@ print 'Raw folder: %s'%(raw_folder)
 eye_root_dir = os.path.join(run_dir,raw_folder,'eyetracker_files')
 file_folder = os.listdir(eye_root_dir)[0]
 img_folder = os.path.join(eye_root_dir,file_folder,'frames')
-
-#get list of images in folder
-img_list = [name for name in os.listdir(img_folder) if os.path.isfile(os.path.join(img_folder, name))]
-sort_nicely(img_list)
-
-#pick first image as reference image
-img_file = os.path.join(img_folder,img_list[0])
-
-# load the image, clone it, and setup the mouse callback function
-img = read_image(img_file,0)
+eye_frames_fpath = get_eye_frames_path(os.path.join(eye_root_dir,file_folder))
+
+if os.path.exists(eye_frames_fpath):
+    #pick first frame of packed frames as reference image
+    img_list = get_eye_frame_list(eye_frames_fpath)
+    img = read_image(eye_frames_fpath,0,im_list=img_list,im_count=0)
+else:
+    #get list of images in folder
+    img_list = [name for name in os.listdir(img_folder) if os.path.isfile(os.path.join(img_folder, name))]
+    sort_nicely(img_list)
+
+    #pick first image as reference image
+    img_file = os.path.join(img_folder,img_list[0])
+
+    # load the image, clone it, and setup the mouse callback function
+    img = read_image(img_file,0)
 
 
 clone = img.copy()
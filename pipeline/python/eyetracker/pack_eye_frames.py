@@ -0,0 +1,155 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Pack eyetracker frames (eyetracker_files/<folder>/frames/, one image per frame) and frame times
+(eyetracker_files/<folder>/times/) into a single HDF5 container: eyetracker_files/<folder>/eye_frames.h5
+
+    frames                 (nframes x h x w x c) uint8, 1 compressed chunk per frame (as read by cv2.imread)
+    frame_names            original image file names, in frame order (sort_nicely)
+    times/frame_times/<k>  columns of frame_times.txt
+    times/performance      attrs: 1st row of performance.txt
+
+Any frame is read by index, without listing the frames dir (see get_eye_frame_list(), read_eye_frame()).
+"""
+import os
+import sys
+import re
+import time
+import optparse
+import cv2
+import h5py
+import numpy as np
+
+#-----------------------------------------------------
+#          FRAME SOURCES (dir of images, or container)
+#-----------------------------------------------------
+def tryint(s):
+    try:
+        return int(s)
+    except:
+        return s
+
+def alphanum_key(s):
+    """ Turn a string into a list of string and number chunks.
+        "z23a" -> ["z", 23, "a"]
+    """
+    return [ tryint(c) for c in re.split('([0-9]+)', s) ]
+
+def get_eye_frames_path(eye_file_dir):
+    return os.path.join(eye_file_dir, 'eye_frames.h5')
+
+def is_frame_container(im_src):
+    return im_src.endswith('.h5')
+
+def get_eye_frame_list(im_src):
+    '''
+    Frame (image file) names, in frame order, for a frames dir or an eye_frames.h5 container.
+    '''
+    if is_frame_container(im_src):
+        with h5py.File(im_src, 'r') as f:
+            im_list = [str(n.decode('utf-8')) if isinstance(n, bytes) else str(n) for n in f['frame_names'][:]]
+    else:
+        im_list = [name for name in os.listdir(im_src) if os.path.isfile(os.path.join(im_src, name))]
+        im_list.sort(key=alphanum_key)
+    return im_list
+
+# open containers, per process (handles are not shared across forked workers)
+eye_frame_files = {}
+
+def get_frame_container(im_src):
+    file_key = (im_src, os.getpid())
+    if file_key not in eye_frame_files:
+        eye_frame_files[file_key] = h5py.File(im_src, 'r')
+    return eye_frame_files[file_key]
+
+def read_eye_frame(im_src, im_list, im_count):
+    '''
+    Frame im_count, same as cv2.imread() of the image file, from a frames dir or an eye_frames.h5 container.
+    '''
+    if is_frame_container(im_src):
+        return get_frame_container(im_src)['frames'][im_count]
+    return cv2.imread(os.path.join(im_src, im_list[im_count]))
+
+def read_text_columns(fpath):
+    # header row + 1 row of values per line
+    with open(fpath, 'r') as pfile:
+        headers = pfile.readline().split()
+        rows = [line.split() for line in pfile if len(line.split()) > 0]
+    return headers, rows
+
+#-----------------------------------------------------
+#          PACKING
+#-----------------------------------------------------
+def pack_eye_frames(im_dir, times_dir, output_fpath, compression='gzip', compression_opts=1, create_new=False):
+    '''
+    Write all frames in im_dir + frame times in times_dir to output_fpath (see module doc).
+    Frames are written in order, 1 chunk per frame, so reading any frame is a single chunk read.
+    '''
+    if os.path.exists(output_fpath) and not create_new:
+        print '... eye frames already packed: %s' % output_fpath
+        return output_fpath
+
+    t_pack = time.time()
+    im_list = get_eye_frame_list(im_dir)
+    nframes = len(im_list)
+    im0 = cv2.imread(os.path.join(im_dir, im_list[0]))
+    print 'Packing %i frames (%s) to %s' % (nframes, str(im0.shape), output_fpath)
+
+    tmp_fpath = '%s.tmp' % output_fpath
+    with h5py.File(tmp_fpath, 'w') as f:
+        f.attrs['source_dir'] = im_dir
+        f.attrs['nframes'] = nframes
+        fset = f.create_dataset('frames', (nframes,) + im0.shape, dtype=im0.dtype,
+                                chunks=(1,) + im0.shape, compression=compression, compression_opts=compression_opts)
+        for im_count, im_fn in enumerate(im_list):
+            if im_count%1000==0:
+                print '... packed %d of %d frames' % (im_count, nframes)
+            fset[im_count] = cv2.imread(os.path.join(im_dir, im_fn))
+        f.create_dataset('frame_names', data=np.array(im_list, dtype='S'))
+
+        headers, rows = read_text_columns(os.path.join(times_dir, 'frame_times.txt'))
+        tgrp = f.create_group('times/frame_times')
+        for ci, header in enumerate(headers):
+            tgrp.create_dataset(header, data=np.array([float(r[ci]) for r in rows]))
+        headers, rows = read_text_columns(os.path.join(times_dir, 'performance.txt'))
+        pgrp = f.create_group('times/performance')
+        for ci, header in enumerate(headers):
+            pgrp.attrs[header] = rows[0][ci]
+    os.rename(tmp_fpath, output_fpath)
+    print '... done packing (%.2f min)' % ((time.time()-t_pack)/60.)
+
+    return output_fpath
+
+def extract_options(options):
+    parser = optparse.OptionParser()
+
+    # PATH opts:
+    parser.add_option('-D', '--root', action='store', dest='rootdir', default='/nas/volume1/2photon/data', help='data root dir (root project dir containing all animalids) [default: /nas/volume1/2photon/data, /n/coxfs01/2pdata if --slurm]')
+    parser.add_option('-i', '--animalid', action='store', dest='animalid', default='', help='Animal ID')
+    parser.add_option('-S', '--session', action='store', dest='session', default='', help='session dir (format: YYYMMDD_ANIMALID')
+    parser.add_option('-A', '--acq', action='store', dest='acquisition', default='FOV1', help="acquisition folder (ex: 'FOV1_zoom3x') [default: FOV1]")
+    parser.add_option('-R', '--run', action='store', dest='run', default='', help="name of run dir containing tiffs to be processed (ex: gratings_phasemod_run1)")
+    parser.add_option('--slurm', action='store_true', dest='slurm', default=False, help="set if running as SLURM job on Odyssey")
+    parser.add_option('--new', action='store_true', dest='create_new', default=False, help="set to re-pack frames, if container exists")
+
+    (options, args) = parser.parse_args(options)
+    if options.slurm is True and 'coxfs' not in options.rootdir:
+        options.rootdir = '/n/coxfs01/2p-data'
+
+    return options
+
+def main(options):
+    options = extract_options(options)
+
+    run_dir = os.path.join(options.rootdir, options.animalid, options.session, options.acquisition, options.run)
+    raw_folder = [r for r in os.listdir(run_dir) if 'raw' in r and os.path.isdir(os.path.join(run_dir, r))][0]
+    eye_root_dir = os.path.join(run_dir,raw_folder,'eyetracker_files')
+    file_folder = os.listdir(eye_root_dir)[0]
+    eye_file_dir = os.path.join(eye_root_dir,file_folder)
+
+    pack_eye_frames(os.path.join(eye_file_dir,'frames'), os.path.join(eye_file_dir,'times'),
+                    get_eye_frames_path(eye_file_dir), create_new=options.create_new)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -22,6 +22,11 @@ import pylab as pl
 import seaborn as sns
 import pandas as pd
 import h5py
+import collections
+from pipeline.python.eyetracker.pack_eye_frames import get_eye_frames_path, is_frame_container, get_eye_frame_list, read_eye_frame, pack_eye_frames
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from functools import partial
 sns.set_style("darkgrid", {"axes.facecolor": ".9"})
 #-----------------------------------------------------
 #          SOME FUNCTIONS FOR VARIOUS PARTS
@@ -81,6 +86,9 @@ def block_mean(im0, fact):
 
 #load frame time info
 def get_frame_rate(relevant_dir):
+    if is_frame_container(relevant_dir):
+        with h5py.File(relevant_dir, 'r') as f:
+            return float(f['times/performance'].attrs['frame_rate'])
     # READ IN FRAME TIMES FILE
     pfile=open(os.path.join(relevant_dir,'performance.txt'))
 
@@ -105,6 +113,9 @@ def get_frame_rate(relevant_dir):
 
 def get_frame_attribute(relevant_dir,attr_string):
     #get frame-by-frame details
+    if is_frame_container(relevant_dir):
+        with h5py.File(relevant_dir, 'r') as f:
+            return f['times/frame_times/%s' % attr_string][:]
     # READ IN FRAME TIMES FILE
     pfile=open(os.path.join(relevant_dir,'frame_times.txt'))
 
@@ -132,11 +143,11 @@ def get_frame_attribute(relevant_dir,attr_string):
 
 #image processing functions
 def get_feature_info(process_img, box_pt1, box_pt2, feature_thresh, target_feature='pupil',criterion='area'):
+    #apply restriction box 
+    process_img = process_img[box_pt1[1]:box_pt2[1],box_pt1[0]:box_pt2[0]]
     #get grayscale
     if process_img.ndim>2:
         process_img=np.mean(process_img,2)
-    #apply restriction box 
-    process_img = process_img[box_pt1[1]:box_pt2[1],box_pt1[0]:box_pt2[0]]
 
     #threshold
     img_roi = np.zeros(process_img.shape)
@@ -148,9 +159,7 @@ def get_feature_info(process_img, box_pt1, box_pt2, feature_thresh, target_featu
         if criterion == 'area':
             #look for largest area
             labeled, nr_objects = ndimage.label(thresh_array) 
-            pix_area = np.zeros((nr_objects,))
-            for i in range(nr_objects):
-                pix_area[i] = len(np.where(labeled==i+1)[0])
+            pix_area = np.bincount(labeled.ravel(), minlength=nr_objects+1)[1:]
             img_roi[labeled == (np.argmax(pix_area)+1)]=255
             img_roi = img_roi.astype('uint8')
         else:
@@ -191,7 +200,182 @@ def get_feature_info(process_img, box_pt1, box_pt2, feature_thresh, target_featu
             return tuple((0,0)), tuple((0,0)), 0
     else:
         return tuple((0,0)), tuple((0,0)), 0
- 
+
+
+#frame loading and feature tracking
+def load_eye_frame(im_src, im_list, im_count, downsample_factor=None, space_filt_size=None):
+    im0 = read_eye_frame(im_src, im_list, im_count)
+    if downsample_factor is not None:
+        im0 = block_mean(im0, downsample_factor)
+    if space_filt_size is not None:
+        im0= cv2.boxFilter(im0,0, (space_filt_size, space_filt_size), normalize = 1)
+    return im0
+
+def iter_eye_frames(im_src, im_list, downsample_factor=None, space_filt_size=None, n_threads=4, prefetch=64):
+    '''
+    Yields (im_count, im0) for each image in im_list, in order, from im_src (frames dir or eye_frames.h5). 
+    Images are read (and filtered) ahead of time by n_threads threads, with at most prefetch frames in memory.
+    '''
+    pool = ThreadPool(n_threads)
+    pending = collections.deque()
+    try:
+        im_count = 0
+        for frame_ix in range(len(im_list)):
+            pending.append(pool.apply_async(load_eye_frame, (im_src, im_list, frame_ix, downsample_factor, space_filt_size)))
+            if len(pending) >= prefetch:
+                yield im_count, pending.popleft().get()
+                im_count += 1
+        while len(pending) > 0:
+            yield im_count, pending.popleft().get()
+            im_count += 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+#padding (pix, before scaling) of the restriction box: around last good fit, on reset after many bad frames, after a bad frame
+box_pads = {'pupil': {'fit': 3, 'reset': 10, 'widen': 5},
+            'cr': {'fit': 2, 'reset': 4, 'widen': 2}}
+
+def is_flagged_frame(target_feature, elp_center, elp_axes):
+    if target_feature == 'pupil':
+        pupil_ratio = np.true_divide(elp_axes[0],elp_axes[1])
+        return elp_center[0]==0 or pupil_ratio <=.6 or pupil_ratio>(1.0/.6) #probably blinking
+    else:
+        cr_radius = np.mean(elp_axes)
+        return elp_center[0]==0 or cr_radius>=20 #probably blinking
+
+def get_ellipse_box(ellipse_params, im_shape, pad):
+    #bounding box of filled ellipse, padded
+    dummy_img = np.zeros(im_shape[0:2], dtype='uint8')
+    cv2.ellipse(dummy_img, ellipse_params,255,-1)
+    tmp, contours, hierarchy = cv2.findContours(dummy_img,cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
+    x,y,w,h = cv2.boundingRect(contours[0])
+    return int(x-pad), int(y-pad), int(x+w+pad), int(y+h+pad)
+
+def track_feature(im_src, im_list, target_feature, box_orig, feature_thresh, scale_factor=1, 
+                  downsample_factor=None, space_filt_size=None, n_threads=4):
+    '''
+    Fits ellipse to target_feature ('pupil' or 'cr') in each frame, in order, since the restriction box
+    for each frame is adapted from the fit on the frames before it.
+
+    Returns dict of arrays (nframes x ...): center, axes, orientation (0 on flagged frames), flag_event,
+    and the box and ellipse fit of each frame (for drawing).
+    '''
+    nframes = len(im_list)
+    pads = dict((k, v*scale_factor) for k, v in box_pads[target_feature].items())
+    x1_orig, y1_orig, x2_orig, y2_orig = box_orig
+    x1, y1, x2, y2 = box_orig
+
+    track = {'center': np.zeros((nframes,2)),
+             'axes': np.zeros((nframes,2)),
+             'orientation': np.zeros((nframes,)),
+             'flag_event': np.zeros((nframes,)),
+             'box': np.zeros((nframes,4), dtype=int),
+             'ellipse': np.zeros((nframes,5))}
+    flag_event = track['flag_event']
+
+    for im_count, im0 in iter_eye_frames(im_src, im_list, downsample_factor=downsample_factor, 
+                                         space_filt_size=space_filt_size, n_threads=n_threads):
+        #display count
+        if im_count%1000==0:
+            print '[%s] Processing Image %d of %d....' %(target_feature,im_count,nframes)
+
+        #get features
+        elp_center, elp_axes, elp_orientation = get_feature_info(im0, (x1,y1), (x2,y2), feature_thresh, target_feature)
+        if is_flagged_frame(target_feature, elp_center, elp_axes):
+            flag_event[im_count] = 1
+        track['box'][im_count,:] = x1, y1, x2, y2
+        track['ellipse'][im_count,:] = tuple(elp_center) + tuple(elp_axes) + (elp_orientation,)
+
+        if flag_event[im_count] == 0:
+             #adaptive part
+            x1, y1, x2, y2 = get_ellipse_box(tuple((elp_center,elp_axes,elp_orientation)), im0.shape, pads['fit'])
+
+            #save to array
+            track['center'][im_count,:] = elp_center
+            track['axes'][im_count,:] = elp_axes
+            track['orientation'][im_count] = elp_orientation
+
+        if im_count >10:    
+            if sum(flag_event[im_count-10:im_count])>= 5:
+                #back to beginning with latest size
+                x1 = int(x1_orig-pads['reset'])
+                y1 = int(y1_orig-pads['reset'])
+                x2 = int(x2_orig+pads['reset'])
+                y2 = int(y2_orig+pads['reset'])
+            else:
+                #give yourself room for error after event
+                if flag_event[im_count-1]<1:
+                    x1 = int(x1-pads['widen'])
+                    y1 = int(y1-pads['widen'])
+                    x2 = int(x2+pads['widen'])
+                    y2 = int(y2+pads['widen'])
+
+    return track
+
+def track_feature_worker(feature_args, im_src=None, im_list=None, scale_factor=1, 
+                         downsample_factor=None, space_filt_size=None, n_threads=4):
+    target_feature, box_orig, feature_thresh = feature_args
+    return target_feature, track_feature(im_src, im_list, target_feature, box_orig, feature_thresh, 
+                                         scale_factor=scale_factor, downsample_factor=downsample_factor, 
+                                         space_filt_size=space_filt_size, n_threads=n_threads)
+
+def track_eye_features(im_src, im_list, feature_boxes, feature_threshs, scale_factor=1, 
+                       downsample_factor=None, space_filt_size=None, n_processes=1, n_threads=4):
+    '''
+    Tracks each feature in feature_boxes (pupil, cr) across all frames. Features are independent of 
+    each other, so each one is tracked in its own process if n_processes > 1.
+    Returns dict of tracks (see track_feature()), keyed by feature.
+    '''
+    feature_args = [(f, feature_boxes[f], feature_threshs[f]) for f in ['pupil', 'cr'] if f in feature_boxes]
+    worker = partial(track_feature_worker, im_src=im_src, im_list=im_list, scale_factor=scale_factor,
+                     downsample_factor=downsample_factor, space_filt_size=space_filt_size, n_threads=n_threads)
+    if n_processes > 1 and len(feature_args) > 1:
+        pool = mp.Pool(processes=min(n_processes, len(feature_args)))
+        try:
+            tracks = dict(pool.map(worker, feature_args))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        tracks = dict(map(worker, feature_args))
+    return tracks
+
+#colors of (box, ellipse, flagged ellipse) in annotated movie
+feature_colors = {'pupil': ((0,255,255), (0,0,255), (0,255,0)),
+                  'cr': ((255,255,0), (255,0,0), (0,255,0))}
+
+def write_annotated_frame(im_count, im_src=None, im_list=None, tracks=None, output_dir=None, downsample_factor=None):
+    im_disp = read_eye_frame(im_src, im_list, im_count)
+    ds = 1 if downsample_factor is None else downsample_factor
+    for target_feature in ['pupil', 'cr']:
+        if target_feature not in tracks:
+            continue
+        track = tracks[target_feature]
+        x1, y1, x2, y2 = [int(v*ds) for v in track['box'][im_count]]
+        elp = [ds*float(v) for v in track['ellipse'][im_count]]
+        ellipse_params_disp = tuple((tuple(elp[0:2]), tuple(elp[2:4]), elp[4]))
+        box_color, elp_color, flag_color = feature_colors[target_feature]
+        cv2.rectangle(im_disp,(x1,y1),(x2,y2),box_color,1)
+        if track['flag_event'][im_count] == 0:
+            cv2.ellipse(im_disp, ellipse_params_disp,elp_color,1)
+        else:
+            cv2.ellipse(im_disp, ellipse_params_disp,flag_color,1)
+    cv2.imwrite(os.path.join(output_dir,im_list[im_count]), im_disp)
+
+def write_annotated_frames(im_src, im_list, tracks, output_dir, downsample_factor=None, n_threads=4):
+    '''
+    Draws restriction box + ellipse fit of each tracked feature on each frame, saved to output_dir.
+    '''
+    pool = ThreadPool(n_threads)
+    try:
+        pool.map(partial(write_annotated_frame, im_src=im_src, im_list=im_list, tracks=tracks, 
+                         output_dir=output_dir, downsample_factor=downsample_factor), 
+                 range(len(im_list)), chunksize=100)
+    finally:
+        pool.close()
+        pool.join()
+
 
 def get_interp_ind(idx, interp_sites, step):
     redo = 0
@@ -317,6 +501,11 @@ def extract_options(options):
 
     parser.add_option('-t', '--timefilt', action='store', dest='time_filt_size', default=5, help='Size of median filter to smooth signals over time(integer)')
 
+    parser.add_option('-n', '--nproc', action='store', dest='n_processes', default=1, help='N processes for tracking features (pupil, cr) in parallel [default: 1]')
+    parser.add_option('--nthreads', action='store', dest='n_threads', default=4, help='N threads for reading frames (and writing annotated frames) [default: 4]')
+
+    parser.add_option('--pack', action='store_true', dest='pack_frames', default=False, help='Pack frames + times into single eye_frames.h5 (if not done), and read frames from it')
+
     parser.add_option('-b', '--baseline', action='store', dest='baseline', default=1, help='Length of baseline period (secs) for trial parsing')
 
     parser.add_option('--default', action='store_true', dest='default', default='store_false', help="Use all DEFAULT params, for params not specified by user (prevent interactive)")
@@ -354,6 +543,9 @@ def process_data(options):
     if time_filt_size is not None:
         time_filt_size = int(time_filt_size)
 
+    n_processes = int(options.n_processes)
+    n_threads = int(options.n_threads)
+
     #***unpack some options***
     downsample_factor = None#hard-code,for now since it seems to alter ability to track upupil
     if downsample_factor is None:
@@ -375,6 +567,17 @@ def process_data(options):
     im_dir = os.path.join(eye_root_dir,file_folder,'frames')
     times_dir = os.path.join(eye_root_dir,file_folder,'times')
 
+    #use packed frames + times, if they exist (see pack_eye_frames.py)
+    eye_frames_fpath = get_eye_frames_path(os.path.join(eye_root_dir,file_folder))
+    if options.pack_frames:
+        pack_eye_frames(im_dir, times_dir, eye_frames_fpath)
+    if os.path.exists(eye_frames_fpath):
+        print 'Reading frames from: %s'%(eye_frames_fpath)
+        im_src = eye_frames_fpath
+        times_dir = eye_frames_fpath
+    else:
+        im_src = im_dir
+
     #paradigm details
     para_file_dir = os.path.join(run_dir,'paradigm','files')
     para_file =  [f for f in os.listdir(para_file_dir) if f.endswith('.json')][0]#assuming a single file for all tiffs in run
@@ -408,9 +611,8 @@ def process_data(options):
             os.makedirs(tmp_dir)
 
         #get relevant image list
-        im_list = [name for name in os.listdir(im_dir) if os.path.isfile(os.path.join(im_dir, name))]
-        sort_nicely(im_list)
-        im0 = cv2.imread(os.path.join(im_dir,im_list[0]))
+        im_list = get_eye_frame_list(im_src)
+        im0 = read_eye_frame(im_src, im_list, 0)
 
         #load user-specificed restriciton box
         user_rect = load_obj(os.path.join(output_file_dir,'user_restriction_box.json'))
@@ -451,169 +653,31 @@ def process_data(options):
                 cr_thresh = int(cr_thresh)
             print 'threshold value for corneal reflection: %10.4f'%(cr_thresh)
             
-            #make empty arrays
-            if 'pupil' in user_rect:
-                pupil_center_list = np.zeros((len(im_list),2))
-                pupil_axes_list = np.zeros((len(im_list),2))
-                pupil_orientation_list = np.zeros((len(im_list),))
-                pupil_flag_event = np.zeros((len(im_list),))
-            if 'cr' in user_rect:
-                cr_center_list = np.zeros((len(im_list),2))
-                cr_axes_list = np.zeros((len(im_list),2))
-                cr_orientation_list = np.zeros((len(im_list),))
-                cr_flag_event = np.zeros((len(im_list),))
-
-        for im_count in range(len(im_list)):
-            #display count
-            if im_count%1000==0:
-                print 'Processing Image %d of %d....' %(im_count,len(im_list))
-
-            #load image
-            im0 = cv2.imread(os.path.join(im_dir,im_list[im_count]))
-            im_disp = np.copy(im0)#save for drawing on, later
-            if downsample_factor is not None:
-                im0 = block_mean(im0, downsample_factor)
-            if space_filt_size is not None:
-                im0= cv2.boxFilter(im0,0, (space_filt_size, space_filt_size), normalize = 1)
-
-            if 'pupil' in user_rect:
-                #get features
-                pupil_center, pupil_axes, pupil_orientation = get_feature_info(im0, (pupil_x1,pupil_y1), (pupil_x2,pupil_y2),\
-                                                                               pupil_thresh, 'pupil')
-
-                pupil_ratio = np.true_divide(pupil_axes[0],pupil_axes[1])
-                if pupil_center[0]==0 or pupil_ratio <=.6 or pupil_ratio>(1.0/.6):#flag this frame, probably blinking
-                    pupil_flag_event[im_count] = 1
-
-
-                #draw and save to file
-                ellipse_params = tuple((pupil_center,pupil_axes,pupil_orientation))
-                if make_movie:
-                    if downsample_factor is not None:
-                        pupil_x1_disp = int(pupil_x1*downsample_factor)
-                        pupil_x2_disp = int(pupil_x2*downsample_factor)
-                        pupil_y1_disp = int(pupil_y1*downsample_factor)
-                        pupil_y2_disp = int(pupil_y2*downsample_factor) 
-
-                        ellipse_params_disp = tuple((tuple([downsample_factor*x for x in ellipse_params[0]]),tuple([downsample_factor*x for x in ellipse_params[1]]),downsample_factor*ellipse_params[2]))
-                    else:
-                        pupil_x1_disp = pupil_x1
-                        pupil_x2_disp = pupil_x2
-                        pupil_y1_disp = pupil_y1
-                        pupil_y2_disp = pupil_y2
-                        ellipse_params_disp = ellipse_params
-
-                    cv2.rectangle(im_disp,(pupil_x1_disp,pupil_y1_disp),(pupil_x2_disp,pupil_y2_disp),(0,255,255),1)
-                    if pupil_flag_event[im_count] == 0:
-                        cv2.ellipse(im_disp, ellipse_params_disp,(0,0,255),1)
-                    else:
-                        cv2.ellipse(im_disp, ellipse_params_disp,(0,255,0),1)
-
-                if pupil_flag_event[im_count] == 0:
-                     #adaptive part
-                    dummy_img = np.zeros(im0.shape)
-                    cv2.ellipse(dummy_img, ellipse_params,255,-1)
-                    dummy_img = np.mean(dummy_img,2)
-                    tmp, contours, hierarchy = cv2.findContours(dummy_img.astype('uint8'),cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-                    x,y,w,h = cv2.boundingRect(contours[0])
-                    pupil_x1 = int(x-(3*scale_factor))
-                    pupil_y1 = int(y-(3*scale_factor))
-                    pupil_x2 = int(x+w+(3*scale_factor))
-                    pupil_y2 = int(y+h+(3*scale_factor))
-
-                    #save to array
-                    pupil_center_list[im_count,:] = pupil_center
-                    pupil_axes_list[im_count,:] = pupil_axes
-                    pupil_orientation_list[im_count] = pupil_orientation
-
-                if im_count >10:    
-                    if sum(pupil_flag_event[im_count-10:im_count])>= 5:
-                        #back to beginning with latest size
-                        pupil_x1 = int(pupil_x1_orig-(10*scale_factor))
-                        pupil_y1 = int(pupil_y1_orig-(10*scale_factor))
-                        pupil_x2 = int(pupil_x2_orig+(10*scale_factor))
-                        pupil_y2 = int(pupil_y2_orig+(10*scale_factor))
-
-
-                    else:
-                        #give yourself room for error after event
-                        if pupil_flag_event[im_count-1]<1:
-                            pupil_x1 = int(pupil_x1-(5*scale_factor))
-                            pupil_y1 = int(pupil_y1-(5*scale_factor))
-                            pupil_x2 = int(pupil_x2+(5*scale_factor))
-                            pupil_y2 = int(pupil_y2+(5*scale_factor))
-
-
-            if 'cr' in user_rect:
-                #get features
-                cr_center, cr_axes, cr_orientation = get_feature_info(im0, (cr_x1,cr_y1), (cr_x2,cr_y2),\
-                                                                               cr_thresh, 'cr')
-
-                cr_ratio = np.true_divide(cr_axes[0],cr_axes[1])
-                cr_radius = np.mean(cr_axes)
-                if cr_center[0]==0 or cr_radius>=20:#flag this frame, probably blinking
-                    cr_flag_event[im_count] = 1
-
-
-                #draw and save to file
-                ellipse_params = tuple((cr_center,cr_axes,cr_orientation))
-                if make_movie:
-                    if downsample_factor is not None:
-                        cr_x1_disp = int(cr_x1*downsample_factor)
-                        cr_x2_disp = int(cr_x2*downsample_factor)
-                        cr_y1_disp = int(cr_y1*downsample_factor)
-                        cr_y2_disp = int(cr_y2*downsample_factor) 
-
-                        ellipse_params_disp = tuple((tuple([downsample_factor*x for x in ellipse_params[0]]),tuple([downsample_factor*x for x in ellipse_params[1]]),downsample_factor*ellipse_params[2]))
-                    else:
-                        cr_x1_disp = cr_x1
-                        cr_x2_disp = cr_x2
-                        cr_y1_disp = cr_y1
-                        cr_y2_disp = cr_y2
-                        ellipse_params_disp = ellipse_params
-
-                    cv2.rectangle(im_disp,(cr_x1_disp,cr_y1_disp),(cr_x2_disp,cr_y2_disp),(255,255,0),1)
-                    if cr_flag_event[im_count] == 0:
-                        cv2.ellipse(im_disp, ellipse_params_disp,(255,0,0),1)
-                    else:
-                        cv2.ellipse(im_disp, ellipse_params_disp,(0,255,0),1)
-
-                if cr_flag_event[im_count] == 0:
-                     #adaptive part
-                    dummy_img = np.zeros(im0.shape)
-                    cv2.ellipse(dummy_img, ellipse_params,255,-1)
-                    dummy_img = np.mean(dummy_img,2)
-                    tmp, contours, hierarchy = cv2.findContours(dummy_img.astype('uint8'),cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-                    x,y,w,h = cv2.boundingRect(contours[0])
-                    cr_x1 = int(x-(2*scale_factor))
-                    cr_y1 = int(y-(2*scale_factor))
-                    cr_x2 = int(x+w+(2*scale_factor))
-                    cr_y2 = int(y+h+(2*scale_factor))
-
-                    #save to array
-                    cr_center_list[im_count,:] = cr_center
-                    cr_axes_list[im_count,:] = cr_axes
-                    cr_orientation_list[im_count] = cr_orientation
-
-                if im_count >10:    
-                    if sum(cr_flag_event[im_count-10:im_count])>= 5:
-                        #back to beginning with latest size
-                        cr_x1 = int(cr_x1_orig-(4*scale_factor))
-                        cr_y1 = int(cr_y1_orig-(4*scale_factor))
-                        cr_x2 = int(cr_x2_orig+(4*scale_factor))
-                        cr_y2 = int(cr_y2_orig+(4*scale_factor))
-
-
-                    else:
-                        #give yourself room for error after event
-                        if cr_flag_event[im_count-1]<1:
-                            cr_x1 = int(cr_x1-(2*scale_factor))
-                            cr_y1 = int(cr_y1-(2*scale_factor))
-                            cr_x2 = int(cr_x2+(2*scale_factor))
-                            cr_y2 = int(cr_y2+(2*scale_factor))
-
-            if make_movie: 
-                cv2.imwrite((os.path.join(tmp_dir,im_list[im_count])), im_disp)
+        #track features across frames
+        feature_boxes = {}; feature_threshs = {}
+        if 'pupil' in user_rect:
+            feature_boxes['pupil'] = (pupil_x1_orig, pupil_y1_orig, pupil_x2_orig, pupil_y2_orig)
+            feature_threshs['pupil'] = pupil_thresh
+        if 'cr' in user_rect:
+            feature_boxes['cr'] = (cr_x1_orig, cr_y1_orig, cr_x2_orig, cr_y2_orig)
+            feature_threshs['cr'] = cr_thresh
+        tracks = track_eye_features(im_src, im_list, feature_boxes, feature_threshs, scale_factor=scale_factor,
+                                    downsample_factor=downsample_factor, space_filt_size=space_filt_size,
+                                    n_processes=n_processes, n_threads=n_threads)
+        if 'pupil' in user_rect:
+            pupil_center_list = tracks['pupil']['center']
+            pupil_axes_list = tracks['pupil']['axes']
+            pupil_orientation_list = tracks['pupil']['orientation']
+            pupil_flag_event = tracks['pupil']['flag_event']
+        if 'cr' in user_rect:
+            cr_center_list = tracks['cr']['center']
+            cr_axes_list = tracks['cr']['axes']
+            cr_orientation_list = tracks['cr']['orientation']
+            cr_flag_event = tracks['cr']['flag_event']
+
+        if make_movie: 
+            print 'Drawing features on frames for movie...'
+            write_annotated_frames(im_src, im_list, tracks, tmp_dir, downsample_factor=downsample_factor, n_threads=n_threads)
         #***get camera timestamps****
         frame_rate = get_frame_rate(times_dir)
         frame_period = 1.0/frame_rate
@@ -780,7 +844,7 @@ def process_data(options):
 
         file_grp = h5py.File(output_fn, 'w')#open file
         #save some general attributes
-        file_grp.attrs['source_dir'] = im_dir
+        file_grp.attrs['source_dir'] = im_src
         file_grp.attrs['nframes'] = len(im_list)
         file_grp.attrs['frame_rate'] = frame_rate
         file_grp.attrs['time_filter_size'] = time_filt_size
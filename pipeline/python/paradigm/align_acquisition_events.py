@@ -579,6 +579,22 @@ def load_timecourses(traceid_dir):
 
 #%%
 def group_rois_by_trial_type(traceid_dir, parsed_frames_filepath, trial_info, si_info, excluded_tiffs=[], create_new=True):
+    '''
+    Align each ROI's time courses (roi_timecourses_*.hdf5) into trials (parsed_frames_*.hdf5),
+    and save to traceid_dir/roi_trials_<tstamp>.hdf5 as:
+
+        traces/<trace_type>   (ntrials x nframes x nrois), NaN past each trial's nframes
+        labels/config         (ntrials,) stim config of each trial
+        labels/trial          (ntrials,) trial name
+        labels/aux_file_idx   (ntrials,) tif (block) idx of each trial
+        labels/stim_on_frame  (ntrials,) frame idx (in trial) of stimulus onset
+        labels/nframes        (ntrials,) n frames in each trial
+        labels/frame_idxs     (ntrials x nframes) volume idxs (in run) of each trial's frames, -1 past nframes
+        rois/roi, rois/slice, rois/idx_in_slice, rois/id_in_set   (nrois,)
+
+    Trials are sorted by config, then trial. Stim configs (with ntrials) are saved to attrs['configs'].
+    See load_roi_trials().
+    '''
 
     paradigm_dir = os.path.split(parsed_frames_filepath)[0]
     trace_hash = os.path.split(traceid_dir)[-1].split('_')[-1]
@@ -611,7 +627,7 @@ def group_rois_by_trial_type(traceid_dir, parsed_frames_filepath, trial_info, si
         configs = json.load(f)
     #configs, stimtype = get_stimulus_configs(trial_info)
 
-    # Create OUTFILE to save each ROI's time course for each trial, sorted by stimulus config
+    # Create OUTFILE to save all ROI time courses, aligned by trial and sorted by stimulus config
     t_roitrials = time.time()
     # First check if ROI_TRIALS exist -- extraction takes awhile...
     existing_roi_trial_fns = sorted([t for t in os.listdir(traceid_dir) if 'roi_trials_' in t and t.endswith('hdf5')], key=natural_keys)
@@ -622,13 +638,20 @@ def group_rois_by_trial_type(traceid_dir, parsed_frames_filepath, trial_info, si
 
         # Check file to make sure it is complete:
         roi_trials = h5py.File(roi_trials_by_stim_path, 'r')
-        if not len(roi_trials.keys()) == len(configs.keys()):
+        if is_aligned_roi_trials(roi_trials):
+            # attrs['configs'] is written last, only once all trace types are aligned:
+            found_configs = json.loads(roi_trials.attrs['configs']).keys() if 'configs' in roi_trials.attrs.keys() else []
+            timecourse_opts = roi_timecourses[roi_list[0]]['timecourse'].keys()
+            if not all(tc in roi_trials['traces'].keys() for tc in timecourse_opts):
+                found_configs = []
+        else:
+            found_configs = roi_trials.keys()
+        roi_trials.close()
+        if not len(found_configs) == len(configs.keys()):
             print "Incomplete stim-config list found in loaded roi-trials file."
-            print "Found %i out of %i stim configs." % (len(roi_trials.keys()), len(configs.keys()))
+            print "Found %i out of %i stim configs." % (len(found_configs), len(configs.keys()))
             print "Creating new...!"
-            roi_trials.close()
         else:
-            roi_trials.close()
             return roi_trials_by_stim_path
 
     # This executes only of legit roi_trials file not found--------------------
@@ -648,6 +671,9 @@ def group_rois_by_trial_type(traceid_dir, parsed_frames_filepath, trial_info, si
     roi = None; trial = None; configname = None
     try:
         print "TID %s -- Creating ROI-TRIALS file, tstamp: %s" % (trace_hash, tstamp)
+
+        # Assign trials to stim configs, and get volume idxs (in run) of each trial:
+        trial_configs = []; trial_names = []; trial_frame_idxs = []; stim_on_frames = []; aux_file_idxs = []
         for configname in sorted(configs.keys(), key=natural_keys):
             currconfig = configs[configname]
             configparams = [k for k in currconfig.keys() if not k=='filename']
@@ -657,52 +683,57 @@ def group_rois_by_trial_type(traceid_dir, parsed_frames_filepath, trial_info, si
             print "Found %i trials for current stim config." % len(curr_trials)
             configs[configname]['ntrials'] = len(curr_trials)
 
-            if configname not in roi_trials.keys():
-                config_grp = roi_trials.create_group(configname)
-                nonlist_attrs = [int, float, str, unicode]
-                for attr_key in configs[configname].keys():
-                    if type(configs[configname][attr_key]) in nonlist_attrs:
-                        config_grp.attrs[attr_key] = configs[configname][attr_key]
-                    else: # isinstance(configs[configname][attr_key], list):
-                        attr_key_x = '%s_x' % attr_key
-                        attr_key_y = '%s_y' % attr_key
-                        config_grp.attrs[attr_key_x] = configs[configname][attr_key][0]
-                        config_grp.attrs[attr_key_y] = configs[configname][attr_key][1]
-            else:
-                config_grp = roi_trials[configname]
-
-            for tidx, trial in enumerate(sorted(curr_trials, key=natural_keys)):
-                currtrial = trial # 'trial%03d' % int(tidx + 1)
-                curr_trial_volume_idxs = [vol_idxs[int(i)] for i in parsed_frames[trial]['frames_in_run']]
-
-                stim_on_frame_idx = parsed_frames[trial]['frames_in_run'].attrs['stim_on_idx']
-                stim_on_volume_idx = vol_idxs[stim_on_frame_idx]
-                trial_idxs = sorted(list(set(curr_trial_volume_idxs)))
-
-                for roi in roi_list:
-                    if roi not in config_grp.keys():
-                        roi_grp = config_grp.create_group(roi)
-                    else:
-                        roi_grp = config_grp[roi]
-
-                    if currtrial not in roi_grp.keys():
-                        trial_grp = roi_grp.create_group(currtrial)
-                        trial_grp.attrs['volume_stim_on'] = stim_on_volume_idx
-                        trial_grp.attrs['frame_idxs'] = trial_idxs
-                        trial_grp.attrs['aux_file_idx'] = parsed_frames[trial]['frames_in_run'].attrs['aux_file_idx']
-                    else:
-                        trial_grp = roi_grp[currtrial]
-
-                    timecourse_opts = roi_timecourses[roi]['timecourse'].keys()
-                    for tc in timecourse_opts:
-                        tcourse = roi_timecourses[roi]['timecourse'][tc][trial_idxs]
-                        tset = trial_grp.create_dataset(tc, tcourse.shape, tcourse.dtype)
-                        tset[...] = tcourse
-
-                    config_grp[roi].attrs['id_in_set'] = roi_timecourses[roi].attrs['id_in_set']
-                    #config_grp[roi].attrs['id_in_src'] = roi_timecourses[roi].attrs['id_in_src']
-                    config_grp[roi].attrs['idx_in_slice'] = roi_timecourses[roi].attrs['idx_in_slice']
-                    config_grp[roi].attrs['slice'] = roi_timecourses[roi].attrs['slice']
+            for trial in sorted(curr_trials, key=natural_keys):
+                frames_in_run = parsed_frames[trial]['frames_in_run']
+                trial_idxs = sorted(list(set([vol_idxs[int(i)] for i in frames_in_run[...]])))
+                stim_on_volume_idx = vol_idxs[frames_in_run.attrs['stim_on_idx']]
+
+                trial_configs.append(configname)
+                trial_names.append(trial)
+                trial_frame_idxs.append(trial_idxs)
+                stim_on_frames.append(trial_idxs.index(stim_on_volume_idx))
+                aux_file_idxs.append(frames_in_run.attrs['aux_file_idx'])
+
+        # Volume idxs of each trial (row), padded with -1 to the longest trial:
+        ntrials = len(trial_names); nrois = len(roi_list)
+        nframes = np.array([len(trial_idxs) for trial_idxs in trial_frame_idxs], dtype=int)
+        frame_idxs = np.ones((ntrials, nframes.max()), dtype=int) * -1
+        for tidx, trial_idxs in enumerate(trial_frame_idxs):
+            frame_idxs[tidx, 0:nframes[tidx]] = trial_idxs
+        in_trial = frame_idxs > -1
+
+        roi_trials.attrs['roi_timecourses'] = roi_tcourse_filepath
+        roi_trials.attrs['parsed_frames'] = parsed_frames_filepath
+
+        labels = roi_trials.create_group('labels')
+        labels.create_dataset('config', data=np.array(trial_configs, dtype='S'))
+        labels.create_dataset('trial', data=np.array(trial_names, dtype='S'))
+        labels.create_dataset('aux_file_idx', data=np.array(aux_file_idxs, dtype=int))
+        labels.create_dataset('stim_on_frame', data=np.array(stim_on_frames, dtype=int))
+        labels.create_dataset('nframes', data=nframes)
+        labels.create_dataset('frame_idxs', data=frame_idxs)
+
+        rois = roi_trials.create_group('rois')
+        rois.create_dataset('roi', data=np.array(roi_list, dtype='S'))
+        rois.create_dataset('slice', data=np.array([roi_timecourses[roi].attrs['slice'] for roi in roi_list], dtype='S'))
+        rois.create_dataset('idx_in_slice', data=np.array([roi_timecourses[roi].attrs['idx_in_slice'] for roi in roi_list]))
+        rois.create_dataset('id_in_set', data=np.array([roi_timecourses[roi].attrs['id_in_set'] for roi in roi_list]))
+
+        # 1 (trial x frame x roi) dataset per trace type, filled from 1 read of each ROI's full time course:
+        traces = roi_trials.create_group('traces')
+        timecourse_opts = roi_timecourses[roi_list[0]]['timecourse'].keys()
+        for tc in timecourse_opts:
+            tc_dtype = np.promote_types(roi_timecourses[roi_list[0]]['timecourse'][tc].dtype, np.float32)
+            tracemat = np.ones((ntrials, frame_idxs.shape[1], nrois), dtype=tc_dtype) * np.nan
+            for ridx, roi in enumerate(roi_list):
+                tcourse = roi_timecourses[roi]['timecourse'][tc][...]
+                tracemat[in_trial, ridx] = tcourse[frame_idxs[in_trial]]
+            trials_per_chunk = int(max(1, min(ntrials, 2**20 / (tracemat[0].nbytes))))
+            traces.create_dataset(tc, data=tracemat, chunks=(trials_per_chunk,) + tracemat.shape[1:])
+            print "... aligned %s traces: %s" % (tc, str(tracemat.shape))
+
+        # Written last -- marks file as complete (see check above):
+        roi_trials.attrs['configs'] = json.dumps(configs, sort_keys=True)
 
     except Exception as e:
         print "--- ERROR grouping ROI time courses by stimulus config. ---"
@@ -711,6 +742,8 @@ def group_rois_by_trial_type(traceid_dir, parsed_frames_filepath, trial_info, si
         print "-------------------------------------------------------------"
     finally:
         roi_trials.close()
+        roi_timecourses.close()
+        parsed_frames.close()
 
     # Get unique hash for current PARSED FRAMES file:
     roi_trials_hash = hash_file(roi_trials_by_stim_path, hashtype='sha1')
@@ -742,6 +775,67 @@ def group_rois_by_trial_type(traceid_dir, parsed_frames_filepath, trial_info, si
     return roi_trials_by_stim_path
 
 
+#%%
+def is_aligned_roi_trials(roi_trials):
+    # roi_trials files written before the (trial x frame x roi) format are grouped as config -> roi -> trial -> trace_type
+    return 'labels' in roi_trials.keys() and 'traces' in roi_trials.keys()
+
+def load_roi_trials(roi_trials_by_stim_path, trace_type='raw'):
+    '''
+    Load trace_type traces of all ROIs, aligned by trial, from ROI-TRIALS file (see group_rois_by_trial_type()).
+
+    Returns dict of arrays: traces, config, trial, aux_file_idx, stim_on_frame, nframes, frame_idxs,
+    roi, slice, idx_in_slice, id_in_set.
+    Older ROI-TRIALS files (config -> roi -> trial -> trace_type groups) are read into the same arrays.
+    '''
+    roi_trials = h5py.File(roi_trials_by_stim_path, 'r')
+    try:
+        if is_aligned_roi_trials(roi_trials):
+            A = dict((k, roi_trials['labels'][k][...]) for k in roi_trials['labels'].keys())
+            A.update(dict((k, roi_trials['rois'][k][...]) for k in roi_trials['rois'].keys()))
+            A['traces'] = roi_trials['traces'][trace_type][...]
+        else:
+            A = roi_trials_groups_to_arrays(roi_trials, trace_type=trace_type)
+    finally:
+        roi_trials.close()
+
+    for k in ['config', 'trial', 'roi', 'slice']:
+        A[k] = A[k].astype(str)
+
+    return A
+
+def roi_trials_groups_to_arrays(roi_trials, trace_type='raw'):
+    config_list = sorted([c for c in roi_trials.keys() if len(roi_trials[c].keys()) > 0], key=natural_keys)
+    roi_list = sorted(roi_trials[config_list[0]].keys(), key=natural_keys)
+
+    A = dict((k, []) for k in ['config', 'trial', 'aux_file_idx', 'stim_on_frame', 'nframes'])
+    trial_frame_idxs = []; trial_traces = []
+    for configname in config_list:
+        for trial in sorted(roi_trials[configname][roi_list[0]].keys(), key=natural_keys):
+            trial_grp = roi_trials[configname][roi_list[0]][trial]
+            trial_idxs = [i for i in trial_grp.attrs['frame_idxs']]
+            A['config'].append(configname)
+            A['trial'].append(trial)
+            A['aux_file_idx'].append(trial_grp.attrs['aux_file_idx'])
+            A['stim_on_frame'].append(trial_idxs.index(int(trial_grp.attrs['volume_stim_on'])))
+            A['nframes'].append(len(trial_idxs))
+            trial_frame_idxs.append(trial_idxs)
+            trial_traces.append(np.vstack([roi_trials[configname][roi][trial][trace_type][...] for roi in roi_list]).T)
+    A = dict((k, np.array(v)) for k, v in A.items())
+
+    ntrials = len(trial_traces)
+    A['frame_idxs'] = np.ones((ntrials, A['nframes'].max()), dtype=int) * -1
+    A['traces'] = np.ones((ntrials, A['nframes'].max(), len(roi_list))) * np.nan
+    for tidx in range(ntrials):
+        A['frame_idxs'][tidx, 0:A['nframes'][tidx]] = trial_frame_idxs[tidx]
+        A['traces'][tidx, 0:A['nframes'][tidx], :] = trial_traces[tidx]
+
+    A['roi'] = np.array(roi_list)
+    for attr_key in ['slice', 'idx_in_slice', 'id_in_set']:
+        A[attr_key] = np.array([roi_trials[config_list[0]][roi].attrs[attr_key] for roi in roi_list])
+
+    return A
+
 #%%
 def traces_to_trials(trial_info, si_info, configs, roi_trials_by_stim_path, trace_type='raw', eye_info=None):
     print "-------------------------------------------------------------------"
@@ -763,9 +857,9 @@ def traces_to_trials(trial_info, si_info, configs, roi_trials_by_stim_path, trac
     else:
         last_trials_in_block= []
 
-    # Load ROI list and traces:
-    roi_trials = h5py.File(roi_trials_by_stim_path, 'r')
-    roi_list = sorted(roi_trials[roi_trials.keys()[0]].keys(), key=natural_keys)
+    # Load ROI list and traces (all trials, all ROIs):
+    A = load_roi_trials(roi_trials_by_stim_path, trace_type=trace_type)
+    roi_list = list(A['roi'])
 
     # Get info for TRIAL EPOCH for alignment:
     volumerate = trial_info['volumerate'] #parsed_frames.attrs['volumerate']
@@ -777,17 +871,18 @@ def traces_to_trials(trial_info, si_info, configs, roi_trials_by_stim_path, trac
     iti_dur = trial_info['iti_full'] #trialdict['trial00001']['iti_dur_ms']/1E3
     tpoints = [int(i) for i in np.arange(-1*iti_pre, stim_dur+iti_dur)]
 
-    config_list = sorted(roi_trials.keys(), key=natural_keys)
+    config_list = sorted(list(set(A['config'])), key=natural_keys)
     try:
-        for roi in roi_list:
+        for ridx, roi in enumerate(roi_list):
             roi_dfs = []
             bad_trials = []
             for configname in sorted(config_list, key=natural_keys): #sorted(ROIs.keys(), key=natural_key):
 
-                curr_slice = roi_trials[configname][roi].attrs['slice']
-                roi_in_slice = roi_trials[configname][roi].attrs['idx_in_slice']
-                stim_trials = sorted([t for t in roi_trials[configname][roi].keys()], key=natural_keys)
-                nvols = max([roi_trials[configname][roi][t][trace_type].shape[0] for t in stim_trials])
+                curr_slice = A['slice'][ridx]
+                roi_in_slice = A['idx_in_slice'][ridx]
+                stim_ixs = np.where(A['config'] == configname)[0]  # sorted by trial
+                stim_trials = list(A['trial'][stim_ixs])
+                nvols = A['nframes'][stim_ixs].max()
                 ntrials = len(stim_trials)
 
                 # initialize TRIALMAT: each row is a trial, each column is a frame of that trial
@@ -797,7 +892,7 @@ def traces_to_trials(trial_info, si_info, configs, roi_trials_by_stim_path, trac
 
                 # Identify the first frame (across all trials) that the stimulus comes on --
                 # This frame is the one we will align all other trials to.
-                first_on = int(min([[i for i in roi_trials[configname][roi][t].attrs['frame_idxs']].index(roi_trials[configname][roi][t].attrs['volume_stim_on']) for t in stim_trials]))
+                first_on = int(A['stim_on_frame'][stim_ixs].min())
 
                 #tsecs = (np.arange(0, nvols) - first_on ) / volumerate  # Using volumerate, since assuming we look at 1 roi on 1 slice
                 sidx = int(curr_slice[5:]) - 1 # Get slice index
@@ -873,12 +968,13 @@ def traces_to_trials(trial_info, si_info, configs, roi_trials_by_stim_path, trac
                         morphlevel = -1
                         
 
-                for tidx, trial in enumerate(sorted(stim_trials, key=natural_keys)): #[15:25]):
+                for tidx, (trial, trial_ix) in enumerate(zip(stim_trials, stim_ixs)): #[15:25]):
                     if trial in last_trials_in_block:
                         continue
                     
-                    frame_idxs = roi_trials[configname][roi][trial].attrs['frame_idxs']
-                    adj_frame_idxs = frame_idxs - roi_trials[configname][roi][trial].attrs['aux_file_idx'] * len(all_frame_idxs)
+                    aux_file_idx = A['aux_file_idx'][trial_ix]
+                    frame_idxs = A['frame_idxs'][trial_ix, 0:A['nframes'][trial_ix]]
+                    adj_frame_idxs = frame_idxs - aux_file_idx * len(all_frame_idxs)
 
                     # Check if last calculated frame is actually not included (can happend at end of .tif file):
                     if adj_frame_idxs[-1] > len(all_frame_idxs):
@@ -895,17 +991,17 @@ def traces_to_trials(trial_info, si_info, configs, roi_trials_by_stim_path, trac
                     tsecs = all_frame_idxs[adj_frame_idxs] - all_frame_idxs[adj_frame_idxs][first_on]
                     if not (round(tsecs[0]) == -1*iti_pre and round(tsecs[-1]) == (stim_dur+iti_post)):
                         print "Bad trial indices found!", roi, configname, trial
-                        print "Aux file idx:", roi_trials[configname][roi][trial].attrs['aux_file_idx']
+                        print "Aux file idx:", aux_file_idx
                         print "tsecs:", tsecs
-                        bad_trials.append((configname, trial, roi_trials[configname][roi][trial].attrs['aux_file_idx']))
+                        bad_trials.append((configname, trial, aux_file_idx))
                         continue
                         
 
                     # Get raw (or other specified) timecourse for current trial:
-                    trial_timecourse = roi_trials[configname][roi][trial][trace_type]
+                    trial_timecourse = A['traces'][trial_ix, 0:A['nframes'][trial_ix], ridx]
 
                     # Identify the frame index within the current trial that the stimulus comes on:
-                    curr_on = int([i for i in roi_trials[configname][roi][trial].attrs['frame_idxs']].index(int(roi_trials[configname][roi][trial].attrs['volume_stim_on'])))
+                    curr_on = int(A['stim_on_frame'][trial_ix])
 
                     # Align current trial frames to the "stim onset" point:
                     trialmat[tidx, first_on:first_on+len(trial_timecourse[curr_on:])] = trial_timecourse[curr_on:]
@@ -16,6 +16,7 @@ import math
 import random
 import itertools
 import copy
+from functools import partial
 import scipy.io
 import optparse
 import pprint
@@ -39,7 +40,7 @@ from statsmodels.nonparametric.smoothers_lowess import lowess
 from skimage import exposure
 from collections import Counter
 ##
-from pipeline.python.utils import natural_keys, replace_root, print_elapsed_time
+from pipeline.python.utils import natural_keys, replace_root, print_elapsed_time, load_maskarray
 #
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from pipeline.python.utils import get_frame_info
@@ -905,7 +906,7 @@ def get_smoothed_run(traceid_dir, trace_type='processed', dff=False, frac=0.01,
     
 
 #%%
-def get_processed_run(traceid_dir, quantile=0.20, window_size_sec=None, create_new=False, fmt='hdf5', user_test=False, nonnegative=False):
+def get_processed_run(traceid_dir, quantile=0.20, window_size_sec=None, create_new=False, fmt='hdf5', user_test=False, nonnegative=False, n_processes=1):
     
     xdata_df=None; labels_df=None; F0_df=None;
     # Set up paths to look for saved dataframes:
@@ -924,7 +925,7 @@ def get_processed_run(traceid_dir, quantile=0.20, window_size_sec=None, create_n
     n_src_dataframes = len([r for r in os.listdir(trace_arrays_dir) if 'File' in r and r.endswith(fmt)])
     if not n_orig_tiffs == n_src_dataframes or create_new is True:
         print "Extracting PROCESSED trace arrays from .tif files."
-        process_trace_arrays(traceid_dir, window_size_sec=window_size_sec, quantile=quantile, fmt=fmt, user_test=user_test, nonnegative=nonnegative)
+        process_trace_arrays(traceid_dir, window_size_sec=window_size_sec, quantile=quantile, fmt=fmt, user_test=user_test, nonnegative=nonnegative, n_processes=n_processes)
         
     if not create_new:
         try:
@@ -970,7 +971,7 @@ def test_drift_correction(raw_df, F0_df, corrected_df, nframes_to_show, test_roi
     pl.pause(0.001)
 
 def process_trace_arrays(traceid_dir, window_size_sec=None, quantile=0.08, create_new=False, 
-                             fmt='pkl', user_test=False, test_roi='roi00001', nonnegative=False):
+                             fmt='pkl', user_test=False, test_roi='roi00001', nonnegative=False, n_processes=1):
     '''
     Calculate F0 for each ROI by .tif file (continuous time points). These
     trace "chunks" can later be parsed and combined into a dataframe for trial
@@ -978,6 +979,8 @@ def process_trace_arrays(traceid_dir, window_size_sec=None, quantile=0.08, creat
     on/off (i.e., a literal 'acquisition' in SI).
     
     If window_size_sec unspecified, then default is to use 3 trials for window size.
+    
+    n_processes : N processes to split ROIs across for the rolling F0 (see rolling_quantile_array()).
     '''
     
     # Create fig dir to save example traces of drift-correction:
@@ -1053,7 +1056,7 @@ def process_trace_arrays(traceid_dir, window_size_sec=None, quantile=0.08, creat
         if user_test:
             while True:
                 print "Selected %i sec to use for calculating rolling %.3f percentile..." % (window_size_sec, quantile)
-                corrected_df, F0_df = get_rolling_baseline(raw_df, window_size_sec*framerate, quantile=quantile)
+                corrected_df, F0_df = get_rolling_baseline(raw_df, window_size_sec*framerate, quantile=quantile, n_processes=n_processes)
                 nframes_to_show = int(round(window_size_sec*framerate*10))
                 pl.figure()
                 pl.ion()
@@ -1076,7 +1079,7 @@ def process_trace_arrays(traceid_dir, window_size_sec=None, quantile=0.08, creat
                     quantile = float(quantile_sel)
                     pl.close()
         else:
-            corrected_df, F0_df = get_rolling_baseline(raw_df, window_size_sec*framerate, quantile=quantile)
+            corrected_df, F0_df = get_rolling_baseline(raw_df, window_size_sec*framerate, quantile=quantile, n_processes=n_processes)
             print "Showing initial drift correction (quantile: %.2f)" % quantile
             print "Min value for all ROIs:", np.min(np.min(corrected_df, axis=0))
 
@@ -1128,14 +1131,15 @@ def process_trace_arrays(traceid_dir, window_size_sec=None, quantile=0.08, creat
     
 
     
-def get_rolling_baseline(Xdf, window_size, quantile=0.08):
+def get_rolling_baseline(Xdf, window_size, quantile=0.08, n_processes=1, step=1):
         
     #window_size_sec = (nframes_trial/framerate) * 2 # decay_constant * 40
     #decay_frames = window_size_sec * framerate # decay_constant in frames
     #window_size = int(round(decay_frames))
     #quantile = 0.08
     window_size = int(round(window_size))
-    Fsmooth = Xdf.apply(rolling_quantile, args=(window_size, quantile))
+    F0 = rolling_quantile_array(Xdf.values, window_size, quantile, n_processes=n_processes, step=step)
+    Fsmooth = pd.DataFrame(F0, index=Xdf.index, columns=Xdf.columns)
     offset = Fsmooth.mean().mean()
     print("drift offset:", offset)
     Xdata = (Xdf - Fsmooth) #+ offset
@@ -1144,6 +1148,81 @@ def get_rolling_baseline(Xdf, window_size, quantile=0.08):
     return Xdata, Fsmooth
 
 
+def init_baseline_worker(terminating_, signal_):
+    # Places the padded signal array in the global namespace of the worker subprocesses,
+    # so each worker reads its block of ROIs from it instead of getting a pickled copy.
+    global terminating, padded_signal
+    terminating = terminating_
+    padded_signal = signal_
+
+def _windowed_quantile_block(col_ixs, wing=None, quantile=None, step=1):
+    if terminating.is_set():
+        return None
+    return windowed_quantile(padded_signal[:, col_ixs[0]:col_ixs[1]], wing, quantile, step=step)
+
+def windowed_quantile(signal, wing, quantile, step=1):
+    """Quantile (0--1) over the full window (2*wing + 1) centered on each non-padded frame.
+
+    `signal` is (nframes + 2*wing) x nrois, i.e., already padded with _pad_array().
+    step > 1 evaluates the window quantile every <step> frames only (plus the last frame),
+    and linearly interpolates F0 in between.
+    """
+    window_size = 2 * wing + 1
+    if step <= 1:
+        rolled = pd.DataFrame(signal).rolling(window_size, 2, center=True).quantile(quantile)
+        return rolled.values[wing:-wing]
+
+    signal = np.ascontiguousarray(signal)
+    nframes, nrois = signal.shape[0] - 2 * wing, signal.shape[1]
+    centers = np.unique(np.r_[np.arange(0, nframes, step), nframes - 1])
+    windows = np.lib.stride_tricks.as_strided(signal, shape=(nframes, window_size, nrois),
+                                              strides=(signal.strides[0], signal.strides[0], signal.strides[1]))
+    block_size = max(1, int(1E7 // (window_size * nrois)))
+    F0_centers = np.vstack([np.percentile(windows[centers[i:i+block_size]], quantile * 100, axis=1) \
+                            for i in range(0, len(centers), block_size)])
+    if len(centers) < 2:
+        return F0_centers
+
+    frames = np.arange(0, nframes)
+    ixs = np.clip(np.searchsorted(centers, frames, side='right') - 1, 0, len(centers) - 2)
+    frac = (frames - centers[ixs]) / np.asarray(centers[ixs + 1] - centers[ixs], dtype=float)
+    return F0_centers[ixs] + (F0_centers[ixs + 1] - F0_centers[ixs]) * frac[:, np.newaxis]
+
+def rolling_quantile_array(X, width, quantile, n_processes=1, step=1):
+    """Rolling quantile (0--1) with mirrored edges, for all columns (ROIs) of X (nframes x nrois).
+
+    Same as rolling_quantile() on each column, but padding/windowing is done once on the 2D array.
+    n_processes > 1 splits ROIs into blocks, one per process.
+    step > 1 gives an approximate F0, interpolated between windows every <step> frames (see windowed_quantile()).
+    """
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, np.newaxis]
+    nrois = X.shape[1]
+    wing = _width2wing(width, X[:, 0])
+    signal = _pad_array(X, wing)
+
+    if n_processes > 1 and nrois > 1:
+        block_size = int(math.ceil(nrois / float(n_processes)))
+        blocks = [(i, min(i + block_size, nrois)) for i in range(0, nrois, block_size)]
+        terminating = mp.Event()
+        pool = mp.Pool(processes=len(blocks), initializer=init_baseline_worker, initargs=(terminating, signal))
+        try:
+            results = pool.map(partial(_windowed_quantile_block, wing=wing, quantile=quantile, step=step), blocks)
+        except KeyboardInterrupt:
+            terminating.set()
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        F0 = np.hstack(results)
+    else:
+        F0 = windowed_quantile(signal, wing, quantile, step=step)
+
+    return F0
+
+
 # Use cnvlib.smoothing functions to deal get mirrored edges on rolling quantile:
 def rolling_quantile(x, width, quantile):
     """Rolling quantile (0--1) with mirrored edges."""
@@ -2506,7 +2585,7 @@ def sort_rois_2D(traceid_dir):
     # Load masks and reshape to 2D:
     if ref_file not in maskfile.keys():
         ref_file = maskfile.keys()[0]
-    masks = np.array(maskfile[ref_file]['Slice01']['maskarray'])
+    masks = load_maskarray(maskfile[ref_file]['Slice01'], 'maskarray')
     dims = maskfile[ref_file]['Slice01']['zproj'].shape
     masks_r = np.reshape(masks, (dims[0], dims[1], masks.shape[-1]))
     print "Masks: (%i, %i), % rois." % (masks_r.shape[0], masks_r.shape[1], masks_r.shape[-1])
@@ -20,8 +20,28 @@ import pylab as pl
 import tifffile as tf
 import multiprocessing as mp
 from scipy.ndimage import zoom
+from pipeline.python.utils import zproj_tiff_pages, get_tiff_dims
+
+
+def get_downsampled_std_image(tf_path, nchannels, channel, downsample_factor=(0.1, 1, 1), order=1):
+    '''
+    STD image of channel's frames in tf_path, after zoom(frames, downsample_factor, order=order).
+    Frames are streamed from the tiff (1 read), see utils.zproj_tiff_pages().
+    '''
+    npages, d1, d2 = get_tiff_dims(tf_path)
+    print "orig tif shape: %s" % str((npages, d1, d2))
+    if nchannels==2:
+        if channel=='Channel02':
+            ch_pages = np.arange(1, npages, nchannels)
+        else:
+            ch_pages = np.arange(0, npages, nchannels)
+    else:
+        ch_pages = np.arange(0, npages)
+    zproj = zproj_tiff_pages(tf_path, {channel: ch_pages}, zproj_types=['std'],
+                             downsample_factor=downsample_factor, order=order)
+
+    return zproj[channel]['std']
 
-    
 def get_downsampled_std_images(run_dir, downsample_factor=(0.1, 1, 1), interpolation='bilinear',
                                pid='processed001', channel='Channel01'):
     print "RUN:", run_dir 
@@ -55,25 +75,14 @@ def get_downsampled_std_images(run_dir, downsample_factor=(0.1, 1, 1), interpola
         else:
             fn_append = str(re.search('Slice(\d{2})_Channel(\d{2})_File(\d{3})', tf_path).group(0))
         if not os.path.exists(write_dir): os.makedirs(write_dir)
-        tif_tmp = tf.imread(tf_path)
-        print "orig tif shape: %s" % str(tif_tmp.shape)
-        if nchannels==2:
-            if channel=='Channel02':
-                tif = tif_tmp[1::nchannels, :, :]
-            else:
-                tif = tif_tmp[0::nchannels, :, :]
-        else:
-            tif = copy.copy(tif_tmp)
-        print fn_append, tif.shape, tif.dtype
         if interpolation == 'bilinear':
             order = 1
         elif interpolation == 'cubic':
             order = 3
         elif interpolation == 'nearest':
             order = 0
-        tif_r = zoom(tif, downsample_factor, order=order)
-        std_img = np.empty((tif_r.shape[1], tif_r.shape[2]), dtype=tif_r.dtype)
-        std_img[:] = np.std(tif_r, axis=0)
+        std_img = get_downsampled_std_image(tf_path, nchannels, channel, downsample_factor=downsample_factor, order=order)
+        print fn_append, std_img.shape, std_img.dtype
         tf.imsave(os.path.join(write_dir, 'std_%s.tif' % fn_append), std_img)
 
        # tf.imsave(os.path.join(write_dir, 'std_%s.tif' % fn_append), tif_r)
@@ -122,27 +131,10 @@ def get_downsampled_std_images_mp(run_dir, downsample_factor=(0.1, 1, 1), interp
             else:
                 fn_append = str(re.search('Slice(\d{2})_Channel(\d{2})_File(\d{3})', tf_path).group(0))
             if not os.path.exists(write_dir): os.makedirs(write_dir)
-            tif_tmp = tf.imread(tf_path)
-            print "orig shape: %s" % str(tif_tmp.shape)
-            if nchannels==2:
-                if channel=='Channel02':
-                    tif = tif_tmp[1::nchannels, :, :]
-                else:
-                    tif = tif_tmp[0::nchannels, :, :]
-            else:
-                tif = copy.copy(tif_tmp)
-            print "... new tif: %s" % str(tif.shape)
-#
-#            fn_append = str(re.search('Slice(\d{2})_Channel(\d{2})_File(\d{3})', tf_path).group(0))
-#            if not os.path.exists(write_dir): os.makedirs(write_dir)
-#            tif = tf.imread(tf_path)
-            #print fn_append, tif.shape
-            tif_r = zoom(tif, downsample_factor, order=order)
-            std_img = np.empty((tif_r.shape[1], tif_r.shape[2]), dtype=tif_r.dtype)
-            std_img[:] = np.std(tif_r, axis=0)
+            std_img = get_downsampled_std_image(tf_path, nchannels, channel, downsample_factor=downsample_factor, order=order)
             tf.imsave(os.path.join(write_dir, 'std_%s.tif' % fn_append), std_img)
             outdict[fn_append] = write_dir
-            print 'Done:', fn_append, tif.shape
+            print 'Done:', fn_append, std_img.shape
 
             
         out_q.put(outdict)
@@ -13,15 +13,16 @@ import optparse
 import json
 import re
 import logging
+import traceback
+import multiprocessing as mp
 import scipy.io
 import numpy as np
 import matplotlib as mpl
 mpl.use('TKAgg')
 
-from checksumdir import dirhash
 import copy
 from pipeline.python.set_pid_params import get_default_pid, write_hash_readonly, append_hash_to_paths
-from pipeline.python.utils import write_dict_to_json, isreadonly# , get_image_description_SI
+from pipeline.python.utils import write_dict_to_json, isreadonly, dirhash, get_dir_digests # , get_image_description_SI
 
 from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWRITE, S_IWGRP, S_IWOTH
 #from caiman.utils import utils
@@ -77,6 +78,17 @@ def val_parse(v):
         v: python object
     """
 
+    # Most per-frame values are plain numbers, skip eval() for those:
+    try:
+        return int(v)
+    except ValueError:
+        pass
+    try:
+        if v.lower() not in ['nan', '-nan']:
+            return float(v)
+    except ValueError:
+        pass
+
     try:
         return eval(v)
     except:
@@ -180,6 +192,77 @@ def format_si_value(value):
             return value
 
 
+def parse_si_metadata(metadata):
+    '''
+    Turn the SI. lines of a ScanImage metadata (header) string into nested dicts, e.g. SI.hRoiManager.linesPerFrame.
+    '''
+    SI_struct = {}
+    for item in metadata.splitlines():
+        if 'SI.' not in item:
+            continue
+        t = SI_struct
+        fieldname = item.split(' = ')[0] #print fieldname
+        fvalue = item.split(' = ')[1]
+        value = format_si_value(fvalue)
+
+        for ix,part in enumerate(fieldname.split('.')):
+            nsubfields = len(fieldname.split('.'))
+            if ix==nsubfields-1:
+                t.setdefault(part, value)
+            else:
+                t = t.setdefault(part, {})
+
+    return SI_struct
+
+def init_si_worker(terminating_, path_to_si_reader_):
+    # As initializer(), and also puts the path to ScanImageTiffReader in the worker's global namespace.
+    global terminating, path_to_si_reader
+    terminating = terminating_
+    path_to_si_reader = path_to_si_reader_
+
+def extract_si_file(tiffpath):
+    '''
+    SI header (as nested dicts) and parsed image descriptions of each frame, for 1 raw tiff.
+    '''
+    if terminating.is_set():
+        return None
+    if path_to_si_reader not in sys.path:
+        sys.path.append(path_to_si_reader)
+    from ScanImageTiffReader import ScanImageTiffReader
+
+    # Make sure TIFF is READ ONLY:
+    if not isreadonly(tiffpath):
+        os.chmod(tiffpath, S_IREAD|S_IRGRP|S_IROTH)
+
+    SI_struct = parse_si_metadata(ScanImageTiffReader(tiffpath).metadata())
+    imgdescr = get_image_description_SI(tiffpath)
+
+    return {'SI': SI_struct.get('SI', None), 'imgdescr': imgdescr}
+
+def extract_si_metadata(tiffpaths, path_to_si_reader, n_processes=1):
+    '''
+    Returns list of {'SI': ..., 'imgdescr': ...} for each tiff in tiffpaths (extracted in parallel).
+    '''
+    terminating = mp.Event()
+    pool = mp.Pool(initializer=init_si_worker, initargs=(terminating, path_to_si_reader),
+                   processes=max(1, min(n_processes, len(tiffpaths))))
+    results = None
+    try:
+        results = pool.map_async(extract_si_file, tiffpaths).get(999999)
+    except KeyboardInterrupt:
+        terminating.set()
+        print "**interupt"
+        pool.terminate()
+        print "***Terminating!"
+    except Exception as e:
+        traceback.print_exc()
+        pool.terminate()
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
 def extract_options(options):
     parser = optparse.OptionParser()
 
@@ -193,6 +276,7 @@ def extract_options(options):
     parser.add_option('--slurm', action='store_true', dest='slurm', default=False, help='flag to use SLURM default opts')
    
     parser.add_option('--rerun', action='store_false', dest='new_acquisition', default=True, help="set if re-running to get metadata for previously-processed acquisition")
+    parser.add_option('-n', '--nprocs', action='store', dest='nprocs', default=4, help="n processes for extracting metadata from tiffs [default: 4]")
 
 
     (options, args) = parser.parse_args(options) 
@@ -258,28 +342,36 @@ def get_meta(options):
     print "Raw Tiff hash:", rawtiff_dir
     # ======================================================================
 
-    # Check if metadata already extracted:
-    raw_simeta_json = '%s.json' % raw_simeta_basename
-    if os.path.isfile(os.path.join(rawtiff_dir, raw_simeta_json)):
-        with open(os.path.join(rawtiff_dir, raw_simeta_json), 'r') as f:
-            scanimage_metadata = json.load(f)
-        file_keys = [k for k in scanimage_metadata.keys() if 'File' in k]
-        incompletes = [f for f in file_keys if 'SI' not in scanimage_metadata[f].keys() or 'imgdescr' not in scanimage_metadata[f].keys()]
-        if len(incompletes) > 0:
-            extract_si = True
-        else:
-            extract_si = False
-    else:
-        extract_si = True
-    
     # Get SIMETA, if need:
     rawtiffs = sorted([t for t in os.listdir(rawtiff_dir) if t.endswith('.tif')], key=natural_keys)
     nontiffs = sorted([t for t in os.listdir(rawtiff_dir) if t not in rawtiffs], key=natural_keys)
     print rawtiffs
+
+    # Check if metadata already extracted -- per-file entries are reused if complete and file size/mtime are unchanged
+    # (entries saved without 'filestat' are reused if complete):
+    raw_simeta_json = '%s.json' % raw_simeta_basename
+    if os.path.isfile(os.path.join(rawtiff_dir, raw_simeta_json)):
+        with open(os.path.join(rawtiff_dir, raw_simeta_json), 'r') as f:
+            prev_simeta = json.load(f)
+    else:
+        prev_simeta = {}
+    file_stats = dict((rawtiff, [os.stat(os.path.join(rawtiff_dir, rawtiff)).st_size,
+                                 os.stat(os.path.join(rawtiff_dir, rawtiff)).st_mtime]) for rawtiff in rawtiffs)
+
+    to_extract = []
+    for fidx, rawtiff in enumerate(rawtiffs):
+        curr_file = 'File{:03d}'.format(fidx+1)
+        prev = prev_simeta.get(curr_file, {})
+        complete = 'SI' in prev.keys() and 'imgdescr' in prev.keys()
+        if not complete or prev.get('filestat', file_stats[rawtiff]) != file_stats[rawtiff]:
+            to_extract.append(curr_file)
+    extract_si = len(to_extract) > 0 or len(prev_simeta) == 0 or prev_simeta.get('filenames') != rawtiffs
     
-    if extract_si is True:
+    if extract_si is False:
+        scanimage_metadata = prev_simeta
+    else:
         print "================================================="
-        print "Extracting SI metadata from raw tiffs."
+        print "Extracting SI metadata from %i of %i raw tiffs." % (len(to_extract), len(rawtiffs))
         print "================================================="
         # Extract and parse SI metadata:
         scanimage_metadata = dict()
@@ -288,54 +380,26 @@ def get_meta(options):
         scanimage_metadata['acquisition'] = acquisition
         scanimage_metadata['run'] = run
 
-        for fidx,rawtiff in enumerate(sorted(rawtiffs, key=natural_keys)):
-
-            curr_file = 'File{:03d}'.format(fidx+1)
-            print "Processing:", curr_file
-
-            currtiffpath = os.path.join(rawtiff_dir, rawtiff)
-
-            # Make sure TIFF is READ ONLY:
-            if not isreadonly(currtiffpath):
-                os.chmod(currtiffpath, S_IREAD|S_IRGRP|S_IROTH)  
+        extracted = extract_si_metadata([os.path.join(rawtiff_dir, rawtiffs[int(f[4:])-1]) for f in to_extract],
+                                        path_to_si_reader, n_processes=int(options.nprocs))
+        assert extracted is not None and all([e is not None for e in extracted]), "Failed to extract SI metadata."
+        extracted = dict((curr_file, simeta) for curr_file, simeta in zip(to_extract, extracted))
 
-            scanimage_metadata[curr_file] = {'SI': None}
-
-            metadata = ScanImageTiffReader(currtiffpath).metadata()
-            meta = metadata.splitlines()
-            del metadata
-
-            # descs = ScanImageTiffReader(os.path.join(acquisition_dir, rawtiff)).descriptions()
-            # vol=ScanImageTiffReader("my.tif").data();
-
-            # Get ScanImage metadata:
-            SI = [l for l in meta if 'SI.' in l]
-            del meta
-
-            # Iterate through list of SI. strings and turn into dict:
-            SI_struct = {}
-            for item in SI:
-                t = SI_struct
-                fieldname = item.split(' = ')[0] #print fieldname
-                fvalue = item.split(' = ')[1]
-                value = format_si_value(fvalue)
-
-                for ix,part in enumerate(fieldname.split('.')):
-                    nsubfields = len(fieldname.split('.'))
-                    if ix==nsubfields-1:
-                        t.setdefault(part, value)
-                    else:
-                        t = t.setdefault(part, {})
-
-            # Get img descriptions for each frame:
-            imgdescr = get_image_description_SI(currtiffpath)
+        # Hash only the re-extracted tiffs (cached in raw dir's hash manifest):
+        extracted_tiffs = [rawtiffs[int(f[4:])-1] for f in to_extract]
+        file_hashes = get_dir_digests(rawtiff_dir, hashtype='sha1', 
+                                      excluded_files=nontiffs + [t for t in rawtiffs if t not in extracted_tiffs])
 
+        for fidx,rawtiff in enumerate(sorted(rawtiffs, key=natural_keys)):
+            curr_file = 'File{:03d}'.format(fidx+1)
+            if curr_file in extracted.keys():
+                print "Processed:", curr_file
+                scanimage_metadata[curr_file] = extracted[curr_file]
+                scanimage_metadata[curr_file]['filehash'] = file_hashes[rawtiff]
+            else:
+                scanimage_metadata[curr_file] = prev_simeta[curr_file]
+            scanimage_metadata[curr_file]['filestat'] = file_stats[rawtiff]
             scanimage_metadata['filenames'].append(rawtiff)
-            if 'SI' not in SI_struct.keys():
-                scanimage_metadata[curr_file]['SI'] = None   
-            else: 
-                scanimage_metadata[curr_file]['SI'] = SI_struct['SI']
-            scanimage_metadata[curr_file]['imgdescr'] = imgdescr
 
         file_keys = [f for f in scanimage_metadata.keys() if 'File0' in f]
         print "SI files:", file_keys
@@ -14,11 +14,12 @@ import tifffile as tf
 import pylab as pl
 import numpy as np
 from scipy import ndimage
+import scipy.sparse
 import cv2
 import glob
 from pipeline.python.paradigm import process_mw_files as mw
 
-from pipeline.python.utils import natural_keys, replace_root
+from pipeline.python.utils import natural_keys, replace_root, load_maskarray
 #from pipeline.python.retinotopy.visualize_rois import roi_retinotopy
 from pipeline.python.traces import get_traces as traces
 from pipeline.python.traces import remake_neuropil_masks as rmasks
@@ -140,99 +141,90 @@ def get_processed_stack(tiff_path_full,RETINOID, slicenum=0):
     return stack1
             
 def process_array(roi_trace, RETINOID, stack_info):
-    
+    '''
+    Detrend (subtract rolling mean) and temporally smooth all traces (rows of roi_trace) at once.
+    Both are boxcar filters along time, with traces padded by their 1st/last values at the edges.
+    '''
     frame_rate = stack_info['frame_rate']
     stimfreq = stack_info['stimfreq']
+    roi_trace = roi_trace.astype(float)
     #hard-code for now, in the future, get from mworks file
     if RETINOID['PARAMS']['minus_rolling_mean']:
         print('Removing rolling mean from traces...')
-        detrend_roi_trace = np.zeros(roi_trace.shape)
-
         windowsz = int(np.ceil((np.true_divide(1,stimfreq)*3)*frame_rate))
 
-        for roi in range(roi_trace.shape[0]):
-            tmp0=roi_trace[roi,:];
-            tmp1=np.concatenate((np.ones(windowsz)*tmp0[0], tmp0, np.ones(windowsz)*tmp0[-1]),0)
-
-            rolling_mean=np.convolve(tmp1, np.ones(windowsz)/windowsz, 'same')
-            rolling_mean=rolling_mean[windowsz:-windowsz]
-
-            detrend_roi_trace[roi,:]=np.subtract(tmp0,rolling_mean)
-        roi_trace = detrend_roi_trace
-        del detrend_roi_trace
+        rolling_mean = ndimage.uniform_filter1d(roi_trace, windowsz, axis=1, mode='nearest')
+        roi_trace = roi_trace - rolling_mean
+        del rolling_mean
 
     if RETINOID['PARAMS']['average_frames'] is not None:
         print('Performing temporal smoothing on traces...')
-        smooth_roi_trace = np.zeros(roi_trace.shape)
-
         windowsz = int(RETINOID['PARAMS']['average_frames'])
 
-        for roi in range(roi_trace.shape[0]):
-            tmp0=roi_trace[roi,:];
-            tmp1=np.concatenate((np.ones(windowsz)*tmp0[0], tmp0, np.ones(windowsz)*tmp0[-1]),0)
-
-            tmp2=np.convolve(tmp1, np.ones(windowsz)/windowsz, 'same')
-            tmp2=tmp2[windowsz:-windowsz]
-
-            smooth_roi_trace[roi,:]=tmp2
-        roi_trace = smooth_roi_trace
-        del smooth_roi_trace
+        roi_trace = ndimage.uniform_filter1d(roi_trace, windowsz, axis=1, mode='nearest')
 
     return roi_trace
 
-def do_regression(t,phi,roi_trace,npixels,tpoints,roi_type,signal_fit_idx):
+def do_regression(t,phi,roi_trace,npixels,tpoints,roi_type,signal_fit_idx,chunk_size=10000):
+	'''
+	Least-squares fit of y = beta*cos(t + phi) for each pixel/roi (rows of roi_trace), in closed form:
+	beta = <x,y>/<x,x> (pinv of a single-column design matrix). Pixels are done in blocks of chunk_size.
+	'''
 	print('Doing regression')
 	#doing regression to get amplitude and variance expained
-	t=np.transpose(np.expand_dims(t,1))
-	tmatrix=np.tile(t,(npixels,1))
-
-	phimatrix=np.tile(phi,(1,tpoints))
-	Xmatrix=np.cos(tmatrix+phimatrix)
+	t=np.squeeze(t)
+	phi=np.reshape(phi,(npixels,))
 
 	beta_array=np.zeros((npixels))
 	varexp_array=np.zeros((npixels))
 	if roi_type != 'pixels':
 		signal_fit = np.zeros((npixels,tpoints))
 
-	for midx in range(npixels):
-		x=np.expand_dims(Xmatrix[midx,:],1)
-		y=roi_trace[midx,:]
-		beta=np.matmul(np.linalg.pinv(x),y)
-		beta_array[midx]=beta
-		yHat=x*beta
-		if roi_type == 'pixels':
-			if midx == signal_fit_idx:
-				signal_fit=np.squeeze(yHat)
-		else:
-			signal_fit[midx,:]=np.squeeze(yHat)
-		SSreg=np.sum((yHat-np.mean(y,0))**2)
-		SStotal=np.sum((y-np.mean(y,0))**2)
-		varexp_array[midx]=SSreg/SStotal
+	for start in range(0,npixels,chunk_size):
+		ixs=slice(start,min(start+chunk_size,npixels))
+		x=np.cos(t[np.newaxis,:]+phi[ixs,np.newaxis])
+		y=roi_trace[ixs,:]
+		xx=np.sum(x**2,1)
+		beta=np.sum(x*y,1)/np.where(xx>0,xx,1.)
+		beta[xx==0]=0
+		beta_array[ixs]=beta
+		yHat=x*beta[:,np.newaxis]
+		if roi_type != 'pixels':
+			signal_fit[ixs,:]=yHat
+		ymean=np.mean(y,1)[:,np.newaxis]
+		SSreg=np.sum((yHat-ymean)**2,1)
+		SStotal=np.sum((y-ymean)**2,1)
+		varexp_array[ixs]=SSreg/SStotal
+
+	if roi_type == 'pixels':
+		signal_fit=np.cos(t+phi[signal_fit_idx])*beta_array[signal_fit_idx]
 
 	return varexp_array, beta_array, signal_fit
 
 def get_mask_traces(tiff_stack,masks):
-	szx, szy, nframes = tiff_stack.shape
-	nmasks, szx, szy = masks.shape
+	'''
+	Average of each frame of tiff_stack (szx, szy, nframes) over the nonzero pixels of each mask (nmasks, szx, szy).
+	All masks are applied at once as a normalized sparse (pixels x masks) array (see traces.apply_maskarray).
+	Empty masks give NaN traces.
 
-	roi_trace = np.zeros((nmasks,nframes))
+	Returns roi_trace (nmasks x nframes).
+	'''
+	szx, szy, nframes = tiff_stack.shape
+	nmasks = masks.shape[0]
 
-	for frame in range(nframes):
-		for midx in range(nmasks):
-			#get frame and mask
-			im0 = np.squeeze(tiff_stack[:,:,frame])
-			single_mask = np.squeeze(masks[midx,:,:])
+	#binarize masks, and weight each pixel by 1/npixels in its mask
+	maskarray = scipy.sparse.csc_matrix(np.reshape(masks!=0, (nmasks, szx*szy)).T.astype(float))
+	npixels = np.asarray(maskarray.sum(axis=0)).ravel()
+	maskarray = maskarray.dot(scipy.sparse.diags(1./np.maximum(npixels, 1)))
 
-			#set zero values in mask as nans in image
-			im0 = im0.astype('float32')
-			im0[single_mask==0] = np.nan
+	#take the average of non-zero mask values
+	frames = np.reshape(tiff_stack, (szx*szy, nframes)).T
+	roi_trace = traces.apply_maskarray(frames, maskarray).T
+	roi_trace[npixels==0, :] = np.nan
 
-			#take the average of non-zero mask values
-			roi_trace[midx,frame] = np.nanmean(im0)
 	return roi_trace
 
 
-
 	
 
 def analyze_tiff(tiff_path_full,tiff_fn,stack_info, RETINOID,file_dir,tiff_fig_dir,masks_file,slicenum=0, np_cfactor=0.7, create_new=False, create_new_masks=False):
@@ -311,7 +303,7 @@ def analyze_tiff(tiff_path_full,tiff_fn,stack_info, RETINOID,file_dir,tiff_fig_d
         #print masks_file[masks_file.keys()[0]]['masks'].keys()
         #slice_str = masks_file[file_str]['masks'].keys()[0]
 		#masks = masks_file[file_str]['masks'][slice_str][:]
-        masks = masks_file[mask_file_str][mask_slice_str]['maskarray'][:]
+        masks = load_maskarray(masks_file[mask_file_str][mask_slice_str], 'maskarray')
         # reshape mask array
         d1, d2 = masks_file[mask_file_str][mask_slice_str]['zproj'].shape
         nrois = masks.shape[-1]
@@ -349,7 +341,7 @@ def analyze_tiff(tiff_path_full,tiff_fn,stack_info, RETINOID,file_dir,tiff_fig_d
         #roi_trace = get_mask_traces(tiff_stack,masks)
 
         # apply masks to stack and do neuropil correction:
-        np_maskarray = masks_file[mask_file_str][mask_slice_str]['np_maskarray'][:]
+        np_maskarray = load_maskarray(masks_file[mask_file_str][mask_slice_str], 'np_maskarray')
         print("...NP masks: %s" % str(np_maskarray.shape))
 
         if RETINOID['PARAMS']['downsample_factor'] is not None:
@@ -384,8 +376,8 @@ def analyze_tiff(tiff_path_full,tiff_fn,stack_info, RETINOID,file_dir,tiff_fig_d
         npset.attrs['dims'] = (szx, szy)
         
         # APply masks to tiff:
-        soma_trace = masks_r.dot(tiffs_r)
-        np_trace = np_maskarray.T.dot(tiffs_r)
+        soma_trace = traces.apply_maskarray(tiffs_r.T, masks_r.T).T
+        np_trace = traces.apply_maskarray(tiffs_r.T, np_maskarray).T
         roi_trace = soma_trace - (np_cfactor * np_trace)
  
         print "... applied masks. roi_trace shape: %s" % str(roi_trace.shape)
@@ -14,6 +14,8 @@ import copy
 import optparse
 import sys
 import traceback
+import hashlib
+import h5py
 import cv2
 from scipy import interpolate
 import math
@@ -25,6 +27,7 @@ import seaborn as sns
 import cPickle as pkl
 import numpy as np
 import scipy as sp
+import scipy.sparse
 from scipy import stats
 import pandas as pd
 import matplotlib as mpl
@@ -35,7 +38,7 @@ import scipy.optimize as opt
 from matplotlib.patches import Ellipse, Rectangle
 
 from mpl_toolkits.axes_grid1 import AxesGrid
-from pipeline.python.utils import natural_keys, convert_range, label_figure, load_dataset, load_run_info, get_screen_dims, warp_spherical, get_spherical_coords, get_lin_coords
+from pipeline.python.utils import natural_keys, convert_range, label_figure, load_dataset, load_run_info, get_screen_dims, warp_spherical, get_spherical_coords, get_lin_coords, get_warp_spherical_weights, save_sparse_group, load_maskarray
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from scipy.signal import argrelextrema
 from scipy.interpolate import splrep, sproot, splev, interp1d
@@ -352,31 +355,138 @@ def reshape_array_for_nynx(rfmap_values, nx, ny):
 
 
 
-def sphr_correct_maps(avg_resp_by_cond, fit_params=None, multiproc=True):
+def get_resize_weights(n_in, n_out):
+    '''
+    Weights (n_out x n_in) of cv2.resize(interpolation=cv2.INTER_LINEAR) along 1 axis.
+    Also returns which inputs each output reads (taps with 0 weight included, since NaNs propagate through them).
+    '''
+    weights = np.zeros((n_out, n_in))
+    support = np.zeros((n_out, n_in))
+    for i in range(n_in):
+        v = np.zeros((n_in, 1))
+        v[i] = 1
+        weights[:, i] = cv2.resize(v, (1, n_out), interpolation=cv2.INTER_LINEAR)[:, 0]
+        v[i] = np.nan
+        support[:, i] = np.isnan(cv2.resize(v, (1, n_out), interpolation=cv2.INTER_LINEAR)[:, 0])
+
+    return scipy.sparse.csr_matrix(weights), scipy.sparse.csr_matrix(support)
+
+def build_sphr_warp_operator(cart_x, cart_y, sphr_th, sphr_ph, row_vals=None, col_vals=None, 
+                             resolution=(1080, 1920), normalize_range=True):
+    '''
+    Sparse linear map equivalent to warp_spherical_fromarr() for flattened (ny x nx) RF maps: upsample
+    to the stimulated region of the screen (resample_map), spherical warp (warp_spherical), crop, and resize to grid.
 
-    if multiproc:
-        avg_resp_by_cond = avg_resp_by_cond.T
+    Returns
+        warp_op (sparse CSR, ny*nx x ny*nx) : warped maps (ny*nx x nrois) = warp_op.dot(rfmaps)
+        nan_mask (bool, ny*nx) : grid points warp_spherical_fromarr() returns as NaN
+    '''
+    nx = len(col_vals)
+    ny = len(row_vals)
+    npix = resolution[0]*resolution[1]
+    screen_bounds_pix = get_screen_lim_pixels(cart_x, cart_y, row_vals=row_vals, col_vals=col_vals)
+    (pix_bottom_edge, pix_left_edge, pix_top_edge, pix_right_edge) = screen_bounds_pix
 
+    # Upsample (as resample_map): each stimulated screen pixel takes 1 grid value, the rest are NaN
+    stim_height = pix_bottom_edge-pix_top_edge+1
+    stim_width = pix_right_edge-pix_left_edge+1
+    grid_ixs = cv2.resize(np.arange(0, ny*nx).reshape(ny, nx).astype(float), (stim_width, stim_height),
+                          interpolation=cv2.INTER_NEAREST).astype(int)
+    stim_pix = np.ravel_multi_index(np.mgrid[pix_top_edge:pix_bottom_edge+1, pix_left_edge:pix_right_edge+1], 
+                                    resolution).ravel()
+    upsample_op = scipy.sparse.csr_matrix((np.ones(stim_pix.shape), (stim_pix, grid_ixs.ravel())), shape=(npix, ny*nx))
+    nan_pix = np.ones(npix)
+    nan_pix[stim_pix] = 0
+
+    # Spherical warp (same arg order as warp_spherical() call in warp_spherical_fromarr)
+    warp_weights, warp_support, outside = get_warp_spherical_weights(sphr_th, sphr_ph, cart_x, cart_y, 
+                                                                     normalize_range=normalize_range)
+
+    # Crop and resize back to grid (separable over rows/cols of cropped screen)
+    trim_pix = np.ravel_multi_index(np.mgrid[pix_top_edge:pix_bottom_edge, pix_left_edge:pix_right_edge], 
+                                    resolution).ravel()
+    crop_op = scipy.sparse.csr_matrix((np.ones(trim_pix.shape), (np.arange(0, len(trim_pix)), trim_pix)), 
+                                      shape=(len(trim_pix), npix))
+    row_weights, row_support = get_resize_weights(pix_bottom_edge-pix_top_edge, ny)
+    col_weights, col_support = get_resize_weights(pix_right_edge-pix_left_edge, nx)
+    resize_op = scipy.sparse.kron(row_weights, col_weights).tocsr().dot(crop_op)
+    resize_support = scipy.sparse.kron(row_support, col_support).tocsr().dot(crop_op)
+
+    warp_op = resize_op.dot(warp_weights).dot(upsample_op)
+    nan_warped = outside | (warp_support.dot(nan_pix) > 0)
+    nan_mask = resize_support.dot(nan_warped.astype(float)) > 0
+
+    return scipy.sparse.csr_matrix(warp_op), nan_mask
+
+sphr_warp_operators = {}
+
+def get_sphr_warp_operator(fit_params, cache_dir=None, create_new=False):
+    '''
+    Load (or build and save) the spherical-correction operator for the screen geometry and RF grid in
+    fit_params ('screen', 'row_vals', 'col_vals', 'downsample_factor'). See build_sphr_warp_operator().
+    Operators are saved as <cache_dir>/sphr_warp_<geometry hash>.hdf5 (default cache_dir: fit_params['rfdir']).
+    '''
     ds_factor = fit_params['downsample_factor']
     col_vals = fit_params['col_vals']
     row_vals = fit_params['row_vals']
-
-    # Downsample screen resolution
     resolution_ds = [int(i/ds_factor) for i in fit_params['screen']['resolution'][::-1]]
 
-    # Get linear coordinates in degrees (downsampled)
-    lin_x, lin_y = get_lin_coords(resolution=resolution_ds, cm_to_deg=True) 
-    print("Screen res (ds=%ix): [%i, %i]" % (ds_factor, resolution_ds[0], resolution_ds[1]))
+    geometry = (tuple(resolution_ds), tuple(np.round(row_vals, 4)), tuple(np.round(col_vals, 4)), float(ds_factor))
+    op_key = hashlib.sha1(str(geometry).encode('utf-8')).hexdigest()[0:8]
+    if op_key in sphr_warp_operators and not create_new:
+        return sphr_warp_operators[op_key]
 
-    # Get Spherical coordinate mapping
-    cart_x, cart_y, sphr_th, sphr_ph = get_spherical_coords(cart_pointsX=lin_x, 
-                                                            cart_pointsY=lin_y,
-                                                            cm_to_degrees=False) # already in deg
+    if cache_dir is None:
+        cache_dir = fit_params['rfdir']
+    op_fpath = os.path.join(cache_dir, 'sphr_warp_%s.hdf5' % op_key)
+    warp_op = None
+    if os.path.exists(op_fpath) and not create_new:
+        try:
+            with h5py.File(op_fpath, 'r') as f:
+                warp_op = load_maskarray(f, name='warp_op', as_sparse=True).tocsr()
+                nan_mask = f['nan_mask'][:]
+        except Exception as e:
+            print("... error loading %s, rebuilding" % op_fpath)
+            warp_op = None
+    if warp_op is None:
+        print("... building spherical warp operator (%s)" % op_key)
+        lin_x, lin_y = get_lin_coords(resolution=resolution_ds, cm_to_deg=True) 
+        cart_x, cart_y, sphr_th, sphr_ph = get_spherical_coords(cart_pointsX=lin_x, 
+                                                                cart_pointsY=lin_y,
+                                                                cm_to_degrees=False) # already in deg
+        warp_op, nan_mask = build_sphr_warp_operator(cart_x, cart_y, sphr_th, sphr_ph, 
+                                                     row_vals=row_vals, col_vals=col_vals, 
+                                                     resolution=resolution_ds)
+        # Write to tmp file, then rename, so an interrupted write never leaves a partial operator file
+        tmp_fpath = '%s.tmp%i' % (op_fpath, os.getpid())
+        with h5py.File(tmp_fpath, 'w') as f:
+            save_sparse_group(warp_op, f, 'warp_op')
+            f.create_dataset('nan_mask', data=nan_mask)
+            f.attrs['resolution'] = resolution_ds
+            f.attrs['row_vals'] = row_vals
+            f.attrs['col_vals'] = col_vals
+            f.attrs['downsample_factor'] = ds_factor
+        os.rename(tmp_fpath, op_fpath)
+        print("... saved: %s" % op_fpath)
+
+    sphr_warp_operators[op_key] = (warp_op, nan_mask)
+
+    return warp_op, nan_mask
 
-    args=(cart_x, cart_y, sphr_th, sphr_ph, row_vals, col_vals, resolution_ds,)
-    avg_t = avg_resp_by_cond.apply(warp_spherical_fromarr, axis=0, args=args)
+def sphr_correct_maps(avg_resp_by_cond, fit_params=None, multiproc=True):
+    '''
+    Spherical correction of all RF maps at once (columns of avg_resp_by_cond), 
+    as warp_spherical_fromarr() on each map (see get_sphr_warp_operator()).
+    '''
+    if multiproc:
+        avg_resp_by_cond = avg_resp_by_cond.T
+
+    warp_op, nan_mask = get_sphr_warp_operator(fit_params)
+    avg_warped = warp_op.dot(avg_resp_by_cond.values)
+    avg_warped[nan_mask, :] = np.nan
+    avg_t = pd.DataFrame(avg_warped, columns=avg_resp_by_cond.columns)
 
-    return avg_t.reset_index(drop=True)
+    return avg_t
 
 from functools import partial
 import multiprocessing as mp
@@ -390,6 +500,8 @@ def sphr_correct_maps_mp(avg_resp_by_cond, fit_params, n_processes=2, test_subse
         df_ = avg_resp_by_cond.copy()
     print("Parallel", df_.shape)
 
+    # Build (or load) the warp operator once, before forking -- workers use the in-memory copy
+    get_sphr_warp_operator(fit_params)
     df = parallelize_dataframe(df_.T, sphr_correct_maps, fit_params, n_processes=n_processes)
 
     return df
@@ -838,56 +950,25 @@ def do_2d_fit(rfmap, nx=None, ny=None, verbose=False):
 # -----------------------------------------------------------------------------
 
 
-def plot_and_fit_roi_RF(response_vector, row_vals, col_vals, 
-                        min_sigma=2.5, max_sigma=50, sigma_scale=2.35, scale_sigma=True,
-                        trim=False, hard_cutoff=False, map_thr=None, set_to_min=False, perc_min=None):
+def fit_roi_RF(response_vector, row_vals, col_vals, 
+               max_sigma=50, sigma_scale=2.35, scale_sigma=True):
     '''
-    Fits RF for single ROI. 
+    Fits RF for single ROI (no plotting). 
     Note: This does not filter by R2, includes all fit-able.
     
-    Returns a dict with fit info if doesn't error out.
+    Returns a dict with fit info if doesn't error out (empty dict otherwise).
     
-    Sigma must be [2.5, 50]...
+    Sigma must be [xres/2, max_sigma]...
     '''
-#        set_to_min = False
-#        hard_cutoff = False
-#        set_to_min_str = ''    
-#        cutoff_type = 'no_trim'
-#        map_thr=''
-#    else:
-#        cutoff_type = 'hard_thr' if hard_cutoff else 'perc_min'
-#        map_thr = 1.5 if (trim and hard_cutoff) else perc_min
-#        
-#    set_to_min_str = 'set_min' if set_to_min else ''
     sigma_scale = sigma_scale if scale_sigma else 1.0
     results = {}
-    fig, axes = pl.subplots(1,2, figsize=(8, 4)) # pl.figure()
-    ax = axes[0]
-    #ax, rfmap = plot_roi_RF(avg_zscores_by_cond[rid], ncols=len(col_vals), nrows=len(row_vals), ax=ax)
-    ax, rfmap = plot_roi_RF(response_vector, ax=ax, 
-                            ncols=len(col_vals), nrows=len(row_vals))
-#                            , trim=trim,
-#                            perc_min=perc_min,
-#                            hard_cutoff=False, map_thr=map_thr, set_to_min=set_to_min)
-#
-    ax2 = axes[1]
+    rfmap = get_rf_map(response_vector, len(col_vals), len(row_vals)).copy()
+
     # Do fit 
     # ---------------------------------------------------------------------
     denoised=False
-    #if hard_cutoff and (rfmap.max() < map_thr):
-    #    fitr = {'success': False}
-    #else:
     fitr, fit_y = do_2d_fit(rfmap, nx=len(col_vals), ny=len(row_vals))
-#        if rfmap.max() > 3.0 and fit_y is None:
-#            try:
-#                rfmap[rfmap<rfmap.max()*0.2] = rfmap.min()
-#                fitr, fit_y = do_2d_fit(rfmap, nx=len(col_vals), ny=len(row_vals))
-#                assert fitr is not None, "--- no fit, trying with denoised..."
-#                denoised=True
-#            except Exception as e:
-#                print e
-#                pass
-#            
+
     xres = np.mean(np.diff(sorted(row_vals)))
     yres = np.mean(np.diff(sorted(col_vals)))
     min_sigma = xres/2.0
@@ -898,13 +979,35 @@ def plot_and_fit_roi_RF(response_vector, row_vals, col_vals,
             or any(s > max_sigma for s in [abs(sigx_f)*xres*sigma_scale, abs(sigy_f)*yres*sigma_scale]):
             fitr['success'] = False
 
-    if fitr['success']:    
-        # Draw ellipse: #ax.contour(plot_xx, plot_yy, fitr.reshape(rfmap.shape), 3, colors='b')
-#        amp_f, x0_f, y0_f, sigx_f, sigy_f, theta_f, offset_f = fitr['popt']
-#        ell = Ellipse((x0_f, y0_f), abs(sigx_f)*sigma_scale, abs(sigy_f)*sigma_scale, 
-#                      angle=np.rad2deg(theta_f), alpha=0.5, edgecolor='w') #theta_f)
-#        ax.add_patch(ell)
-#        ax.text(0, -1, 'r2=%.2f, theta=%.2f' % (fitr['r2'], theta_f), color='k')
+    if fitr['success']:
+        results = {'amplitude': amp_f,
+                   'x0': x0_f,
+                   'y0': y0_f,
+                   'sigma_x': sigx_f,
+                   'sigma_y': sigy_f,
+                   'theta': theta_f,
+                   'offset': offset_f,
+                   'r2': fitr['r2'],
+                   'fit_y': fit_y,
+                   'fit_r': fitr,
+                   'data': rfmap,
+                   'denoised': denoised}
+    
+    return results
+
+
+def plot_roi_RF_fit(response_vector, roi_fit_results, row_vals, col_vals, scale_sigma=True):
+    '''
+    Plots RF map for single ROI, with fit ellipse + covariance of fit params (if fit, see fit_roi_RF()).
+    '''
+    fig, axes = pl.subplots(1,2, figsize=(8, 4)) # pl.figure()
+    ax = axes[0]
+    ax, rfmap = plot_roi_RF(response_vector, ax=ax, 
+                            ncols=len(col_vals), nrows=len(row_vals))
+    ax2 = axes[1]
+
+    if roi_fit_results != {}:
+        fitr = roi_fit_results['fit_r']
         ax = plot_rf_ellipse(fitr, ax, scale_sigma=scale_sigma)
                 
         # Visualize fit results:
@@ -928,29 +1031,127 @@ def plot_and_fit_roi_RF(response_vector, row_vals, col_vals,
         
     pl.subplots_adjust(wspace=0.3, left=0.1, right=0.9)
 
-    xi = np.arange(0, len(col_vals))
-    yi = np.arange(0, len(row_vals))
-    xx, yy = np.meshgrid(xi, yi)
+    return fig
 
 
-    if fitr['success']:
-        results = {'amplitude': amp_f,
-                   'x0': x0_f,
-                   'y0': y0_f,
-                   'sigma_x': sigx_f,
-                   'sigma_y': sigy_f,
-                   'theta': theta_f,
-                   'offset': offset_f,
-                   'r2': fitr['r2'],
-                   'fit_y': fit_y,
-                   'fit_r': fitr,
-                   'data': rfmap,
-                   'denoised': denoised}
-        
+def plot_and_fit_roi_RF(response_vector, row_vals, col_vals, 
+                        min_sigma=2.5, max_sigma=50, sigma_scale=2.35, scale_sigma=True,
+                        trim=False, hard_cutoff=False, map_thr=None, set_to_min=False, perc_min=None):
+    '''
+    Fits RF for single ROI and plots it (see fit_roi_RF() and plot_roi_RF_fit()).
+    Note: This does not filter by R2, includes all fit-able.
+    
+    Returns a dict with fit info if doesn't error out.
+    
+    Sigma must be [2.5, 50]...
+    '''
+    results = fit_roi_RF(response_vector, row_vals, col_vals, max_sigma=max_sigma, 
+                         sigma_scale=sigma_scale, scale_sigma=scale_sigma)
+    fig = plot_roi_RF_fit(response_vector, results, row_vals, col_vals, scale_sigma=scale_sigma)
     
     return results, fig
     
 
+def init_rf_worker(terminating_, rf_args_):
+    # Places RF maps + fit params in the global namespace of each worker
+    # subprocess, so they are inherited once per worker (fork), not pickled per ROI.
+    global terminating, rf_args
+    terminating = terminating_
+    rf_args = rf_args_
+
+def fit_rois_worker(roi_chunk):
+    roi_fits = {}
+    if not terminating.is_set():
+        args = rf_args
+        for rid in roi_chunk:
+            roi_fits[rid] = fit_roi_RF(args['avg_resp_by_cond'][rid], args['row_vals'], args['col_vals'],
+                                       sigma_scale=args['sigma_scale'], scale_sigma=args['scale_sigma'])
+    return roi_fits
+
+def plot_rois_worker(roi_chunk):
+    n_plotted = 0
+    if not terminating.is_set():
+        args = rf_args
+        for rid in roi_chunk:
+            fig = plot_roi_RF_fit(args['avg_resp_by_cond'][rid], args['fit_results'].get(rid, {}), 
+                                  args['row_vals'], args['col_vals'], scale_sigma=args['scale_sigma'])
+            fig.suptitle('roi %i' % int(rid+1))
+            label_figure(fig, args['data_identifier'])
+            figname = '%s_%s_RF_roi%05d' % (args['trace_type'], args['response_type'], int(rid+1))
+            pl.savefig(os.path.join(args['figdir'], '%s.png' % figname))
+            pl.close()
+            n_plotted += 1
+    return n_plotted
+
+def run_rf_pool(worker, roi_list, rf_args, n_processes=1):
+    '''
+    Runs worker (fit_rois_worker or plot_rois_worker) on chunks of roi_list, 
+    in n_processes workers that share rf_args. Returns list of worker outputs.
+    '''
+    terminating = mp.Event()
+    if n_processes <= 1:
+        init_rf_worker(terminating, rf_args)
+        return [worker(roi_list)]
+
+    n_chunks = min(len(roi_list), n_processes*4)
+    roi_chunks = [roi_list[i::n_chunks] for i in range(n_chunks)]
+    results = []
+    pool = mp.Pool(processes=n_processes, initializer=init_rf_worker, initargs=(terminating, rf_args,))
+    try:
+        for ci, res in enumerate(pool.imap_unordered(worker, roi_chunks)):
+            results.append(res)
+            print("... %i of %i roi chunks done" % (ci+1, n_chunks))
+    except KeyboardInterrupt:
+        terminating.set()
+        pool.terminate()
+        print("terminating")
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+def fit_roi_RFs(avg_resp_by_cond, row_vals, col_vals, roi_list=None, 
+                sigma_scale=2.35, scale_sigma=True, n_processes=1):
+    '''
+    Fits RFs of all ROIs in roi_list (columns of avg_resp_by_cond), in parallel if n_processes > 1.
+    Returns dict of fit results (see fit_roi_RF()), keyed by roi, for ROIs that were fit.
+    '''
+    if roi_list is None:
+        roi_list = avg_resp_by_cond.columns.tolist()
+    rf_args = {'avg_resp_by_cond': avg_resp_by_cond[roi_list], 
+               'row_vals': row_vals, 'col_vals': col_vals,
+               'sigma_scale': sigma_scale, 'scale_sigma': scale_sigma}
+    
+    fit_results = {}
+    for roi_fits in run_rf_pool(fit_rois_worker, roi_list, rf_args, n_processes=n_processes):
+        fit_results.update(dict((rid, res) for rid, res in roi_fits.items() if res != {}))
+    
+    return fit_results
+
+def plot_roi_RF_fits(avg_resp_by_cond, fit_results, fit_params, roi_list=None, 
+                     trace_type='corrected', response_type='dff', 
+                     data_identifier='METADATA', n_processes=1):
+    '''
+    Saves RF map + fit figure of each ROI in roi_list to <rfdir>/roi_fits, in parallel if n_processes > 1.
+    '''
+    if roi_list is None:
+        roi_list = avg_resp_by_cond.columns.tolist()
+    figdir = os.path.join(fit_params['rfdir'], 'roi_fits')
+    if not os.path.exists(figdir):
+        os.makedirs(figdir)
+    rf_args = {'avg_resp_by_cond': avg_resp_by_cond[roi_list], 
+               'fit_results': fit_results,
+               'row_vals': fit_params['row_vals'], 'col_vals': fit_params['col_vals'],
+               'scale_sigma': fit_params['scale_sigma'], 
+               'trace_type': trace_type, 'response_type': response_type,
+               'data_identifier': data_identifier, 'figdir': figdir}
+
+    n_plotted = sum(run_rf_pool(plot_rois_worker, roi_list, rf_args, n_processes=n_processes))
+    print("... saved %i roi fit figures: %s" % (n_plotted, figdir))
+
+    return n_plotted
+
 
 #%%
 def plot_kde_maxima(kde_results, weights, linX, linY, screen, use_peak=True, \
@@ -1639,7 +1840,8 @@ def fit_rfs(avg_resp_by_cond, fit_params={}, #row_vals=[], col_vals=[], fitparam
             response_type='dff', roi_list=None, #scale_sigma=True,
             #rf_results_fpath='/tmp/fit_results.pkl', 
             do_spherical_correction=False,
-            data_identifier='METADATA'):
+            data_identifier='METADATA', trace_type='corrected', 
+            n_processes=1, plot_roi_fits=True):
             #response_thr=None):
 
     '''
@@ -1647,6 +1849,9 @@ def fit_rfs(avg_resp_by_cond, fit_params={}, #row_vals=[], col_vals=[], fitparam
     Saves 2 output files for fitting: 
         fit_results.pkl 
         fit_params.json
+
+    ROIs are fit in n_processes workers. Figures of each roi's fit (<rfdir>/roi_fits) are 
+    made afterward (also in parallel), only if plot_roi_fits.
     '''
     #trim=False; hard_cutoff=False; map_thr=''; set_to_min=False; 
      # '''
@@ -1669,10 +1874,6 @@ def fit_rfs(avg_resp_by_cond, fit_params={}, #row_vals=[], col_vals=[], fitparam
     with open(rf_params_fpath, 'w') as f:
         json.dump(fit_params, f, indent=4, sort_keys=True)
     
-    # Create subdir for saving each roi's fit
-    if not os.path.exists(os.path.join(rfdir, 'roi_fits')):
-        os.makedirs(os.path.join(rfdir, 'roi_fits'))
-
     roi_list = avg_resp_by_cond.columns.tolist()
 
     bad_rois = [r for r in roi_list if avg_resp_by_cond.max()[r] > 1.0]
@@ -1682,32 +1883,21 @@ def fit_rfs(avg_resp_by_cond, fit_params={}, #row_vals=[], col_vals=[], fitparam
         with open(badr_fpath, 'w') as f:
             json.dump(bad_rois, f)
      
-    fit_results = {}
-    for rid in roi_list:
-        #print rid
-        if rid in bad_rois:
-            continue
-
-        roi_fit_results, fig = plot_and_fit_roi_RF(avg_resp_by_cond[rid], 
-                                                    row_vals, col_vals,
-                                                    scale_sigma=scale_sigma, 
-                                                    sigma_scale=sigma_scale) 
-        fig.suptitle('roi %i' % int(rid+1))
-        label_figure(fig, data_identifier)            
-        figname = '%s_%s_RF_roi%05d' % (trace_type, response_type, int(rid+1))
-        pl.savefig(os.path.join(rfdir, 'roi_fits', '%s.png' % figname))
-        pl.close()
-        
-        if roi_fit_results != {}:
-            fit_results[rid] = roi_fit_results
-        #%
-    xi = np.arange(0, len(col_vals))
-    yi = np.arange(0, len(row_vals))
-    xx, yy = np.meshgrid(xi, yi)
+    fit_roi_list = [r for r in roi_list if r not in bad_rois]
+    fit_results = fit_roi_RFs(avg_resp_by_cond, row_vals, col_vals, roi_list=fit_roi_list,
+                              sigma_scale=sigma_scale, scale_sigma=scale_sigma, 
+                              n_processes=n_processes)
+    print("... fit %i of %i rois" % (len(fit_results.keys()), len(fit_roi_list)))
         
     with open(rf_results_fpath, 'wb') as f:
         pkl.dump(fit_results, f, protocol=pkl.HIGHEST_PROTOCOL)
 
+    # Save figure for each roi's fit
+    if plot_roi_fits:
+        plot_roi_RF_fits(avg_resp_by_cond, fit_results, fit_params, roi_list=fit_roi_list,
+                         trace_type=trace_type, response_type=response_type, 
+                         data_identifier=data_identifier, n_processes=n_processes)
+
     return fit_results, fit_params
 
 #%%
@@ -1896,7 +2086,8 @@ def fit_2d_receptive_fields(animalid, session, fov, run, traceid,
                             ellipse_ec='w', ellipse_fc='none', ellipse_lw=2, 
                             plot_ellipse=True, scale_sigma=True, sigma_scale=2.35,
                             linecolor='darkslateblue', cmap='bone', legend_lw=2, 
-                            fit_thr=0.5, rootdir='/n/coxfs01/2p-data', n_processes=1, test_subset=False):
+                            fit_thr=0.5, rootdir='/n/coxfs01/2p-data', n_processes=1, test_subset=False,
+                            plot_roi_fits=True):
 
     rows = 'ypos'; cols = 'xpos';
 
@@ -1974,12 +2165,8 @@ def fit_2d_receptive_fields(animalid, session, fov, run, traceid,
                                                         do_spherical_correction=do_spherical_correction)
             if do_spherical_correction:
                 print("...doin spherical warps")
-                if n_processes>1:
-                    avg_resp_by_cond = sphr_correct_maps_mp(avg_resp_by_cond, fit_params, 
-                                                                n_processes=n_processes, test_subset=test_subset)
-                else:
-                    avg_resp_by_cond = sphr_correct_maps(avg_resp_by_cond, fit_params, 
-                                                                multiproc=False)
+                avg_resp_by_cond = sphr_correct_maps(avg_resp_by_cond, fit_params, 
+                                                            multiproc=False)
             print("...saved array")
             save_rfmap_array(avg_resp_by_cond, fit_params['rfdir'])
          
@@ -1987,7 +2174,9 @@ def fit_2d_receptive_fields(animalid, session, fov, run, traceid,
         print("...now, fitting")
         fit_results, fit_params = fit_rfs(avg_resp_by_cond, response_type=response_type, 
                                           do_spherical_correction=do_spherical_correction, 
-                                            fit_params=fit_params, data_identifier=data_id)            
+                                            fit_params=fit_params, data_identifier=data_id,
+                                            trace_type=trace_type, n_processes=n_processes,
+                                            plot_roi_fits=plot_roi_fits)            
     try:
         # Convert to dataframe
         if avg_resp_by_cond is None:
@@ -2207,6 +2396,9 @@ def extract_options(options):
     parser.add_option('-n', '--nproc', action='store', dest='n_processes', default=1, 
                       help="N processes")
 
+    parser.add_option('--no-roi-plots', action='store_false', dest='plot_roi_fits', default=True, 
+                      help="flag to NOT save figure of each roi's fit")
+
     parser.add_option('--sphere', action='store_true', 
                         dest='do_spherical_correction', default=False, help="N processes")
     (options, args) = parser.parse_args(options)
@@ -2293,7 +2485,7 @@ def main(options):
                                 linecolor=optsE.linecolor, cmap=optsE.cmap, 
                                 legend_lw=optsE.legend_lw, 
                                 plot_format=plot_format, n_processes=n_processes, 
-                                test_subset=test_subset)
+                                test_subset=test_subset, plot_roi_fits=optsE.plot_roi_fits)
     
     print("--- fit %i rois total ---" % (len(fit_results.keys())))
 
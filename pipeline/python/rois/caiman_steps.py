@@ -70,7 +70,7 @@ import cPickle as pkl
 import numpy as np
 import tifffile as tf
 import pandas as pd
-from pipeline.python.utils import natural_keys
+from pipeline.python.utils import natural_keys, load_maskarray
 
 from pipeline.python.paradigm import utils as util
 from pipeline.python.paradigm import plot_responses as pplot
@@ -695,7 +695,7 @@ def get_seeds(fname_new, fr, optsE, traceid_dir, decay_time=4.0,
                 pid_fpath = glob.glob(os.path.join(acquisition_dir, run, 'processed', 'pids_%s.json' % run))[0]
                 with open(pid_fpath, 'r') as f: pids = json.load(f)
                 ref_file = pids['processed001']['PARAMS']['motion']['ref_file'] # Just always default to processed001...
-                A_in = maskfile[ref_file]['Slice01']['maskarray'][:] # Already in shape npixels x nrois -- but x-y dims are flipped@**
+                A_in = load_maskarray(maskfile[ref_file]['Slice01'], 'maskarray') # Already in shape npixels x nrois -- but x-y dims are flipped@**
                 A_in[A_in>0] = 1
                 A_in = A_in.astype(bool)
             
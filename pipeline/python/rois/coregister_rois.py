@@ -169,6 +169,7 @@ import re
 import json
 import h5py
 import scipy.io
+import scipy.sparse
 import pprint
 from scipy import ndimage
 import optparse
@@ -253,6 +254,48 @@ def minimumWeightMatching(costSet):
         if costSet_[iSet[k], jSet[k]] != practicalInfinity]
 
 #%%
+def binarize_components(A, dims, dist_maxthr=0.1):
+    '''
+    Threshold each spatial component (column of A, pixels in F-order) at dist_maxthr * max,
+    and keep only its largest connected component.
+    Each component is labeled on the bounding box of its suprathreshold pixels, rather than the full FOV.
+
+    Returns sparse boolean matrix (npixels x ncomponents), CSC.
+    '''
+    d1 = dims[0]
+    A = scipy.sparse.csc_matrix(A) if issparse(A) else scipy.sparse.csc_matrix(np.asarray(A))
+    A.sort_indices()
+    K = A.shape[-1]
+
+    s = ndimage.generate_binary_structure(2,2)
+    row_ixs = []; col_ixs = []
+    for i in range(K):
+        vals = A.data[A.indptr[i]:A.indptr[i+1]]
+        pix = A.indices[A.indptr[i]:A.indptr[i+1]]
+        if len(vals) == 0:
+            continue
+        pix = pix[vals > dist_maxthr*max(vals.max(), 0)]
+        if len(pix) == 0:
+            continue
+        # keep only the largest connected component (ties are all kept):
+        rr = pix % d1; cc = pix // d1
+        r0 = rr.min(); c0 = cc.min()
+        bw = np.zeros((rr.max()-r0+1, cc.max()-c0+1), dtype=bool)
+        bw[rr-r0, cc-c0] = True
+        labeled, nr_objects = ndimage.label(bw, s)
+        if nr_objects > 1:
+            pix_labels = labeled[rr-r0, cc-c0]
+            sizes = np.bincount(pix_labels)
+            pix = pix[sizes[pix_labels] == sizes.max()]
+        row_ixs.append(pix)
+        col_ixs.append(np.ones(pix.shape, dtype=int)*i)
+
+    if len(row_ixs) > 0:
+        row_ixs = np.hstack(row_ixs); col_ixs = np.hstack(col_ixs)
+    M = scipy.sparse.csc_matrix((np.ones(len(row_ixs), dtype=bool), (row_ixs, col_ixs)), shape=A.shape)
+
+    return M
+
 def get_distance_matrix(A1, A2, dims, dist_maxthr=0.1, dist_exp=0.1, dist_overlap_thr=0.8):
     """
         params_thr (dict)
@@ -260,59 +303,29 @@ def get_distance_matrix(A1, A2, dims, dist_maxthr=0.1, dist_exp=0.1, dist_overla
             'dist_exp'         :  (float) power n for distance between masked components: dist = 1 - (and(m1,m2)/or(m1,m2))^n (default: 1)
             'dist_thr'         :  (float) threshold for setting a distance to infinity, i.e., illegal matches (default: 0.5)
             'dist_overlap_thr' :  (float) overlap threshold for detecting if one ROI is a subset of another (default: 0.8)
-    """
-    d1 = dims[0]
-    d2 = dims[1]
 
+        Intersection counts for all pairs come from one sparse product (M1.T * M2), so only pairs
+        of components that share pixels are ever compared -- all others have overlap = 0 (dist = 1).
+    """
     #% first transform A1 and A2 into binary masks
-    M1 = np.zeros(A1.shape).astype('bool') #A1.astype('bool').toarray()
-    M2 = np.zeros(A2.shape).astype('bool') #A2.astype('bool').toarray()
-
-    K1 = A1.shape[-1]
-    K2 = A2.shape[-1]
-
-    s = ndimage.generate_binary_structure(2,2)
     print "Generating binary structure..."
-    for i in np.arange(0, max(K1,K2)):
-        if i < K1:
-            A_temp = A1.toarray()[:,i]
-            M1[A_temp>dist_maxthr*max(A_temp),i] = True
-            labeled, nr_objects = ndimage.label(np.reshape(M1[:,i], (d1,d2), order='F'), s)  # keep only the largest connected component
-            sizes = ndimage.sum(np.reshape(M1[:,i], (d1,d2), order='F'), labeled, range(1,nr_objects+1))
-            maxp = np.where(sizes==sizes.max())[0] + 1
-            max_index = np.zeros(nr_objects + 1, np.uint8)
-            max_index[maxp] = 1
-            BW = max_index[labeled]
-            M1[:,i] = np.reshape(BW, M1[:,i].shape, order='F')
-        if i < K2:
-            A_temp = A2.toarray()[:,i];
-            M2[A_temp>dist_maxthr*max(A_temp),i] = True
-            labeled, nr_objects = ndimage.label(np.reshape(M2[:,i], (d1,d2), order='F'), s)  # keep only the largest connected component
-            sizes = ndimage.sum(np.reshape(M2[:,i], (d1,d2), order='F'), labeled, range(1,nr_objects+1))
-            maxp = np.where(sizes==sizes.max())[0] + 1
-            max_index = np.zeros(nr_objects + 1, np.uint8)
-            max_index[maxp] = 1
-            BW = max_index[labeled]
-            M2[:,i] = np.reshape(BW, M2[:,i].shape, order='F')
+    M1 = binarize_components(A1, dims, dist_maxthr=dist_maxthr)
+    M2 = binarize_components(A2, dims, dist_maxthr=dist_maxthr)
 
     #% determine distance matrix between M1 and M2
     print "Determining distance between REF and FILE"
-    D = np.zeros((K1,K2));
-    for i in np.arange(0, K1):
-        for j in np.arange(0, K2):
-
-            overlap = float(np.count_nonzero(M1[:,i] & M2[:,j]))
-            #print overlap
-            totalarea = float(np.count_nonzero(M1[:,i] | M2[:,j]))
-            #print totalarea
-            smallestROI = min(np.count_nonzero(M1[:,i]),np.count_nonzero(M2[:,j]));
-            #print smallestROI
-
-            D[i,j] = 1 - (overlap/totalarea)**dist_exp
-
-            if overlap >= dist_overlap_thr*smallestROI:
-                #print('Too small!')
-                D[i,j] = 0
+    n1 = np.asarray(M1.sum(axis=0), dtype=float).ravel()
+    n2 = np.asarray(M2.sum(axis=0), dtype=float).ravel()
+    overlap = M1.T.astype(float).dot(M2.astype(float)).toarray()
+    totalarea = n1[:, np.newaxis] + n2[np.newaxis, :] - overlap
+    smallestROI = np.minimum(n1[:, np.newaxis], n2[np.newaxis, :])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        D = 1 - (overlap/totalarea)**dist_exp
+    D[overlap >= dist_overlap_thr*smallestROI] = 0
+    # Components with an empty binary mask match nothing:
+    D[n1 == 0, :] = 1
+    D[:, n2 == 0] = 1
 
     return D
 
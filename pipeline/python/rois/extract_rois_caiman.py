@@ -23,7 +23,7 @@ import pylab as pl
 import caiman as cm
 import numpy as np
 import multiprocessing as mp
-from checksumdir import dirhash
+from pipeline.python.utils import dirhash
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from caiman.utils.visualization import plot_contours, view_patches_bar
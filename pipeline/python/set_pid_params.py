@@ -14,8 +14,7 @@ import sys
 import hashlib
 import copy
 import shutil
-from pipeline.python.utils import natural_keys, write_dict_to_json, change_permissions_recursive, get_file_size 
-from checksumdir import dirhash
+from pipeline.python.utils import natural_keys, write_dict_to_json, change_permissions_recursive, get_file_size, dirhash
 from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWRITE, S_IWGRP, S_IWOTH
 
 pp = pprint.PrettyPrinter(indent=4)
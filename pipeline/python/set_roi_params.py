@@ -21,7 +21,7 @@ import shutil
 from pipeline.python.utils import write_dict_to_json, get_tiff_paths
 from pipeline.python.rois.utils import *
 import numpy as np
-from checksumdir import dirhash
+from pipeline.python.utils import dirhash
 
 pp = pprint.PrettyPrinter(indent=4)
 
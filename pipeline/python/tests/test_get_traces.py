@@ -0,0 +1,45 @@
+#!/usr/bin/env python2
+import os
+import h5py
+import numpy as np
+
+from pipeline.python.traces.get_traces import filetraces_complete, get_incomplete_filetraces, \
+                                               masks_to_normed_array, apply_maskarray
+
+
+def write_filetraces(filetraces_dir, curr_file, trace_hash, complete):
+    filetraces_filepath = os.path.join(filetraces_dir, '%s_rawtraces_%s.hdf5' % (curr_file, trace_hash))
+    with h5py.File(filetraces_filepath, 'w') as f:
+        f.attrs['complete'] = complete
+    return filetraces_filepath
+
+def test_incomplete_filetraces(tmpdir):
+    filetraces_dir = str(tmpdir)
+    trace_hash = 'abc123'
+    done = write_filetraces(filetraces_dir, 'File001', trace_hash, True)
+    interrupted = write_filetraces(filetraces_dir, 'File002', trace_hash, False) # present, but not written to the end
+
+    assert filetraces_complete(done)
+    assert not filetraces_complete(interrupted)
+    assert get_incomplete_filetraces(filetraces_dir, ['File001', 'File002', 'File003'], trace_hash) \
+                == ['File002', 'File003']
+
+def test_unreadable_filetraces(tmpdir):
+    filetraces_dir = str(tmpdir)
+    with open(os.path.join(filetraces_dir, 'File001_rawtraces_abc123.hdf5'), 'w') as f:
+        f.write('truncated')
+
+    assert get_incomplete_filetraces(filetraces_dir, ['File001'], 'abc123') == ['File001']
+
+def test_sparse_normed_maskarray():
+    masks = np.zeros((6, 5, 3))
+    masks[1:3, 1:4, 0] = 1
+    masks[4, 0:2, 2] = 1 # ROI 1 is empty
+    dense = masks_to_normed_array(masks)
+    sparse = masks_to_normed_array(masks, sparse=True)
+    assert np.allclose(sparse.toarray(), dense, equal_nan=True)
+
+    frames = np.random.rand(4, 30)
+    traces = apply_maskarray(frames, sparse)
+    assert np.allclose(traces, frames.dot(dense), equal_nan=True)
+    assert np.all(np.isnan(traces[:, 1]))
@@ -0,0 +1,32 @@
+#!/usr/bin/env python2
+import numpy as np
+
+from pipeline.python.utils import update_zproj_stats, get_zproj_images
+
+
+def zproj_in_blocks(frames, block_size, zproj_types=['mean', 'std', 'max']):
+    stats = None
+    for start in range(0, frames.shape[0], block_size):
+        stats = update_zproj_stats(stats, frames[start:start+block_size])
+    return get_zproj_images(stats, zproj_types, frames.dtype)
+
+def test_zproj_matches_numpy():
+    rs = np.random.RandomState(1)
+    for trial in range(200):
+        nframes = rs.randint(2, 300)
+        base, k = rs.randint(0, 60000), rs.randint(1, 20)
+        frames = (rs.randint(0, 3, (nframes, 8, 8)) * k + base).astype(np.uint16)
+        # Alternate base, base+2k: std is exactly k, so any float drift truncates to k-1
+        frames[:nframes//2*2, :4] = base
+        frames[1:nframes//2*2:2, :4] = base + 2*k
+        zproj = zproj_in_blocks(frames, rs.randint(1, 50))
+        assert np.array_equal(zproj['mean'], np.mean(frames, axis=0).astype(np.uint16))
+        assert np.array_equal(zproj['std'], np.std(frames, axis=0).astype(np.uint16))
+        assert np.array_equal(zproj['max'], np.max(frames, axis=0).astype(np.uint16))
+
+def test_zproj_integer_std():
+    # Half the frames at 1000, half at 1004: std is exactly 2
+    frames = np.ones((60, 4, 4), dtype=np.int16) * 1000
+    frames[1::2] += 4
+    zproj = zproj_in_blocks(frames, 7, zproj_types=['std'])
+    assert np.all(zproj['std'] == 2)
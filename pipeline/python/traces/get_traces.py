@@ -115,9 +115,10 @@ import multiprocessing as mp
 import tifffile as tf
 import pylab as pl
 import numpy as np
+import scipy.sparse
 import cPickle as pkl
 from skimage import img_as_uint
-from pipeline.python.utils import natural_keys, hash_file_read_only, load_sparse_mat, print_elapsed_time, hash_file, replace_root, uint16_to_RGB #, get_frame_info
+from pipeline.python.utils import natural_keys, hash_file_read_only, load_sparse_mat, print_elapsed_time, hash_file, replace_root, uint16_to_RGB, iter_tiff_blocks, get_tiff_dims, save_sparse_group, load_maskarray #, get_frame_info
 from pipeline.python.set_trace_params import post_tid_cleanup
 from pipeline.python.rois.utils import get_info_from_tiff_dir
 from pipeline.python.traces.utils import get_metric_set
@@ -498,25 +499,50 @@ def get_mask_info(TID, RID, nslices=1, rootdir='/n/coxfs01/2p-data'):
 #    return maskinfo
 
 #%%
-def masks_to_normed_array(masks):
+def masks_to_normed_array(masks, sparse=False):
     '''
     Assumes masks.shape = (d1, d2, nrois)
 
     Returns:
         maskarray of shape (d, nrois), where d = d1*d2
         values are normalized by size of mask
+        If sparse=True, maskarray is a scipy.sparse.csc_matrix (built from nonzero pixels only).
+        Empty masks give an all-NaN column (as the dense array), so their traces are NaN.
     '''
     d1, d2 = masks[:,:,0].shape
     d = d1*d2
 
     nrois = masks.shape[-1]
 
+    if sparse:
+        masks_r = np.reshape(masks, (d, nrois), order='C')
+        pix, rids = np.nonzero(masks_r)
+        npix = np.bincount(rids, minlength=nrois).astype(float)
+        vals = masks_r[pix, rids] / npix[rids]
+        empty_rids = np.where(npix == 0)[0]
+        if len(empty_rids) > 0:
+            pix = np.hstack([pix, np.tile(np.arange(d), len(empty_rids))])
+            rids = np.hstack([rids, np.repeat(empty_rids, d)])
+            vals = np.hstack([vals, np.ones(d*len(empty_rids)) * np.nan])
+        return scipy.sparse.csc_matrix((vals, (pix, rids)), shape=(d, nrois))
+
     masks_arr = np.empty((d, nrois))
     for r in range(nrois):
         masks_arr[:, r] = np.reshape(masks[:,:,r], (d,), order='C') /  len(np.nonzero(masks[:,:,r])[0])
 
     return masks_arr
 
+def apply_maskarray(frames, maskarray):
+    '''
+    Project frames (T x d) onto maskarray (d x nrois), dense or scipy.sparse.
+
+    Returns:
+        tracemat of shape (T, nrois)
+    '''
+    if scipy.sparse.issparse(maskarray):
+        return np.asarray(maskarray.T.dot(frames.T)).T
+    return frames.dot(maskarray)
+
 
 #%%
 def get_gradient(im) :
@@ -722,6 +748,72 @@ def create_neuropil_masks(masks, niterations=10):
 
     return np_masks
 
+def create_neuropil_maskarray(masks, niterations=10, gap_iterations=None):
+    '''
+    Batched version of create_neuropil_masks(). The summed mask image is computed
+    once (not once per ROI), and each ROI is dilated only within its bounding box
+    (padded by the dilation size), so cost scales with ROI size, not FOV size.
+    A single (2n+1)x(2n+1) dilation is the same as n iterations of the 3x3 kernel.
+
+    Assumes masks.shape = (d1, d2, nrois)
+
+    Returns:
+        np_maskarray, scipy.sparse.csc_matrix of shape (d, nrois), where d = d1*d2,
+        values are normalized by size of annulus -- same values as
+        masks_to_normed_array(create_neuropil_masks(masks, niterations)).
+    '''
+    if gap_iterations is None:
+        if niterations==20:
+            gap_iterations = 8
+        else:
+            gap_iterations = 4
+
+    d1, d2, nrois = masks.shape
+    print "*** creating NP masks for %i rois (annulus: %i-%i iter)" % (nrois, gap_iterations, niterations)
+
+    gap_kernel = np.ones((2*gap_iterations+1, 2*gap_iterations+1), masks.dtype)
+    np_kernel = np.ones((2*niterations+1, 2*niterations+1), masks.dtype)
+    pad = max(niterations, gap_iterations)
+
+    # Get full mask image to subtract overlaps (only once):
+    allmasks = np.sum(masks, axis=-1)
+
+    # Bounding box of each ROI:
+    roi_rows = np.any(masks, axis=1) # d1 x nrois
+    roi_cols = np.any(masks, axis=0) # d2 x nrois
+
+    pix_idxs = []; roi_idxs = []
+    for ridx in range(nrois):
+        rr = np.where(roi_rows[:, ridx])[0]
+        cc = np.where(roi_cols[:, ridx])[0]
+        if len(rr) == 0:
+            continue
+        r0 = max(rr[0] - pad, 0); r1 = min(rr[-1] + pad + 1, d1)
+        c0 = max(cc[0] - pad, 0); c1 = min(cc[-1] + pad + 1, d2)
+        rmask = np.ascontiguousarray(masks[r0:r1, c0:c1, ridx])
+
+        gap = cv2.dilate(rmask, gap_kernel, iterations=1)
+        dilated = cv2.dilate(rmask, np_kernel, iterations=1)
+
+        # Subtract to get annulus region, excluding pixels that overlap any cell:
+        annulus = (dilated - gap)
+        summed = annulus + allmasks[r0:r1, c0:c1]
+        summed[summed>1] = 0
+        summed[allmasks[r0:r1, c0:c1] > 0] = 0
+
+        ys, xs = np.nonzero(summed)
+        pix_idxs.append((ys + r0) * d2 + (xs + c0))
+        roi_idxs.append(np.ones(len(ys), dtype=int) * ridx)
+
+    if len(pix_idxs) > 0:
+        pix_idxs = np.concatenate(pix_idxs); roi_idxs = np.concatenate(roi_idxs)
+    else:
+        pix_idxs = np.array([], dtype=int); roi_idxs = np.array([], dtype=int)
+    npix = np.bincount(roi_idxs, minlength=nrois).astype(float)
+    vals = 1. / npix[roi_idxs]
+
+    return scipy.sparse.csc_matrix((vals, (pix_idxs, roi_idxs)), shape=(d1*d2, nrois))
+
 
 #%%
 def get_masks(mask_write_path, maskinfo, RID, save_warp_images=False, do_neuropil_correction=True, niter=10, rootdir=''):
@@ -818,7 +910,7 @@ def get_masks(mask_write_path, maskinfo, RID, save_warp_images=False, do_neuropi
                 #    extracting from the same run, all we need to do is normalize 
                 #    the masks.
                 if curr_file == maskinfo['ref_file'] and maskinfo['matched_sources'] is True:
-                    mask_arr = masks_to_normed_array(masks)
+                    mask_arr = masks_to_normed_array(masks, sparse=True)
                     masks_aligned = copy.copy(masks)
                 
                 # 2.  Otherwise,
@@ -870,7 +962,7 @@ def get_masks(mask_write_path, maskinfo, RID, save_warp_images=False, do_neuropi
                     masks_aligned, accept_warp = warp_masks(masks, ref_img, img, 
                                                             save_warp_images=save_warp_images, 
                                                             out_fpath=warp_img_path)
-                    mask_arr = masks_to_normed_array(masks_aligned)
+                    mask_arr = masks_to_normed_array(masks_aligned, sparse=True)
                     if not accept_warp:
                         print "*** warp is worse than original! Excluding tif %s." % curr_file
 
@@ -888,10 +980,9 @@ def get_masks(mask_write_path, maskinfo, RID, save_warp_images=False, do_neuropi
                 else:
                     nb = 0
 
-                # Save mask info:
+                # Save mask info (sparse, npixels x nrois):
                 nrois = mask_arr.shape[-1]
-                m = filegrp.create_dataset('/'.join([curr_slice, 'maskarray']), mask_arr.shape, mask_arr.dtype)
-                m[...] = mask_arr
+                m = save_sparse_group(mask_arr, filegrp[curr_slice], 'maskarray')
                 m.attrs['nb'] = nb
                 m.attrs['nr'] = nrois - nb
                 m.attrs['src_roi_idxs'] = src_roi_idxs
@@ -900,19 +991,16 @@ def get_masks(mask_write_path, maskinfo, RID, save_warp_images=False, do_neuropi
 
                 # Check if should create neuropil masks:
                 if do_neuropil_correction:
-                    np_masks = create_neuropil_masks(masks_aligned, niterations=niter)
-                    npil_arr = masks_to_normed_array(np_masks)
-                    npil = filegrp.create_dataset('/'.join([curr_slice, 'np_maskarray']), npil_arr.shape, npil_arr.dtype)
-                    npil[...] = npil_arr
+                    npil_arr = create_neuropil_maskarray(masks_aligned, niterations=niter)
+                    npil = save_sparse_group(npil_arr, filegrp[curr_slice], 'np_maskarray')
                     npil.attrs['niterations'] = niter
 
 
                 # Check if have nmf traces:
                 if 'Ab_data' in maskfile[maskfile.keys()[0]].keys():
-                    Ab = load_sparse_mat('%s/Ab' % curr_file, maskinfo['filepath']).todense()
+                    Ab = load_sparse_mat('%s/Ab' % curr_file, maskinfo['filepath'])
                     Cf = load_sparse_mat('%s/Cf' % curr_file, maskinfo['filepath']).todense()
-                    mab = filegrp.create_dataset('/'.join([curr_slice, 'Ab']), Ab.shape, Ab.dtype)
-                    mab[...] = Ab
+                    save_sparse_group(Ab, filegrp[curr_slice], 'Ab')
                     mac = filegrp.create_dataset('/'.join([curr_slice, 'Cf']), Cf.shape, Cf.dtype)
                     mac[...] = Cf
                     
@@ -966,7 +1054,7 @@ def plot_roi_masks(TID, RID, plot_neuropil=True, mask_figdir='/tmp', rootdir='')
             dims = avg.shape
 
             nb = MASKS[curr_file][curr_slice]['maskarray'].attrs['nb']
-            maskarray= MASKS[curr_file][curr_slice]['maskarray'][:]
+            maskarray = load_maskarray(MASKS[curr_file][curr_slice], 'maskarray', as_sparse=True)
 
             print "--- Mask array: %i ROIs on %s, %s" % (len(curr_rois), curr_file, curr_slice)
             fig = pl.figure()
@@ -980,14 +1068,14 @@ def plot_roi_masks(TID, RID, plot_neuropil=True, mask_figdir='/tmp', rootdir='')
                     print "--- No neuropil mask array found!"
                     plot_neuropil = False
                 else:
-                    np_maskarray = MASKS[curr_file][curr_slice]['np_maskarray'][:]
+                    np_maskarray = load_maskarray(MASKS[curr_file][curr_slice], 'np_maskarray', as_sparse=True)
                     np_niterations = MASKS[curr_file][curr_slice]['np_maskarray'].attrs['niterations']
                     print "--- ...plus neuropil."
 
 
             bgidx = 0
             for ridx in range(nrois):
-                masktmp = np.reshape(maskarray[:, ridx], dims, order='C')
+                masktmp = np.reshape(maskarray[:, ridx].toarray(), dims, order='C')
                 msk = masktmp.copy()
                 msk[msk==0] = np.nan
 
@@ -1016,7 +1104,7 @@ def plot_roi_masks(TID, RID, plot_neuropil=True, mask_figdir='/tmp', rootdir='')
                     is_bg = False
 
                 if plot_neuropil is True and not is_bg:
-                    masktmp = np.reshape(np_maskarray[:, ridx], dims, order='C')
+                    masktmp = np.reshape(np_maskarray[:, ridx].toarray(), dims, order='C')
                     msk = masktmp.copy()
                     msk[msk==0] = np.nan
                     ax.imshow(msk, interpolation='None', alpha=0.2, cmap=pl.cm.Blues_r)
@@ -1055,8 +1143,65 @@ def hash_filetraces(filetraces_dir, traceid_hash):
     print "Saved hash info for file-traces files."
 
 #%%
+def load_file_masks(maskdict_path, curr_file, do_neuropil_correction=True):
+    '''
+    Load (sparse) mask arrays for each slice of curr_file from MASKS.hdf5.
 
-def apply_masks_to_tiff(currtiff_path, TID, si_info, maskdict_path=None, do_neuropil_correction=True, cfactor=0.6, output_filedir='/tmp', rootdir=''):
+    Returns:
+        dict with 'source_file' (original mask file) and 'slices', a dict keyed
+        by slice name with maskarray, np_maskarray (if neuropil), Ab & Cf (if NMF), nb, nr.
+    '''
+    file_masks = {'slices': {}}
+    MASKS = h5py.File(maskdict_path, 'r')
+    try:
+        file_masks['source_file'] = MASKS.attrs['source_file']
+        roi_slices = sorted([k for k in MASKS[curr_file].keys() if 'Slice' in k], key=natural_keys)
+        for curr_slice in roi_slices:
+            slice_grp = MASKS[curr_file][curr_slice]
+            smasks = {'maskarray': load_maskarray(slice_grp, 'maskarray', as_sparse=True)}
+            if do_neuropil_correction is True and 'np_maskarray' in slice_grp.keys():
+                smasks['np_maskarray'] = load_maskarray(slice_grp, 'np_maskarray', as_sparse=True)
+            if 'Ab' in slice_grp.keys():
+                smasks['Ab'] = load_maskarray(slice_grp, 'Ab', as_sparse=True)
+                smasks['Cf'] = slice_grp['Cf'][:]
+                attrs_src = slice_grp if 'nb' in slice_grp.attrs.keys() else slice_grp['maskarray']
+                smasks['nb'] = attrs_src.attrs['nb']
+                smasks['nr'] = attrs_src.attrs['nr']
+            file_masks['slices'][curr_slice] = smasks
+    finally:
+        MASKS.close()
+
+    return file_masks
+
+def filetraces_complete(filetraces_filepath):
+    '''
+    Check whether file-traces output exists and was written to the end (see apply_masks_to_tiff).
+    '''
+    if not os.path.exists(filetraces_filepath):
+        return False
+    try:
+        with h5py.File(filetraces_filepath, 'r') as f:
+            return 'complete' in f.attrs.keys() and bool(f.attrs['complete'])
+    except Exception as e:
+        return False
+
+def get_incomplete_filetraces(filetraces_dir, file_list, trace_hash):
+    '''
+    Files (FileXXX) in file_list whose FileXXX_rawtraces_<trace_hash>.hdf5 is missing or was not written to the end.
+    '''
+    return [curr_file for curr_file in file_list if not filetraces_complete(
+                os.path.join(filetraces_dir, '%s_rawtraces_%s.hdf5' % (curr_file, trace_hash)))]
+
+def apply_masks_to_tiff(currtiff_path, TID, si_info, maskdict_path=None, do_neuropil_correction=True, cfactor=0.6, output_filedir='/tmp', rootdir='', chunk_size=500, file_masks=None):
+    '''
+    Extract traces for each slice of a .tif file, streaming the movie in blocks of
+    pages (at most chunk_size frames in memory at once). Each block is split into
+    signal-channel frames per slice, projected onto the mask arrays, and written
+    into the pre-allocated datasets of <TRACEID_DIR>/files/FileXXX_rawtraces_<TRACEID_HASH>.hdf5.
+
+    file_masks (dict) : masks already loaded with load_file_masks() (otherwise, read from maskdict_path).
+    The output file gets attr 'complete'=True only once all frames are written.
+    '''
     nchannels = si_info['nchannels']
     nslices = si_info['nslices']
     nslices_full = si_info['nslices_full']
@@ -1075,42 +1220,49 @@ def apply_masks_to_tiff(currtiff_path, TID, si_info, maskdict_path=None, do_neur
     print "-- Extracting traces: %s" % curr_file
 
     # Load MASKS info:
-    if maskdict_path is None:
-        maskdict_path = os.path.join(traceid_dir, 'MASKS.hdf5')
-    MASKS = h5py.File(maskdict_path, 'r')
+    if file_masks is None:
+        if maskdict_path is None:
+            maskdict_path = os.path.join(traceid_dir, 'MASKS.hdf5')
+        file_masks = load_file_masks(maskdict_path, curr_file, do_neuropil_correction=do_neuropil_correction)
 
-    roi_slices = [k for k in MASKS[curr_file].keys() if 'Slice' in k] #maskinfo['roi_slices']
+    roi_slices = sorted(file_masks['slices'].keys(), key=natural_keys) #maskinfo['roi_slices']
 
     # Create outfile:
     filetraces_fn = '%s_rawtraces_%s.hdf5' % (curr_file, TID['trace_hash'])
     filetraces_filepath = os.path.join(traceid_dir, 'files', filetraces_fn)
 
+    # Read blocks of whole volumes, so that each block de-interleaves into the same slices:
+    chunk_size = max(nslices, int(chunk_size) - (int(chunk_size) % nslices))
+
+    file_grp = None
     try:
-        # Load input tiff file:
-        print "-- -- Reading tiff... %s" % currtiff_path
-        tiff = tf.imread(currtiff_path)
-        #print tiff.shape
-        T, d1, d2 = tiff.shape
+        # Get input tiff dims (only reads header):
+        T, d1, d2 = get_tiff_dims(currtiff_path)
         d = d1*d2
-        tiffR = np.reshape(tiff, (T, d), order='C'); del tiff
 
-        # First get signal channel only:
-        tiffR = tiffR[signal_channel_idx::nchannels,:]
-        print tiffR.shape
+        # Pages of signal channel only:
+        signal_page_idxs = np.arange(signal_channel_idx, T, nchannels)
+        print "-- -- Streaming tiff in blocks of %i frames... %s" % (chunk_size, currtiff_path)
+        print "-- -- Signal channel: %i frames (%i total pages)" % (len(signal_page_idxs), T)
+
         # Apply masks to each slice:
         file_grp = h5py.File(filetraces_filepath, 'w')
         file_grp.attrs['source_file'] = currtiff_path
         file_grp.attrs['file_id'] = curr_file
         file_grp.attrs['signal_channel'] = TID['PARAMS']['signal_channel']
         file_grp.attrs['dims'] = (d1, d2, nslices, T/nslices)
-        file_grp.attrs['mask_sourcefile'] = MASKS.attrs['source_file']  #MASKS['original_source'] #mask_path
-         
+        file_grp.attrs['mask_sourcefile'] = file_masks['source_file']  #MASKS['original_source'] #mask_path
+        file_grp.attrs['complete'] = False
+
+        # Load masks and create output datasets for each slice:
+        maskarrays = {}; np_maskarrays = {}; tracesets = {}
         roi_counter = 0
-        for sl, curr_slice in enumerate(sorted(roi_slices, key=natural_keys)):
+        for sl, curr_slice in enumerate(roi_slices):
 
             print "-- -- -- Extracting ROI time course from %s" % curr_slice
-            maskarray = MASKS[curr_file][curr_slice]['maskarray'][:]
-            print "MASK SHAPE: %s" % str(maskarray.shape)
+            smasks = file_masks['slices'][curr_slice]
+            maskarrays[curr_slice] = smasks['maskarray']
+            print "MASK SHAPE: %s" % str(maskarrays[curr_slice].shape)
 
             # Get frame tstamps:
             curr_tstamps = np.array(frames_tsec[sl::nslices_full])
@@ -1122,54 +1274,65 @@ def apply_masks_to_tiff(currtiff_path, TID, si_info, maskdict_path=None, do_neur
             fset[...] = curr_tstamps
 
             tset = file_grp.create_dataset('/'.join([curr_slice, 'frames_indices']), tstamps_indices.shape, tstamps_indices.dtype)
-            tset[...] = tstamps_indices 
+            tset[...] = tstamps_indices
 
-
-            # Get current frames:
-            tiffslice = tiffR[sl::nslices, :]
-            tracemat = tiffslice.dot(maskarray)
+            # Allocate RAW trace (filled block by block below):
+            curr_nframes = len(signal_page_idxs[sl::nslices])
+            curr_nrois = maskarrays[curr_slice].shape[-1]
+            trace_dtype = np.result_type(maskarrays[curr_slice].dtype, np.float32)
             dims = (d1, d2, T/nslices)
-            print "STACK dims for slice: %s (%s)" % (str(dims), str(tiffslice.shape))
-
-            # Save RAW trace:
-            tset = file_grp.create_dataset('/'.join([curr_slice, 'traces', 'raw']), tracemat.shape, tracemat.dtype)
-            tset[...] = tracemat
-            curr_nframes, curr_nrois = tracemat.shape
-            print "... saved tracemat: %s" % str(tracemat.shape)
-            tset.attrs['nframes'] = curr_nframes #tracemat.shape[0]
-            tset.attrs['nrois'] = curr_nrois #tracemat.shape[1]
+            print "STACK dims for slice: %s (%s)" % (str(dims), str((curr_nframes, d)))
+            tset = file_grp.create_dataset('/'.join([curr_slice, 'traces', 'raw']), (curr_nframes, curr_nrois), trace_dtype)
+            tset.attrs['nframes'] = curr_nframes
+            tset.attrs['nrois'] = curr_nrois
             tset.attrs['dims'] = dims
+            tracesets[curr_slice] = {'raw': tset}
 
-            # Save NEUROPIL traces and neurpil-CORRECTED traces, if relevant:
-            if do_neuropil_correction is True and 'np_maskarray' in MASKS[curr_file][curr_slice].keys():
+            # Allocate NEUROPIL traces and neurpil-CORRECTED traces, if relevant:
+            if do_neuropil_correction is True and 'np_maskarray' in smasks.keys():
                 print "-- -- -- + neuropil subtraction"
-                np_maskarray = np.array(MASKS[curr_file][curr_slice]['np_maskarray']) #[:]
-                np_tracemat = tiffslice.dot(np_maskarray)
-                np_corrected = tracemat - (cfactor * np_tracemat)
-                np_traces = file_grp.create_dataset('/'.join([curr_slice, 'traces', 'neuropil']), np_tracemat.shape, np_tracemat.dtype)
-                np_traces[...] = np_tracemat
-                print "... saved np tracemat: %s" % str(np_tracemat.shape)
-
-                np_corrected = file_grp.create_dataset('/'.join([curr_slice, 'traces', 'np_subtracted']), np_corrected.shape, np_corrected.dtype)
+                np_maskarrays[curr_slice] = smasks['np_maskarray']
+                np_traces = file_grp.create_dataset('/'.join([curr_slice, 'traces', 'neuropil']), (curr_nframes, curr_nrois), trace_dtype)
+                np_corrected = file_grp.create_dataset('/'.join([curr_slice, 'traces', 'np_subtracted']), (curr_nframes, curr_nrois), trace_dtype)
                 np_corrected.attrs['correction_factor'] = cfactor
-
+                tracesets[curr_slice]['neuropil'] = np_traces
+                tracesets[curr_slice]['np_subtracted'] = np_corrected
 
             # Extract NMF-denoised traces, if relevant:
-            if 'Ab' in MASKS[curr_file][curr_slice].keys():
-                Ab = MASKS[curr_file][curr_slice]['Ab'][:]
-                Cf = MASKS[curr_file][curr_slice]['Cf'][:]
+            if 'Ab' in smasks.keys():
+                Ab = smasks['Ab']
+                Cf = smasks['Cf']
                 extracted_traces = Ab.T.dot(Ab.dot(Cf))
                 extracted_traces = np.array(extracted_traces.T) # trans to get same format as other traces (NR x Tpoints)
                 ext = file_grp.create_dataset('/'.join([curr_slice, 'traces', 'denoised_nmf']), extracted_traces.shape, extracted_traces.dtype)
                 ext[...] = extracted_traces
-                ext.attrs['nb'] = MASKS[curr_file][curr_slice].attrs['nb']
-                ext.attrs['nr'] = MASKS[curr_file][curr_slice].attrs['nr']
-            
+                ext.attrs['nb'] = smasks['nb']
+                ext.attrs['nr'] = smasks['nr']
+
             # Increment ROI counter:
             slice_grp = file_grp[curr_slice]
             slice_grp.attrs['roi_indices'] = np.arange(roi_counter, roi_counter+curr_nrois)
             roi_counter += curr_nrois
 
+        # Stream signal-channel frames and project each block onto masks:
+        for start, block in iter_tiff_blocks(currtiff_path, page_idxs=signal_page_idxs, chunk_size=chunk_size):
+            blockR = np.reshape(block, (block.shape[0], d), order='C'); del block
+            for sl, curr_slice in enumerate(roi_slices):
+                tiffslice = blockR[sl::nslices, :]
+                t0 = start // nslices
+                t1 = t0 + tiffslice.shape[0]
+                tracemat = apply_maskarray(tiffslice, maskarrays[curr_slice])
+                tracesets[curr_slice]['raw'][t0:t1, :] = tracemat
+                if curr_slice in np_maskarrays:
+                    np_tracemat = apply_maskarray(tiffslice, np_maskarrays[curr_slice])
+                    tracesets[curr_slice]['neuropil'][t0:t1, :] = np_tracemat
+                    tracesets[curr_slice]['np_subtracted'][t0:t1, :] = tracemat - (cfactor * np_tracemat)
+            print "... extracted frames %i-%i of %i" % (start, start+blockR.shape[0], len(signal_page_idxs))
+
+        for curr_slice in roi_slices:
+            print "... saved tracemat: %s" % str(tracesets[curr_slice]['raw'].shape)
+        file_grp.attrs['complete'] = True
+
         print "--- Done extracting: %s ---" % curr_file
         print "--- Total of %i ROIs. ---" % roi_counter
 
@@ -1180,14 +1343,13 @@ def apply_masks_to_tiff(currtiff_path, TID, si_info, maskdict_path=None, do_neur
     finally:
         if file_grp is not None:
             file_grp.close()
-        #maskfile.close()
 
     return filetraces_filepath
 
 
 #%%
 
-def apply_masks_by_tid(tmp_tid_path, filenum=1, rootdir='', do_neuropil_correction=True, cfactor=0.5):
+def apply_masks_by_tid(tmp_tid_path, filenum=1, rootdir='', do_neuropil_correction=True, cfactor=0.5, chunk_size=500):
     filetraces_filepath = None
 
     # Load tmp rid file for coreg:
@@ -1210,6 +1372,7 @@ def apply_masks_by_tid(tmp_tid_path, filenum=1, rootdir='', do_neuropil_correcti
     print "Saving file traces to:", filetraces_dir
     if not os.path.exists(filetraces_dir):
         os.makedirs(filetraces_dir)
+    maskdict_path = os.path.join(TID['DST'], 'MASKS.hdf5')
 
     if rootdir not in TID['SRC']:
         TID['SRC'] = replace_root(TID['SRC'], rootdir, info['animalid'], info['session'])
@@ -1227,7 +1390,8 @@ def apply_masks_by_tid(tmp_tid_path, filenum=1, rootdir='', do_neuropil_correcti
                                                   do_neuropil_correction=do_neuropil_correction,
                                                   cfactor=cfactor,
                                                   output_filedir=filetraces_dir,
-                                                  rootdir=rootdir)
+                                                  rootdir=rootdir,
+                                                  chunk_size=chunk_size)
     except Exception as e:
         if filetraces_filepath is None:
             print 'Unable to find tiff src path for: %s' % curr_file
@@ -1242,10 +1406,36 @@ def apply_masks_by_tid(tmp_tid_path, filenum=1, rootdir='', do_neuropil_correcti
 # =============================================================================
 # Extract ROIs for each specified slice for each file:
 # =============================================================================
-def apply_masks_to_movies(TID, RID, si_info, maskdict_path=None, do_neuropil_correction=True, cfactor=0.6, output_filedir='/tmp', rootdir=''):
+def init_extraction_worker(terminating_, extraction_args_):
+    # Places masks + extraction params in the global namespace of each worker
+    # subprocess, so they are inherited once per worker (fork), not pickled per file.
+    global terminating, extraction_args
+    terminating = terminating_
+    extraction_args = extraction_args_
+
+def extract_file_worker(file_info):
+    curr_file, currtiff_path = file_info
+    t_file = time.time()
+    filetraces_filepath = None
+    if not terminating.is_set():
+        args = extraction_args
+        filetraces_filepath = apply_masks_to_tiff(currtiff_path, args['TID'], args['si_info'],
+                                                  do_neuropil_correction=args['do_neuropil_correction'],
+                                                  cfactor=args['cfactor'],
+                                                  output_filedir=args['output_filedir'],
+                                                  rootdir=args['rootdir'],
+                                                  chunk_size=args['chunk_size'],
+                                                  file_masks=args['masks'][curr_file])
+    return curr_file, filetraces_filepath, time.time() - t_file
+
+def apply_masks_to_movies(TID, RID, si_info, maskdict_path=None, do_neuropil_correction=True, cfactor=0.6, output_filedir='/tmp', rootdir='', chunk_size=500, n_processes=1, resume=False):
     '''
     For each .tif in this trace id set, load .tif movie and apply masks.
     Save traces as .hdf5 for each .tif file in <TRACEID_DIR>/files/.
+
+    n_processes (int) : N worker processes to extract files in parallel. Masks for all files
+                        are loaded once and shared with workers (not sent with each file).
+    resume (bool)     : skip files whose FileXXX_rawtraces_<TRACEID_HASH>.hdf5 was already fully written.
     '''
     session_dir = RID['DST'].split('/ROIs/')[0]
     info = get_info_from_tiff_dir(TID['SRC'], session_dir)
@@ -1260,29 +1450,59 @@ def apply_masks_to_movies(TID, RID, si_info, maskdict_path=None, do_neuropil_cor
     # Load MASKDICT:
     if rootdir not in TID['DST']:
         TID['DST'] = replace_root(TID['DST'], rootdir, info['animalid'], info['session'])
+    if maskdict_path is None:
+        maskdict_path = os.path.join(TID['DST'], 'MASKS.hdf5')
+    filetraces_dir = os.path.join(TID['DST'], 'files')
 
+    # Get files left to extract:
+    file_list = []
     for tfn in tiff_files:
         curr_file = str(re.search(r"File\d{3}", tfn).group())
         if curr_file in TID['PARAMS']['excluded_tiffs']:
             print "***Skipping %s -- excluded from ROI set %s" % (curr_file, RID['roi_id'])
             continue
-        print "Extracting traces: %s" % curr_file
-        currtiff_path = os.path.join(TID['SRC'], tfn)
-        filetraces_filepath = apply_masks_to_tiff(currtiff_path, TID, si_info, maskdict_path=maskdict_path,
-                                                  do_neuropil_correction=do_neuropil_correction,
-                                                  cfactor=cfactor,
-                                                  output_filedir=output_filedir, rootdir=rootdir)
-        print "Saved %s traces: %s" % (curr_file, filetraces_filepath)
+        filetraces_filepath = os.path.join(filetraces_dir, '%s_rawtraces_%s.hdf5' % (curr_file, TID['trace_hash']))
+        if resume and filetraces_complete(filetraces_filepath):
+            print "***Skipping %s -- traces already extracted (%s)" % (curr_file, TID['trace_hash'])
+            continue
+        file_list.append((curr_file, os.path.join(TID['SRC'], tfn)))
+    print "Extracting traces from %i files (%i procs)." % (len(file_list), n_processes)
+
+    # Masks for all files, loaded once:
+    masks = dict((curr_file, load_file_masks(maskdict_path, curr_file, do_neuropil_correction=do_neuropil_correction)) \
+                         for curr_file, currtiff_path in file_list)
+    extraction_args = {'TID': TID, 'si_info': si_info, 'masks': masks,
+                       'do_neuropil_correction': do_neuropil_correction, 'cfactor': cfactor,
+                       'output_filedir': output_filedir, 'rootdir': rootdir, 'chunk_size': chunk_size}
+
+    terminating = mp.Event()
+    if n_processes > 1 and len(file_list) > 1:
+        pool = mp.Pool(processes=min(n_processes, len(file_list)), initializer=init_extraction_worker,
+                       initargs=(terminating, extraction_args))
+        try:
+            for fi, (curr_file, filetraces_filepath, t_file) in enumerate(pool.imap_unordered(extract_file_worker, file_list)):
+                print "[%i of %i] Saved %s traces (%.1f s): %s" % (fi+1, len(file_list), curr_file, t_file, filetraces_filepath)
+        except KeyboardInterrupt:
+            terminating.set()
+            pool.terminate()
+            print "terminating"
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_extraction_worker(terminating, extraction_args)
+        for fi, file_info in enumerate(file_list):
+            curr_file, filetraces_filepath, t_file = extract_file_worker(file_info)
+            print "[%i of %i] Saved %s traces (%.1f s): %s" % (fi+1, len(file_list), curr_file, t_file, filetraces_filepath)
 
     # Hash filetraces files:
-    filetraces_dir = os.path.join(TID['DST'], 'files')
     hash_filetraces(filetraces_dir, TID['trace_hash'])
 
     print "TID %s -- Finished compiling trace arrays across files" % TID['trace_hash']
     print_elapsed_time(t_extract)
     print "-----------------------------------------------------------------------"
 
-    return os.path.join(TID['DST'], 'files')
+    return filetraces_dir
 
 #%%
 # =============================================================================
@@ -1875,7 +2095,7 @@ def append_corrected_fissa(exp, filetraces_dir):
 
 #%%
 
-def append_neuropil_subtraction(maskdict_path, cfactor, filetraces_dir, create_new=False, rootdir=''):
+def append_neuropil_subtraction(maskdict_path, cfactor, filetraces_dir, create_new=False, rootdir='', chunk_size=500):
 
     #signal_channel_idx = int(TID['PARAMS']['signal_channel']) - 1 # 0-indexing into tiffs
 
@@ -1924,20 +2144,20 @@ def append_neuropil_subtraction(maskdict_path, cfactor, filetraces_dir, create_n
                         info = get_info_from_tiff_dir(os.path.split(tiffpath)[0], session_dir)
                         tiffpath = replace_root(tiffpath, rootdir, info['animalid'], info['session'])
 
-                    tiff = tf.imread(tiffpath)
-                    T, d1, d2 = tiff.shape
+                    T, d1, d2 = get_tiff_dims(tiffpath)
                     d = d1*d2
                     orig_mat_shape = traces_currfile[curr_slice]['traces']['raw'].shape
                     #orig_dims = traces_currfile.attrs['dims'] # (d1, d2, nslices, T)
                     nchannels = T/orig_mat_shape[0]
                     signal_channel_idx = int(traces_currfile.attrs['signal_channel']) - 1
+                    signal_page_idxs = np.arange(signal_channel_idx, T, nchannels)
+                    print "SLICE shape is:", (len(signal_page_idxs), d)
 
-                    tiffR = np.reshape(tiff, (T, d), order='C'); del tiff
-                    tiffslice = tiffR[signal_channel_idx::nchannels,:]
-                    print "SLICE shape is:", tiffslice.shape
-
-                    np_maskarray = MASKS[curr_file][curr_slice]['np_maskarray'][:]
-                    np_tracemat = tiffslice.dot(np_maskarray)
+                    np_maskarray = load_maskarray(MASKS[curr_file][curr_slice], 'np_maskarray', as_sparse=True)
+                    np_tracemat = np.empty((len(signal_page_idxs), np_maskarray.shape[-1]), dtype=np.result_type(np_maskarray.dtype, np.float32))
+                    for start, block in iter_tiff_blocks(tiffpath, page_idxs=signal_page_idxs, chunk_size=chunk_size):
+                        blockR = np.reshape(block, (block.shape[0], d), order='C'); del block
+                        np_tracemat[start:start+blockR.shape[0], :] = apply_maskarray(blockR, np_maskarray)
 
                 if overwrite_correctedmat is True:
                     np_correctedmat = tracemat - (cfactor * np_tracemat)
@@ -2001,6 +2221,10 @@ def extract_options(options):
                       dest="do_neuropil_correction", default=False, help="Set flag to extract neuropil.")
     parser.add_option('--warp', action="store_true",
                       dest="save_warp_images", default=False, help="Set flag to save output plots of warped ROIs (manual warp only).")
+    parser.add_option('-n', '--nprocs', action="store",
+                      dest="nprocs_extract", default=1, help="N processes for applying masks to .tif files in parallel [default: 1]")
+    parser.add_option('--chunk', action="store",
+                      dest="chunk_size", default=500, help="N frames to read from each .tif at a time when applying masks [default: 500]")
 
     # ALIGNMENT opts:
     parser.add_option('--align', action='store_true', dest='align_traces', default=False, help='Set flag to align traces. Must set trial alignment and trace preprocessing params.')
@@ -2222,12 +2446,12 @@ class RoiMasks():
                 curr_file = str(re.search('File(\d{3})', target_fpath).group(0))
                 if target_fpath == self.ref_img_path:
                     # Don't need to do anything but normalize array:
-                    warps[curr_file]['maskarray'] = masks_to_normed_array(self.masks)
+                    warps[curr_file]['maskarray'] = masks_to_normed_array(self.source_mask, sparse=True)
                 else:
                     print "... Warping %s to ref." % target_fpath
                     target_img = tf.imread(target_fpath)
                     masks_aligned = self.warp_mask(target_img)
-                    warps[curr_file]['maskarray'] = masks_to_normed_array(masks_aligned)
+                    warps[curr_file]['maskarray'] = masks_to_normed_array(masks_aligned, sparse=True)
                     if save_warp_images:
                         warp_img_path = os.path.join(output_dir, 'warped_rois_r%s_to_%s.png' % (self.ref_file, fname))
                         plot_warped_rois(self.reference_img, target_img, self.masks, masks_aligned, out_fpath=warp_img_path)
@@ -2287,9 +2511,11 @@ class RoiMasks():
 
 
     def extract_neuropil_masks(self, niter):
+        d1, d2 = self.reference_img.shape
         for target_fpath in self.masks.keys():
-            np_masks = create_neuropil_masks(self.masks[target_fpath]['maskarray'], niterations=niter)
-            self.masks[target_fpath]['np_maskarray'] = masks_to_normed_array(np_masks)
+            # Binarize (sparse) normed mask array back to (d1, d2, nrois) for dilation:
+            masks = np.reshape(self.masks[target_fpath]['maskarray'].toarray() > 0, (d1, d2, -1), order='C').astype(self.source_mask.dtype)
+            self.masks[target_fpath]['np_maskarray'] = create_neuropil_maskarray(masks, niterations=niter)
             
             
                             
@@ -2438,6 +2664,8 @@ def extract_traces(options):
         print "... Specified %i iterations for annulus size." % np_niterations
         print "... Correction factor = %.2f" % np_correction_factor
     save_warp_images = options.save_warp_images
+    chunk_size = int(options.chunk_size)
+    nprocs_extract = int(options.nprocs_extract)
 
     # Trace alignment params:
     #create_dataframe = options.create_dataframe
@@ -2568,16 +2796,22 @@ def extract_traces(options):
     print "-----------------------------------------------------------------------"
     print "Checking that masks were warped to each .tif...\n    %s" % maskfig_dir
     filetraces_fns = [f for f in os.listdir(filetraces_dir) if f.endswith('hdf5')]
-    mismatch = []
-    if si_info['nslices'] > 1:
-        for slicename in ['Slice%02d' % int(i+1) for i in range(si_info['nslices'])]:
-            print "...... N=%i trace files found (expecting %i)." % (len(filetraces_fns), len(tiffs))
-            mismatch.append(len(filetraces_fns) != len(tiffs))
+    print "...... N=%i trace files found (expecting %i)." % (len(filetraces_fns), len(tiffs))
+    if np_method == 'fissa':
+        # File-traces are written by create_filetraces_from_fissa (no 'complete' attr):
+        mismatch = len(filetraces_fns) != len(tiffs)
     else:
-        print "...... N=%i trace files found (expecting %i)." % (len(filetraces_fns), len(tiffs))
-        mismatch.append(len(filetraces_fns) != len(tiffs))
-
-    if any(mismatch):
+        # Every output must exist and have been written to the end (pooled runs can be interrupted mid-file):
+        incomplete_files = get_incomplete_filetraces(filetraces_dir, 
+                                                     [f for f in tiffs if f not in TID['PARAMS']['excluded_tiffs']],
+                                                     TID['trace_hash'])
+        if len(incomplete_files) > 0:
+            print "...... %i trace files missing or incomplete: %s" % (len(incomplete_files), str(incomplete_files))
+        mismatch = len(incomplete_files) > 0
+
+    # Only re-extract all files if requested, otherwise pick up incomplete/missing files:
+    resume_extraction = create_new is False
+    if mismatch:
         create_new = True
 
     # 1)  If np_method == 'fissa', raw trace extraction and neuropil-subtraction
@@ -2592,7 +2826,10 @@ def extract_traces(options):
                                                   do_neuropil_correction=do_neuropil_correction,
                                                   cfactor=np_correction_factor,
                                                   output_filedir=filetraces_dir,
-                                                  rootdir=rootdir)
+                                                  rootdir=rootdir,
+                                                  chunk_size=chunk_size,
+                                                  n_processes=nprocs_extract,
+                                                  resume=resume_extraction)
         create_new = False # Re-toggle create-new, since traces now extracted.
         if np_method=='annulus':
             append_trace_type = True
@@ -2656,7 +2893,8 @@ def extract_traces(options):
                                                          np_correction_factor,
                                                          filetraces_dir,
                                                          create_new=create_new,
-                                                         rootdir=rootdir)
+                                                         rootdir=rootdir,
+                                                         chunk_size=chunk_size)
 
     #%
 
@@ -22,7 +22,7 @@ import numpy as np
 import pylab as pl
 
 from pipeline.python.traces import get_traces as gtraces
-from pipeline.python.utils import natural_keys, label_figure
+from pipeline.python.utils import natural_keys, label_figure, load_maskarray, save_sparse_group
 
 def create_neuropil_masks(masks, niterations=20, gap_iterations=4, verbose=False):
 
@@ -84,18 +84,18 @@ def remake_neuropil_annulus(maskdict_path, np_niterations=24, gap_niterations=4,
             print("... making masks %s" % curr_file)
             # Get masks and reshape
             filegrp = MASKS[curr_file]
-            msks = filegrp[curr_slice]['maskarray'][:]
+            msks = load_maskarray(filegrp[curr_slice], 'maskarray')
             d, nr = msks.shape
             d1, d2 = filegrp[curr_slice]['zproj'].shape # should double check this in case not equal
             msks_r = np.reshape(msks, (d1, d2, nr), order='C')
 
             # Make NP mask
-            np_masks = create_neuropil_masks(msks_r, niterations=np_niterations, gap_iterations=gap_niterations)
-            npil_arr = gtraces.masks_to_normed_array(np_masks)
+            npil_arr = gtraces.create_neuropil_maskarray(msks_r, niterations=np_niterations, gap_iterations=gap_niterations)
 
             # Save to file
-            npil = filegrp['%s/np_maskarray' % curr_slice]
-            npil[...] = npil_arr
+            if 'np_maskarray' in filegrp[curr_slice].keys():
+                del filegrp[curr_slice]['np_maskarray']
+            npil = save_sparse_group(npil_arr, filegrp[curr_slice], 'np_maskarray')
             npil.attrs['np_niterations'] = np_niterations
             npil.attrs['gap_niterations'] = gap_niterations
 
@@ -103,7 +103,7 @@ def remake_neuropil_annulus(maskdict_path, np_niterations=24, gap_niterations=4,
                 figid = maskdict_path
                 m1 = msks_r.sum(axis=-1)
                 soma_masks = np.ma.masked_where(m1==0, m1)
-                m2 = np_masks.sum(axis=-1)
+                m2 = np.reshape(np.asarray((npil_arr > 0).sum(axis=-1)), (d1, d2), order='C')
                 neuropil_masks = np.ma.masked_where(m2==0, m2)
                 fig, ax = pl.subplots()
                 ax.imshow(soma_masks, cmap='Blues', alpha=1)
@@ -19,7 +19,7 @@ import cPickle as pkl
 
 
 from caiman.utils.visualization import get_contours
-from pipeline.python.utils import natural_keys, label_figure
+from pipeline.python.utils import natural_keys, label_figure, load_maskarray
 from pipeline.python.rois import utils as rutil # import get_roi_contours, uint16_to_RGB, plot_roi_contours
 
 
@@ -120,7 +120,7 @@ class TraceSet():
         # Get masks from reference file:
         # -----------------------------------------------------------------------------
         mfile = h5py.File(transformed_mask_fpath, 'r')
-        masks = mfile[reference_file]['Slice01']['maskarray'][:]
+        masks = load_maskarray(mfile[reference_file]['Slice01'], 'maskarray')
         
         # If manual2D_circle, convert to 1s:
         if self.TID['PARAMS']['roi_type'] == 'manual2D_circle':
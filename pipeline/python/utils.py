@@ -6,10 +6,13 @@ import re
 import shutil
 import hashlib
 import scipy
+import scipy.sparse
 import h5py
 import time
 import cv2
 import traceback
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import seaborn as sns
@@ -245,6 +248,53 @@ def warp_spherical(image_values, cart_pointsX, cart_pointsY, sphr_pointsTh, sphr
     return warped_values
 
 
+def get_warp_spherical_weights(cart_pointsX, cart_pointsY, sphr_pointsTh, sphr_pointsPh, 
+                               normalize_range=True, in_radians=True):
+    '''
+    Linear weights of warp_spherical(method='linear') as a sparse (n_query x n_points) matrix, i.e., 
+    barycentric coords on the same Delaunay triangulation griddata() builds, so that
+    warp_spherical(image_values, ...).flatten() == weights.dot(image_values.flatten()) for any image.
+    Args are in the same order as warp_spherical().
+
+    Returns
+        weights : sparse CSR, barycentric weights of the 3 vertices of each query point's simplex
+        support : sparse CSR, 1 for each of those vertices (NaN values propagate even with 0 weight)
+        outside : bool array (n_query,), query points outside the convex hull (NaN in griddata())
+    '''
+    from scipy.spatial import Delaunay
+
+    xmaxRad = sphr_pointsTh.max()
+    ymaxRad = sphr_pointsPh.max()
+
+    # normalize max of Cartesian to max of Spherical
+    fx = xmaxRad/cart_pointsX.max() if normalize_range else 1.
+    fy = ymaxRad/cart_pointsY.max() if normalize_range else 1.
+    x0 = cart_pointsX.copy()*fx
+    y0 = cart_pointsY.copy()*fy
+
+    if in_radians and not normalize_range:
+        points = np.array( (np.rad2deg(sphr_pointsTh).flatten(), np.rad2deg(sphr_pointsPh).flatten()) ).T
+    else:
+        points = np.array( (sphr_pointsTh.flatten(), sphr_pointsPh.flatten()) ).T
+    query = np.array( (x0.flatten(), y0.flatten()) ).T
+    n_query, n_points = query.shape[0], points.shape[0]
+
+    tri = Delaunay(points)
+    simplex_ixs = tri.find_simplex(query)
+    outside = simplex_ixs == -1
+    inside_ixs = np.where(~outside)[0]
+
+    transforms = tri.transform[simplex_ixs[inside_ixs]]
+    bary = np.einsum('ijk,ik->ij', transforms[:, :2, :], query[inside_ixs] - transforms[:, 2, :])
+    bary = np.hstack([bary, 1 - bary.sum(axis=1)[:, np.newaxis]])
+    vertices = tri.simplices[simplex_ixs[inside_ixs]]
+
+    rows = np.repeat(inside_ixs, 3)
+    weights = scipy.sparse.csr_matrix((bary.ravel(), (rows, vertices.ravel())), shape=(n_query, n_points))
+    support = scipy.sparse.csr_matrix((np.ones(rows.shape), (rows, vertices.ravel())), shape=(n_query, n_points))
+
+    return weights, support, outside
+
 # -----------------------------------------------------------------------------
 # Plotting:
 # -----------------------------------------------------------------------------
@@ -954,6 +1004,35 @@ def load_sparse_mat(prefix, fname):
     m = scipy.sparse.csc_matrix(tuple(pars[:3]), shape=pars[3])
     return m
 
+def save_sparse_group(matrix, parent, name):
+    """ Save sparse matrix as CSC arrays (data, indices, indptr) in a new group of an open hdf5 file.
+    matrix: sparse (or dense) matrix
+    parent: open h5py File or Group
+    name  : name of group to create (shape and format are saved as group attrs)
+    """
+    matrix = scipy.sparse.csc_matrix(matrix)
+    grp = parent.create_group(name)
+    for info in ['data', 'indices', 'indptr']:
+        grp.create_dataset(info, data=getattr(matrix, info))
+    grp.attrs['shape'] = matrix.shape
+    grp.attrs['format'] = 'csc'
+    return grp
+
+def load_maskarray(parent, name='maskarray', as_sparse=False):
+    """ Load mask array (npixels x nrois) from MASKS.hdf5 slice group.
+    Handles both dense datasets (older MASKS files) and CSC groups (save_sparse_group).
+    as_sparse: return scipy.sparse.csc_matrix, otherwise dense array
+    """
+    marr = parent[name]
+    if isinstance(marr, h5py.Dataset):
+        if as_sparse:
+            return scipy.sparse.csc_matrix(marr[:])
+        return marr[:]
+    m = scipy.sparse.csc_matrix((marr['data'][:], marr['indices'][:], marr['indptr'][:]), shape=tuple(marr.attrs['shape']))
+    if as_sparse:
+        return m
+    return m.toarray()
+
 def loadmat(filename):
     '''
     this function should be called instead of direct spio.loadmat
@@ -1193,25 +1272,153 @@ def hash_file_read_only(fpath, hashtype='sha1'):
     return hashed_fpath
 
 def hash_file(fpath, hashtype='sha1'):
+    if not hashtype=='md5':
+        hashtype = 'sha1'
 
-    BLOCKSIZE = 65536
-    if hashtype=='md5':
-        hasher = hashlib.md5()
-    else:
-        hasher = hashlib.sha1()
+    return file_digest(fpath, hashtype=hashtype)[0:6]
+
+# -----------------------------------------------------------------------------
+# Directory hashing (incremental, from a per-directory manifest):
+# -----------------------------------------------------------------------------
+# Each hashed dir keeps a manifest of {relpath: [size, mtime, digest]} per hash type, so only
+# new or changed files are re-read. The manifest itself is never included in the dir hash.
+HASH_MANIFEST = '.hash_manifest.json'
 
+def file_digest(fpath, hashtype='sha1', blocksize=2**22):
+    '''
+    Full hex digest of file contents (read in blocks of blocksize bytes).
+    '''
+    hasher = hashlib.new(hashtype)
     with open(fpath, 'rb') as afile:
-        buf = afile.read(BLOCKSIZE)
+        buf = afile.read(blocksize)
         while len(buf) > 0:
             hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
+            buf = afile.read(blocksize)
+
+    return hasher.hexdigest()
+
+def load_hash_manifest(dirpath):
+    manifest_path = os.path.join(dirpath, HASH_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except ValueError:
+        print "Bad hash manifest, ignoring: %s" % manifest_path
+        manifest = {}
+    return manifest
 
-    return hasher.hexdigest()[0:6]
+def save_hash_manifest(dirpath, manifest):
+    manifest_path = os.path.join(dirpath, HASH_MANIFEST)
+    tmp_path = '%s.tmp' % manifest_path
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, sort_keys=True, indent=1)
+        os.rename(tmp_path, manifest_path)
+    except (IOError, OSError) as e:
+        # Read-only dirs are hashed as usual, just without updating the manifest.
+        print "Unable to save hash manifest (%s): %s" % (str(e), manifest_path)
+
+def get_dir_digests(dirpath, hashtype='sha1', excluded_files=[], nprocs=8, update_manifest=True):
+    '''
+    Digest of each file in dirpath (recursive; excluded_files are file names to skip).
+    Digests of files whose size and mtime match the dir's manifest are reused, and only
+    new or changed files are read (in parallel, nprocs threads).
+
+    Returns dict: {relpath: digest}
+    '''
+    excluded_files = list(excluded_files) + [HASH_MANIFEST, '%s.tmp' % HASH_MANIFEST]
+    manifest = load_hash_manifest(dirpath)
+    prev_entries = manifest.get(hashtype, {})
+
+    entries = {}; to_hash = []
+    for root, dirs, files in os.walk(dirpath, topdown=True):
+        for fname in files:
+            if fname in excluded_files:
+                continue
+            fpath = os.path.join(root, fname)
+            relpath = os.path.relpath(fpath, dirpath)
+            st = os.stat(fpath)
+            prev = prev_entries.get(relpath)
+            if prev is not None and prev[0] == st.st_size and prev[1] == st.st_mtime:
+                entries[relpath] = prev
+            else:
+                to_hash.append((relpath, st.st_size, st.st_mtime))
+
+    if len(to_hash) > 0:
+        print "Hashing %i of %i files in %s" % (len(to_hash), len(to_hash) + len(entries), dirpath)
+        t_hash = time.time()
+        # hashlib releases the GIL on large reads, so threads are enough to overlap I/O:
+        pool = ThreadPool(processes=max(1, min(nprocs, len(to_hash))))
+        try:
+            digests = pool.map(lambda f: file_digest(os.path.join(dirpath, f[0]), hashtype=hashtype), to_hash)
+        finally:
+            pool.close()
+            pool.join()
+        for (relpath, size, mtime), digest in zip(to_hash, digests):
+            entries[relpath] = [size, mtime, digest]
+        print_elapsed_time(t_hash)
+
+    # Keep entries of (existing) excluded files, since other callers may hash them:
+    new_entries = dict((k, v) for k, v in prev_entries.items() if k not in entries
+                       and os.path.basename(k) in excluded_files and os.path.exists(os.path.join(dirpath, k)))
+    new_entries.update(entries)
+    if update_manifest and new_entries != prev_entries:
+        manifest[hashtype] = new_entries
+        save_hash_manifest(dirpath, manifest)
+
+    return dict((relpath, entry[2]) for relpath, entry in entries.items())
+
+def dirhash(dirpath, hashtype='sha1', excluded_files=[], nprocs=8, update_manifest=True):
+    '''
+    Hash of all file contents in dirpath, same value as checksumdir.dirhash(dirpath, hashtype, excluded_files)
+    (hash of the sorted per-file hex digests), but only new or changed files are re-read (see get_dir_digests()).
+    '''
+    if not os.path.isdir(dirpath):
+        raise TypeError('%s is not a directory.' % dirpath)
+    digests = get_dir_digests(dirpath, hashtype=hashtype, excluded_files=excluded_files,
+                              nprocs=nprocs, update_manifest=update_manifest)
+    hasher = hashlib.new(hashtype)
+    for digest in sorted(digests.values()):
+        hasher.update(digest.encode('utf-8'))
+
+    return hasher.hexdigest()
 
 
 # -----------------------------------------------------------------------------
 # General TIFF processing methods:
 # -----------------------------------------------------------------------------
+def iter_tiff_blocks(tiff_path, page_idxs=None, chunk_size=500):
+    '''
+    Read pages of a tiff in blocks, so that only chunk_size frames are held
+    in memory at once (instead of tf.imread on the whole stack).
+
+    tiff_path (str) : path to .tif file
+    page_idxs (array) : indices of pages to read, in order (default: all pages)
+    chunk_size (int) : max number of pages per block
+
+    Yields (start, block), where start is the position of the block's first
+    page in page_idxs, and block is an array of shape (nframes_in_block, d1, d2).
+    '''
+    with tf.TiffFile(tiff_path) as tif:
+        if page_idxs is None:
+            page_idxs = np.arange(0, len(tif.pages))
+        d1, d2 = tif.pages[0].shape[-2:]
+        for start in range(0, len(page_idxs), chunk_size):
+            curr_idxs = [int(p) for p in page_idxs[start:start+chunk_size]]
+            block = tif.asarray(key=curr_idxs)
+            yield start, np.reshape(block, (len(curr_idxs), d1, d2))
+
+def get_tiff_dims(tiff_path):
+    '''
+    Returns number of pages (frames, all channels/slices) and frame dims of a tiff without reading image data.
+    '''
+    with tf.TiffFile(tiff_path) as tif:
+        npages = len(tif.pages)
+        d1, d2 = tif.pages[0].shape[-2:]
+    return npages, d1, d2
+
 def interleave_tiffs(source_dir, write_dir, runinfo_path):
     '''
     source_dir (str) : path to folder containing tiffs to interleave
@@ -1359,11 +1566,281 @@ def sort_deinterleaved_tiffs(source_dir, runinfo_path):
     print "Done organizing tiffs."
 
 
-def zproj_tseries(source_dir, runinfo_path, zproj_type='mean', write_dir=None, filter3D=False, filter_type='median', filter_size=4):
+# -----------------------------------------------------------------------------
+# Z-projection (single pass over each tiff):
+# -----------------------------------------------------------------------------
+ZPROJ_STATS = {'mean': 'mean', 'average': 'mean', 'std': 'std', 'max': 'max'}
+
+def round_to_dtype(img, dtype):
+    # Same rounding as scipy.ndimage output to integer types (half away from 0):
+    if np.issubdtype(dtype, np.integer):
+        img = np.sign(img) * np.floor(np.abs(img) + 0.5)
+    return img.astype(dtype)
+
+def update_zproj_stats(stats, frames):
+    '''
+    Add frames (nframes x d1 x d2) to running count, mean, M2 (sum of squared deviations) and max,
+    merging each block's stats into the running stats (Welford / Chan et al.), so std needs 1 pass.
+    Also keeps running float64 sums of frames and squared frames (exact for integer frames, below 2**53),
+    for the mean image and the std image of integer stacks (see get_zproj_images()).
+    '''
+    frames = frames.astype(float)
+    nb = frames.shape[0]
+    if stats is None:
+        stats = {'n': 0, 'sum': np.zeros(frames.shape[1:]), 'sumsq': np.zeros(frames.shape[1:]),
+                 'mean': np.zeros(frames.shape[1:]), 'M2': np.zeros(frames.shape[1:]),
+                 'max': np.ones(frames.shape[1:]) * -np.inf}
+    if nb == 0:
+        return stats
+    block_mean = frames.mean(axis=0)
+    block_M2 = ((frames - block_mean)**2).sum(axis=0)
+    n = stats['n'] + nb
+    delta = block_mean - stats['mean']
+    stats['mean'] += delta * nb / float(n)
+    stats['M2'] += block_M2 + delta**2 * stats['n'] * nb / float(n)
+    stats['max'] = np.maximum(stats['max'], frames.max(axis=0))
+    stats['sum'] += frames.sum(axis=0)
+    stats['sumsq'] += (frames**2).sum(axis=0)
+    stats['n'] = n
+
+    return stats
+
+def floor_int_std(stats):
+    '''
+    floor(std) of integer frames, from exact running sums: floor(sqrt(n*sumsq - sum**2) / n),
+    in integer arithmetic (python ints if int64 could overflow), so truncating is never off by 1.
+    '''
+    n = stats['n']
+    if n * stats['sumsq'].max() < 2**62:
+        s1 = stats['sum'].astype(np.int64); s2 = stats['sumsq'].astype(np.int64)
+    else:
+        s1 = stats['sum'].astype(np.int64).astype(object); s2 = stats['sumsq'].astype(np.int64).astype(object)
+    num = n * s2 - s1**2
+    # Integer sqrt: float estimate, corrected to the largest r with r**2 <= num
+    r = np.floor(np.sqrt(num.astype(float))).astype(np.int64).astype(num.dtype)
+    while True:
+        over = r * r > num
+        if not over.any():
+            break
+        r = np.where(over, r - 1, r)
+    while True:
+        under = (r + 1) * (r + 1) <= num
+        if not under.any():
+            break
+        r = np.where(under, r + 1, r)
+
+    return (r // n).astype(float)
+
+def get_zproj_images(stats, zproj_types, dtype):
+    # Same as np.mean/np.std/np.max(frames, axis=0).astype(dtype). Std of integer stacks is truncated
+    # from exact sums (floor_int_std()); float stacks use the merged M2.
+    zproj = dict()
+    for zproj_type in zproj_types:
+        if ZPROJ_STATS[zproj_type] == 'std':
+            if np.issubdtype(dtype, np.integer):
+                img = floor_int_std(stats)
+            else:
+                img = np.sqrt(stats['M2'] / stats['n'])
+        elif ZPROJ_STATS[zproj_type] == 'mean':
+            img = stats['sum'] / float(stats['n'])
+        else:
+            img = stats[ZPROJ_STATS[zproj_type]]
+        zproj[zproj_type] = img.astype(dtype)
+    return zproj
+
+class FrameResampler(object):
+    '''
+    Streamed version of scipy.ndimage.zoom(frames, zoom_factor, order) for order 0 (nearest) or 1 (linear):
+    frames are added in blocks, and add() returns each output frame once its input frames have been added.
+    '''
+    def __init__(self, nframes, zoom_factor, order=1):
+        self.zoom_factor = zoom_factor
+        self.order = order
+        nframes_out = int(round(nframes * zoom_factor[0]))
+        step = (nframes - 1) / float(nframes_out - 1) if nframes_out > 1 else 1.
+        coords = np.arange(nframes_out) * step
+        if order == 0:
+            self.lo = np.floor(coords + 0.5).astype(int).clip(max=nframes-1)
+            self.w = np.zeros(coords.shape)
+        else:
+            self.lo = np.floor(coords).astype(int).clip(max=nframes-1)
+            self.w = coords - self.lo
+        self.hi = np.where(self.w > 0, self.lo + 1, self.lo).clip(max=nframes-1)
+        self.next_out = 0
+        self.nseen = 0
+        self.last_frame = None
+
+    def add(self, frames):
+        dtype = frames.dtype
+        first = self.nseen
+        self.nseen += frames.shape[0]
+        if self.last_frame is not None:
+            frames = np.concatenate([self.last_frame[np.newaxis, :, :], frames], axis=0)
+            first -= 1
+        ready = np.arange(self.next_out, len(self.hi))[self.hi[self.next_out:] < self.nseen]
+        self.next_out += len(ready)
+        self.last_frame = frames[-1]
+
+        w = self.w[ready][:, np.newaxis, np.newaxis]
+        samples = (1 - w) * frames[self.lo[ready] - first] + w * frames[self.hi[ready] - first]
+        if len(ready) > 0 and tuple(self.zoom_factor[1:]) != (1, 1):
+            samples = ndimage.zoom(samples, (1,) + tuple(self.zoom_factor[1:]), order=self.order)
+
+        return round_to_dtype(samples, dtype)
+
+def zproj_tiff_pages(tiff_path, page_groups, zproj_types=['mean'], chunk_size=200, downsample_factor=None, order=1,
+                     filter3D=False, filter_type='median', filter_size=4):
+    '''
+    Z-project groups of pages of a tiff, in a single pass over the file (chunk_size pages at a time).
+
+    page_groups (dict) : key -> page idxs in group, in order (e.g., pages of 1 slice of 1 channel)
+    zproj_types (list) : any of 'mean' (or 'average'), 'std', 'max' -- all from the same pass
+    downsample_factor (tuple) : (t, y, x) factors to zoom each group's frames by before z-projecting,
+                                as scipy.ndimage.zoom(frames, downsample_factor, order=order)
+    filter3D (bool) : median-filter (filter_size) each group's frames before z-projecting
+
+    Returns dict: key -> {zproj_type: image}, images in the tiff's dtype.
+    Filtering and cubic (order > 1) downsampling need all frames of a group at once, so those are held in memory.
+    '''
+    npages, d1, d2 = get_tiff_dims(tiff_path)
+    keys = list(page_groups.keys())
+    page_group = np.ones((npages,), dtype=int) * -1
+    for gi, key in enumerate(keys):
+        assert all(np.diff(page_groups[key]) > 0), "Pages of group %s not in order." % str(key)
+        page_group[np.array(page_groups[key], dtype=int)] = gi
+    read_idxs = np.where(page_group > -1)[0]
+
+    hold_frames = (filter3D and filter_type == 'median') or (downsample_factor is not None and order > 1)
+    if downsample_factor is not None and not hold_frames:
+        resamplers = [FrameResampler(len(page_groups[key]), downsample_factor, order=order) for key in keys]
+    held = [[] for key in keys]
+    stats = [None for key in keys]
+    dtype = None
+    for start, block in iter_tiff_blocks(tiff_path, page_idxs=read_idxs, chunk_size=chunk_size):
+        dtype = block.dtype
+        block_groups = page_group[read_idxs[start:start+block.shape[0]]]
+        for gi in np.unique(block_groups):
+            frames = block[block_groups == gi]
+            if hold_frames:
+                held[gi].append(frames)
+                continue
+            if downsample_factor is not None:
+                frames = resamplers[gi].add(frames)
+            stats[gi] = update_zproj_stats(stats[gi], frames)
+
+    if hold_frames:
+        for gi in range(len(keys)):
+            frames = np.concatenate(held[gi], axis=0)
+            held[gi] = None
+            if filter3D and filter_type == 'median':
+                print "Median filtering, size %i" % filter_size
+                frames = ndimage.median_filter(frames, size=filter_size)
+            if downsample_factor is not None:
+                frames = ndimage.zoom(frames, downsample_factor, order=order)
+            stats[gi] = update_zproj_stats(None, frames)
+
+    return dict((key, get_zproj_images(stats[gi], zproj_types, dtype)) for gi, key in enumerate(keys))
+
+def zproj_tiff_file(tfn, fname, source_dir=None, file_info=None, nslices=1, zproj_types=['mean'], write_dirs={},
+                    filter3D=False, filter_type='median', filter_size=4, chunk_size=200):
+    '''
+    Z-project each slice of each channel of 1 tiff (source_dir/tfn), and save each projection type to
+    write_dirs[zproj_type]/<zproj_type>_SliceNN_ChannelNN_FileNNN.tif (+ vis_ copy).
+    file_info: {'nvolumes': n volumes, 'channelSave': SI.hChannels.channelSave} of file fname.
+    '''
+    filenum = int(fname[4:]) #int(fi + 1)
+    tiff_path = os.path.join(source_dir, tfn)
+
+    # Get tif info:
+    nvolumes = file_info['nvolumes']
+    if isinstance(file_info['channelSave'], int):
+        nchannels = 1
+    else:
+        nchannels = len(file_info['channelSave'])
+    npages, d1, d2 = get_tiff_dims(tiff_path)
+    print "-- tif shape: %s" % str((npages, d1, d2))
+    if npages == nvolumes and nchannels > 1:  # channels already split
+        nslices_actual = npages / nvolumes
+        channels_are_split = True
+    else:
+        nslices_actual = float(npages)/float(nchannels*nvolumes)
+        channels_are_split = False
+
+    ndiscard = nslices_actual - nslices
+    print "--- --- N channels: %i, N volumes: %i" % (nchannels, nvolumes)
+    print "--- --- N slices actual: %i, N slices expected: %i (discard: %i)" % (nslices_actual, nslices, ndiscard)
+    if npages != nchannels*(nslices+ndiscard)*nvolumes:
+        print "*** WARNING: Loaded tiff shape does not match dims expected:", tiff_path
+        print "--- nchannels: %i, nslices: %i, ndiscard: %i, nvolumes: %i" % (nchannels, nslices, ndiscard, nvolumes)
+
+    if channels_are_split:
+        nchannel_cycles = 1
+    else:
+        nchannel_cycles = nchannels
+
+    # Pages of each slice of each channel:
+    page_groups = dict()
+    all_pages = np.arange(0, npages)
+    for ch in range(nchannel_cycles):
+        if 'Channel' in tfn: # channels are split
+            curr_channel = str(re.search('Channel(\d{2})', tfn).group(0))
+            assert (channels_are_split is True) or (nchannels==1), "Not sure if 1 channel or multiple split channels..."
+            ch_pages = all_pages
+        else:
+            if isinstance(file_info['channelSave'], int):
+                curr_channel = 'Channel%02d' %  int(file_info['channelSave'])
+                ch_pages = all_pages
+            else:
+                curr_channel = 'Channel%02d' % int(ch+1) # there are multi channels, nad we are cycling thru (not split)
+                assert channels_are_split is False, "More than 1 channel found and no split detected..."
+                print "... CH %i:  Grabbing every other channel" % int(ch+1)
+                ch_pages = all_pages[ch::nchannels]
+        channelnum = int(curr_channel[7:]) #int(ch+1)
+        stack_step = int(nslices+ndiscard)
+        for sl in range(nslices):
+            page_groups[(channelnum, int(sl+1))] = ch_pages[sl::stack_step]
+
+    zprojs = zproj_tiff_pages(tiff_path, page_groups, zproj_types=zproj_types, chunk_size=chunk_size,
+                              filter3D=filter3D, filter_type=filter_type, filter_size=filter_size)
+
+    for (channelnum, slicenum) in sorted(zprojs.keys()):
+        curr_slice_fn = default_filename(slicenum, channelnum, filenum, acq=None, run=None)
+        for zproj_type in zproj_types:
+            zprojslice = zprojs[(channelnum, slicenum)][zproj_type]
+            tf.imsave(os.path.join(write_dirs[zproj_type], '%s_%s.tif' % (zproj_type, curr_slice_fn)), zprojslice)
+
+            # Save visible too:
+            byteimg = img_as_ubyte(zprojslice)
+            zproj_vis = exposure.rescale_intensity(byteimg, in_range=(byteimg.min(), byteimg.max()))
+            tf.imsave(os.path.join(write_dirs[zproj_type], 'vis_%s_%s.tif' % (zproj_type, curr_slice_fn)), zproj_vis)
+
+        print "... Finished zproj (%s) for %s, Slice%02d, Channel%02d." % ('|'.join(zproj_types), fname, slicenum, channelnum)
+
+    return fname
+
+def init_zproj_worker(terminating_, zproj_args_):
+    # As initializer(), and places the z-projection args in the worker's global namespace.
+    global terminating, zproj_args
+    terminating = terminating_
+    zproj_args = zproj_args_
+
+def zproj_worker(tiff_file):
+    if terminating.is_set():
+        return None
+    tfn, fname = tiff_file
+    file_args = dict((k, v) for k, v in zproj_args.items() if k != 'file_info')
+
+    return zproj_tiff_file(tfn, fname, file_info=zproj_args['file_info'][fname], **file_args)
+
+def zproj_tseries(source_dir, runinfo_path, zproj_type='mean', write_dir=None, filter3D=False, filter_type='median', filter_size=4,
+                  zproj_types=None, nprocs=1, chunk_size=200):
     '''
     source_dir (str) : path to folder containing tiffs to deinterleave and z-project
     runinfo_path (str) : path to .json contaning run meta info
     write_dir (str) : path to save averaged slices to
+    zproj_types (list) : projections to save from the same read of each tiff (default: [zproj_type]).
+                         Each is saved to source_dir_<type>_deinterleaved (or write_dir, for zproj_type).
+    nprocs (int) : n tiffs to z-project in parallel
     '''
     with open(runinfo_path, 'r') as f:
         runinfo = json.load(f)
@@ -1378,92 +1855,56 @@ def zproj_tseries(source_dir, runinfo_path, zproj_type='mean', write_dir=None, f
     #ntotalframes = nslices * nvolumes * nchannels
     basename = runinfo['base_filename']
 
+    if zproj_types is None:
+        zproj_types = [zproj_type]
+    elif zproj_type not in zproj_types:
+        zproj_types = [zproj_type] + list(zproj_types)
+
     # Default write-dir should be source_dir_<projectiontype>_deinterleaved
-    if write_dir is None:
-        write_dir = source_dir + '_%s_deinterleaved' % zproj_type
-    if not os.path.exists(write_dir):
-        os.makedirs(write_dir)
-    print "Writing AVERAGED SLICES to:", write_dir
+    write_dirs = dict((zt, source_dir + '_%s_deinterleaved' % zt) for zt in zproj_types)
+    if write_dir is not None:
+        write_dirs[zproj_type] = write_dir
+    for zt in zproj_types:
+        if not os.path.exists(write_dirs[zt]):
+            os.makedirs(write_dirs[zt])
+        print "Writing %s SLICES to:" % zt.upper(), write_dirs[zt]
 
     tiffs = sorted([t for t in os.listdir(source_dir) if t.endswith('tif')], key=natural_keys)
     print tiffs
     #filenames = ['File%03d' % int(i+1) for i in range(len(tiffs))] #nfiles)]
     filenames = [str(re.search('File(\d{3})', tf_path).group(0)) for tf_path in tiffs]
     print filenames
-    for fi, (tfn, fname) in enumerate(zip(sorted(tiffs, key=natural_keys), sorted(filenames, key=natural_keys))):
-        filenum = int(fname[4:]) #int(fi + 1)
-        print "Z-projecting %i of %i tiff files." % (fi+1, len(tiffs))
-	print "...", fi, fname, tfn
-       
-        # Get tif info:
-        nvolumes = simeta[fname]['SI']['hFastZ']['numVolumes']
-        if isinstance(simeta[fname]['SI']['hChannels']['channelSave'], int):
-            nchannels = 1
-        else:
-            nchannels = len(simeta[fname]['SI']['hChannels']['channelSave'])
-        currtiff = tf.imread(os.path.join(source_dir, tfn))
-        print "-- tif shape: %s" % str(currtiff.shape)
-        if currtiff.shape[0] == nvolumes and nchannels > 1:  # channels already split
-            nslices_actual = currtiff.shape[0] / nvolumes
-            channels_are_split = True
-        else:
-            nslices_actual = float(currtiff.shape[0])/float(nchannels*nvolumes) 
-            channels_are_split = False
-
-	ndiscard = nslices_actual - nslices
-        print "--- --- N channels: %i, N volumes: %i" % (nchannels, nvolumes)
-        print "--- --- N slices actual: %i, N slices expected: %i (discard: %i)" % (nslices_actual, nslices, ndiscard)
-        if currtiff.shape[0] != nchannels*(nslices+ndiscard)*nvolumes:
-            print "*** WARNING: Loaded tiff shape does not match dims expected:", os.path.join(source_dir, tfn)
-            print "--- nchannels: %i, nslices: %i, ndiscard: %i, nvolumes: %i" % (nchannels, nslices, ndiscard, nvolumes)
-
-        if channels_are_split:
-            nchannel_cycles = 1
-        else:
-            nchannel_cycles = nchannels 
-
- 
-        for ch in range(nchannel_cycles):
-            if 'Channel' in tfn: # channels are split
-                curr_channel = str(re.search('Channel(\d{2})', tfn).group(0))
-                assert (channels_are_split is True) or (nchannels==1), "Not sure if 1 channel or multiple split channels..."
-                ch_tiff = currtiff
-            else:
-                if isinstance(simeta[fname]['SI']['hChannels']['channelSave'], int):
-                    curr_channel = 'Channel%02d' %  int(simeta[fname]['SI']['hChannels']['channelSave'])
-                    ch_tiff = currtiff
-                else:
-                    curr_channel = 'Channel%02d' % int(ch+1) # there are multi channels, nad we are cycling thru (not split)
-                    assert channels_are_split is False, "More than 1 channel found and no split detected..."
-                    print "... CH %i:  Grabbing every other channel" % int(ch+1)
-                    ch_tiff = currtiff[ch::nchannels, :, :]
- 
-    	    channelnum = int(curr_channel[7:]) #int(ch+1)
-            for sl in range(nslices):
-                slicenum = int(sl+1)
-                stack_step = int(nslices+ndiscard)
-                sl_tiff = ch_tiff[sl::stack_step, :, :]
-                print "... Slice tiff shape:", sl_tiff.shape
-                if filter3D:
-                    if filter_type == 'median':
-                        print "Median filtering, size %i" % filter_size
-                        sl_tiff = ndimage.median_filter(sl_tiff, size=filter_size)
-                if zproj_type == 'mean' or zproj_type == 'average':
-                    zprojslice = np.mean(sl_tiff, axis=0).astype(currtiff.dtype)
-                elif zproj_type == 'std':
-                    zprojslice = np.std(sl_tiff, axis=0).astype(currtiff.dtype)
-                curr_slice_fn = default_filename(slicenum, channelnum, filenum, acq=None, run=None)
-                tf.imsave(os.path.join(write_dir, '%s_%s.tif' % (zproj_type, curr_slice_fn)), zprojslice)
-            
-                # Save visible too:
-                byteimg = img_as_ubyte(zprojslice)
-                zproj_vis = exposure.rescale_intensity(byteimg, in_range=(byteimg.min(), byteimg.max()))
-                tf.imsave(os.path.join(write_dir, 'vis_%s_%s.tif' % (zproj_type, curr_slice_fn)), zproj_vis)
-
-                print "... Finished zproj for %s, Slice%02d, Channel%02d." % (fname, int(sl+1), channelnum) #int(ch+1))
+    tiff_files = zip(sorted(tiffs, key=natural_keys), sorted(filenames, key=natural_keys))
+    file_info = dict((fname, {'nvolumes': simeta[fname]['SI']['hFastZ']['numVolumes'],
+                              'channelSave': simeta[fname]['SI']['hChannels']['channelSave']}) for fname in filenames)
+    zproj_args = {'source_dir': source_dir, 'file_info': file_info, 'nslices': nslices, 'zproj_types': zproj_types,
+                  'write_dirs': write_dirs, 'filter3D': filter3D, 'filter_type': filter_type,
+                  'filter_size': filter_size, 'chunk_size': chunk_size}
+
+    if nprocs > 1:
+        terminating = mp.Event()
+        pool = mp.Pool(initializer=init_zproj_worker, initargs=(terminating, zproj_args), processes=nprocs)
+        try:
+            done = pool.map_async(zproj_worker, tiff_files).get(999999)
+            print "Z-projected %i of %i tiff files." % (len([d for d in done if d is not None]), len(tiffs))
+        except KeyboardInterrupt:
+            terminating.set()
+            print "**interupt"
+            pool.terminate()
+            print "***Terminating!"
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        file_args = dict((k, v) for k, v in zproj_args.items() if k != 'file_info')
+        for fi, (tfn, fname) in enumerate(tiff_files):
+            print "Z-projecting %i of %i tiff files." % (fi+1, len(tiffs))
+            print "...", fi, fname, tfn
+            zproj_tiff_file(tfn, fname, file_info=file_info[fname], **file_args)
 
     # Sort separated tiff slice images:
-    sort_deinterleaved_tiffs(write_dir, runinfo_path)  # Moves all 'vis_' files to separate subfolder 'visible'
+    for zt in zproj_types:
+        sort_deinterleaved_tiffs(write_dirs[zt], runinfo_path)  # Moves all 'vis_' files to separate subfolder 'visible'
 
 
 